@@ -0,0 +1,89 @@
+"""Bytes per block of the in-memory chain: CompactChain versus the old list of dicts.
+
+Usage: python bench/chain_memory.py [--blocks 1000000] [--tx-per-block 1] [--baseline-sample 100000]
+
+The dict baseline is measured on --baseline-sample blocks and reported per
+block, since a million dicts alone can take more memory than a small box has.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from main import CompactChain  # noqa: E402
+
+START = datetime(2024, 1, 1)
+ADDRESSES = [hashlib.md5(str(i).encode()).hexdigest() for i in range(1000)]
+
+
+def synthetic_block(index, tx_per_block):
+    block_hash = hashlib.sha256(str(index).encode()).hexdigest()
+    previous_hash = hashlib.sha256(str(index - 1).encode()).hexdigest()
+    transactions = [("system" if i == 0 else ADDRESSES[(index + i) % len(ADDRESSES)],
+                     ADDRESSES[index % len(ADDRESSES)], 10.0) for i in range(tx_per_block)]
+    return (index, f"Time capsule message {index}", block_hash, previous_hash,
+            START + timedelta(seconds=index), index % 50 or None, transactions)
+
+
+def measure(build, blocks):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del store
+    return used / blocks
+
+
+def build_compact(blocks, tx_per_block):
+    chain = CompactChain()
+    for index in range(blocks):
+        chain.put(*synthetic_block(index, tx_per_block))
+    return chain
+
+
+def build_dicts(blocks, tx_per_block):
+    chain = []
+    for index in range(blocks):
+        index, message, block_hash, previous_hash, timestamp, owner_id, transactions = synthetic_block(index, tx_per_block)
+        chain.append({
+            "index": index,
+            "message": message,
+            "hash": block_hash,
+            "previous_hash": previous_hash,
+            "timestamp": timestamp,
+            "owner_id": owner_id,
+            "transactions": [{"from_address": tx[0], "to_address": tx[1], "amount": tx[2]} for tx in transactions]
+        })
+    return chain
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--blocks', type=int, default=1_000_000)
+    parser.add_argument('--tx-per-block', type=int, default=1)
+    parser.add_argument('--baseline-sample', type=int, default=100_000)
+    args = parser.parse_args()
+
+    sample = min(args.baseline_sample, args.blocks)
+    compact = measure(lambda: build_compact(args.blocks, args.tx_per_block), args.blocks)
+    dicts = measure(lambda: build_dicts(sample, args.tx_per_block), sample)
+    print(json.dumps({
+        "blocks": args.blocks,
+        "tx_per_block": args.tx_per_block,
+        "compact_bytes_per_block": round(compact, 1),
+        "dict_bytes_per_block": round(dicts, 1),
+        "dict_sample_blocks": sample,
+        "compact_total_mb": round(compact * args.blocks / 2 ** 20, 1),
+        "dict_total_mb_estimate": round(dicts * args.blocks / 2 ** 20, 1),
+        "ratio": round(dicts / compact, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Replay a synthetic order stream through the in-memory matching engine and report orders/sec.
+
+Usage: python bench/order_replay.py [--orders 1000000] [--market-ratio 0.1] [--cancel-ratio 0.05]
+
+Only the OrderBook is exercised (no database), so this measures the matching
+core that the match-orders process runs between settlements.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from main import BookOrder, OrderBook  # noqa: E402
+
+
+def order_stream(args):
+    rng = random.Random(args.seed)
+    mid = 100.0
+    for order_id in range(1, args.orders + 1):
+        mid = max(1.0, mid + rng.gauss(0, 0.05))
+        side = 'buy' if rng.random() < 0.5 else 'sell'
+        quantity = round(rng.uniform(0.1, 10), 2)
+        if rng.random() < args.market_ratio:
+            collar = mid * (1.1 if side == 'buy' else 0.9)
+            yield BookOrder(order_id, order_id % args.users, side, 'market', None, collar, quantity)
+        else:
+            offset = abs(rng.gauss(0, args.spread))
+            price = round(mid - offset if side == 'buy' else mid + offset, 2)
+            if rng.random() < args.cross_ratio:
+                price = round(mid + offset if side == 'buy' else mid - offset, 2)
+            yield BookOrder(order_id, order_id % args.users, side, 'limit', price, price, quantity)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--market-ratio', type=float, default=0.1)
+    parser.add_argument('--cross-ratio', type=float, default=0.2, help='Share of limit orders priced through the mid.')
+    parser.add_argument('--cancel-ratio', type=float, default=0.05, help='Chance of cancelling a random resting order per order.')
+    parser.add_argument('--spread', type=float, default=0.5, help='Std-dev of limit prices around the mid.')
+    parser.add_argument('--seed', type=int, default=2025)
+    args = parser.parse_args()
+
+    orders = list(order_stream(args))
+    rng = random.Random(args.seed + 1)
+    book = OrderBook()
+    fills = cancels = 0
+    started = time.perf_counter()
+    for order in orders:
+        fills += len(book.submit(order))
+        if book.orders and rng.random() < args.cancel_ratio:
+            book.cancel(next(iter(book.orders)))
+            cancels += 1
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "orders": args.orders,
+        "fills": fills,
+        "cancels": cancels,
+        "resting_orders": len(book.orders),
+        "seconds": round(elapsed, 3),
+        "orders_per_second": round(args.orders / elapsed),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    cli()
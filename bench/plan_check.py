@@ -0,0 +1,156 @@
+"""EXPLAIN every statement the routes issue and fail on sequential scans of large tables.
+
+Usage:
+    python bench/seed.py --truncate            # once, against a scratch database
+    python bench/plan_check.py [--min-rows 10000] [--writes] [--admin ADMIN_USER]
+
+Each route is requested once through the Flask test client while the pooled
+connections record every statement with its parameters bound. The distinct
+statements are then run through EXPLAIN (never executed) on a separate
+connection, and any Seq Scan on a table with at least --min-rows estimated
+rows is reported. Exits 1 when one is found, so it can gate a change.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+import psycopg2
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from run import login, routes, stub_server  # noqa: E402  (starts the stub Binance server)
+
+import main  # noqa: E402
+
+EXPLAINABLE = ('select', 'with', 'update', 'delete', 'insert')
+captured = []
+
+
+class CapturingCursor(main.InstrumentedCursor):
+    """Instrumented cursor that also keeps every statement with its parameters bound."""
+
+    def execute(self, query, vars=None):
+        captured.append(self.mogrify(query, vars).decode())
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        captured.extend(self.mogrify(query, vars).decode() for vars in vars_list)
+        return super().executemany(query, vars_list)
+
+
+def instrument_pool():
+    getconn = main.db_pool.getconn
+
+    def capturing_getconn():
+        conn = getconn()
+        conn.cursor_factory = CapturingCursor
+        return conn
+
+    main.db_pool.getconn = capturing_getconn
+
+
+def extra_routes(cursor, args):
+    """Routes run.py does not measure, with ids taken from the seeded data."""
+    cursor.execute('SELECT MIN(id) FROM posts')
+    post_id = cursor.fetchone()[0] or 1
+    cursor.execute('SELECT MAX("index") FROM blocks')
+    last_index = cursor.fetchone()[0] or 0
+    extra = [
+        ('post', 'GET', lambda: f'/board/{post_id}', None),
+        ('search', 'GET', lambda: '/search?q=samurai', None),
+        ('api_search', 'GET', lambda: '/api/search?q=ledger&kind=post', None),
+        ('api_transactions', 'GET', lambda: '/api/transactions', None),
+        ('api_blocks', 'GET', lambda: f'/api/blocks?from={max(0, last_index - 100)}&to={last_index}', None),
+        ('api_block', 'GET', lambda: f'/api/blocks/{last_index}', None),
+        ('trade_puk', 'GET', lambda: '/trade_puk', None),
+        ('puk_klines', 'GET', lambda: '/api/klines/PUK/1h', None),
+        ('klines', 'GET', lambda: '/api/klines/4h', None),
+    ]
+    if args.admin:
+        extra.append(('admin_dashboard', 'GET', lambda: '/admin_dashboard', None))
+    return extra
+
+
+def plan_seq_scans(node):
+    """Yield the relation of every Seq Scan node in an EXPLAIN (FORMAT JSON) plan tree."""
+    if node.get('Node Type') == 'Seq Scan':
+        yield node['Relation Name']
+    for child in node.get('Plans', []):
+        yield from plan_seq_scans(child)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-rows', type=int, default=10_000, help='Tables estimated smaller than this may be scanned.')
+    parser.add_argument('--username', default='bench_user_1')
+    parser.add_argument('--admin', help='Admin username (password "bench") to also check /admin_dashboard.')
+    parser.add_argument('--transfer-to', default=None, help='Wallet address for --writes transfers.')
+    parser.add_argument('--writes', action='store_true', help='Also check POST /transfer and POST /timecapsule.')
+    parser.add_argument('--only', action='append', help='Check only these route names.')
+    parser.add_argument('--seed', type=int, default=2025)
+    parser.add_argument('--out', help='Write the findings as JSON here.')
+    args = parser.parse_args()
+
+    explain_conn = psycopg2.connect(**main.DB_CONFIG)
+    explain_conn.autocommit = True
+    explain = explain_conn.cursor()
+    # Fresh statistics, so the planner sees the seeded table sizes
+    explain.execute('ANALYZE')
+    explain.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p') AND relnamespace = 'public'::regnamespace")
+    table_rows = dict(explain.fetchall())
+
+    app = main.app
+    app.config['TESTING'] = True
+    instrument_pool()
+    rng = random.Random(args.seed)
+    with app.app_context():
+        cursor = main.get_db().cursor()
+        total_blocks = max(int(main.get_platform_stats(cursor, 'blocks')['blocks']), 1)
+        if args.writes and not args.transfer_to:
+            cursor.execute("SELECT wallet_address FROM wallets w JOIN users u ON u.id = w.user_id WHERE u.username <> %s LIMIT 1",
+                           (args.username,))
+            args.transfer_to = cursor.fetchone()[0]
+        checked_routes = routes(args, total_blocks, rng) + extra_routes(cursor, args)
+
+    findings = []
+    for name, method, path, form in checked_routes:
+        if args.only and name not in args.only:
+            continue
+        client = app.test_client()
+        login(client, args.admin if name == 'admin_dashboard' else args.username)
+        captured.clear()
+        response = client.open(path(), method=method, data=form() if form else None)
+        response.get_data()
+        statements = list(dict.fromkeys(q for q in captured if q.lstrip().lower().startswith(EXPLAINABLE)))
+        scans = 0
+        for statement in statements:
+            try:
+                explain.execute('EXPLAIN (FORMAT JSON) ' + statement)
+            except psycopg2.Error as e:
+                print(f"{name}: could not EXPLAIN ({e.pgerror or e}): {' '.join(statement.split())[:200]}")
+                continue
+            plan = explain.fetchone()[0][0]['Plan']
+            for relation in plan_seq_scans(plan):
+                if table_rows.get(relation, 0) >= args.min_rows:
+                    scans += 1
+                    findings.append({'route': name, 'table': relation, 'rows': int(table_rows[relation]),
+                                     'statement': ' '.join(statement.split())})
+                    print(f"{name}: Seq Scan on {relation} (~{int(table_rows[relation])} rows): "
+                          f"{' '.join(statement.split())[:300]}")
+        print(f"{name:24} {response.status_code}  {len(statements):3d} statement(s)  {scans} large seq scan(s)")
+
+    explain_conn.close()
+    stub_server.shutdown()
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(findings, f, indent=2)
+    if findings:
+        raise SystemExit(f"{len(findings)} sequential scan(s) on tables with >= {args.min_rows} rows")
+    print("No sequential scans on large tables")
+
+
+if __name__ == '__main__':
+    cli()
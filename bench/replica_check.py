@@ -0,0 +1,95 @@
+"""Check read-replica routing against a primary and a streaming replica.
+
+Two local instances, e.g. (PostgreSQL 12+, run as the postgres user):
+
+    initdb -D /tmp/pg-primary && pg_ctl -D /tmp/pg-primary -o '-p 5432' start
+    # create chainlogger_user / chainlogger_db, then `flask --app main migrate`
+    pg_basebackup -D /tmp/pg-replica -p 5432 -R -X stream
+    pg_ctl -D /tmp/pg-replica -o '-p 5433' start
+
+Usage: DB_REPLICA_DSNS="port=5433" python bench/replica_check.py [--username bench_user_1]
+
+Logs in through the Flask test client and checks that a read-only route is
+served by the replica, that the same user reads from the primary right after a
+POST, and that reads return to the replica once REPLICA_STICKY_SECONDS pass.
+Pausing replay on the replica (SELECT pg_wal_replay_pause()) and waiting past
+REPLICA_MAX_LAG while writing exercises the lag fallback with --expect-primary.
+"""
+import argparse
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+os.environ.setdefault('REPLICA_STICKY_SECONDS', '2')
+
+from run import login, stub_server  # noqa: E402  (starts the stub Binance server)
+
+import main  # noqa: E402
+
+served_by = []
+
+
+def record_targets():
+    request_pool = main.request_pool
+
+    def recording_request_pool():
+        pool = request_pool()
+        served_by.append('primary' if pool is main.db_pool else f'replica {main.replica_router.pools.index(pool)}')
+        return pool
+
+    main.request_pool = recording_request_pool
+
+
+def target_of(client, method, path, data=None):
+    served_by.clear()
+    response = client.open(path, method=method, data=data)
+    response.get_data()
+    return served_by[0] if served_by else None, response.status_code
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--username', default='bench_user_1')
+    parser.add_argument('--path', default='/blockchain', help='Read-only route to request.')
+    parser.add_argument('--expect-primary', action='store_true', help='Expect every read on the primary (lagging replica).')
+    args = parser.parse_args()
+    if not main.replica_router.pools:
+        raise SystemExit("Set DB_REPLICA_DSNS to at least one replica")
+
+    app = main.app
+    app.config['TESTING'] = True
+    record_targets()
+    client = app.test_client()
+    login(client, args.username)
+    time.sleep(main.REPLICA_STICKY_SECONDS)
+
+    failures = 0
+    checks = [
+        ('read before writing', 'GET', args.path, None, 'primary' if args.expect_primary else 'replica'),
+        ('write', 'POST', '/timecapsule', {'message': f'replica check {time.time()}'}, 'primary'),
+        ('read right after the write', 'GET', args.path, None, 'primary'),
+    ]
+    for label, method, path, data, expected in checks:
+        target, status = target_of(client, method, path, data)
+        ok = target is not None and target.startswith(expected)
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {label:32} {method} {path} -> {status} from {target} (expected {expected})")
+
+    time.sleep(main.REPLICA_STICKY_SECONDS)
+    expected = 'primary' if args.expect_primary else 'replica'
+    target, status = target_of(client, 'GET', args.path)
+    ok = target is not None and target.startswith(expected)
+    failures += not ok
+    print(f"{'ok  ' if ok else 'FAIL'} {'read after the sticky window':32} GET {args.path} -> {status} from {target} "
+          f"(expected {expected}; lag {main.replica_router._lag})")
+
+    stub_server.shutdown()
+    if failures:
+        raise SystemExit(f"{failures} routing check(s) failed")
+
+
+if __name__ == '__main__':
+    cli()
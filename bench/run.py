@@ -0,0 +1,221 @@
+"""Drive the hot routes through the Flask test client and write a JSON latency report.
+
+Usage:
+    python bench/seed.py --truncate            # once, against a scratch database
+    python bench/run.py --requests 200 --out report.json [--compare baseline.json] [--writes]
+
+A stub Binance server is started in-process, so no request leaves the box.
+For every route the report records p50/p99/mean latency, SQL statements per
+request (counted on the connection's cursor class) and response statuses,
+plus the process RSS before and after the run.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+from stub_binance import start_stub  # noqa: E402
+
+stub_server, stub_url = start_stub()
+os.environ['BINANCE_API_BASE'] = stub_url
+
+import main  # noqa: E402
+from seed import BENCH_PASSWORD  # noqa: E402
+
+query_counts = threading.local()
+
+
+class CountingCursor(main.InstrumentedCursor):
+    """Instrumented cursor that also counts the statements issued on the current thread."""
+
+    def execute(self, query, vars=None):
+        query_counts.value = getattr(query_counts, 'value', 0) + 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        query_counts.value = getattr(query_counts, 'value', 0) + 1
+        return super().executemany(query, vars_list)
+
+
+def instrument_pool():
+    getconn = main.db_pool.getconn
+
+    def counting_getconn():
+        conn = getconn()
+        conn.cursor_factory = CountingCursor
+        return conn
+
+    main.db_pool.getconn = counting_getconn
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def login(client, username):
+    response = client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+    if response.status_code != 302 or '/blockchain' not in response.headers.get('Location', ''):
+        raise SystemExit(f"Could not log in as {username}; run bench/seed.py first")
+
+
+def routes(args, total_blocks, rng):
+    read_routes = [
+        ('blockchain', 'GET', lambda: '/blockchain', None),
+        ('blockchain_deep_page', 'GET', lambda: f'/blockchain?page={max(1, total_blocks // main.BLOCK_PAGE_SIZE // 2)}', None),
+        ('blockchain_by_owner', 'GET', lambda: '/blockchain?sort_by=owner', None),
+        ('block', 'GET', lambda: f'/block/{rng.randrange(total_blocks)}', None),
+        ('wallet', 'GET', lambda: '/wallet', None),
+        ('transactions', 'GET', lambda: '/transactions', None),
+        ('board', 'GET', lambda: '/board', None),
+        ('transfer', 'GET', lambda: '/transfer', None),
+        ('timecapsule', 'GET', lambda: '/timecapsule', None),
+        ('trade', 'GET', lambda: '/trade', None),
+    ]
+    if args.writes:
+        read_routes += [
+            ('transfer_post', 'POST', lambda: '/transfer',
+             lambda: {'to_address': args.transfer_to, 'amount': '0.01'}),
+            ('timecapsule_post', 'POST', lambda: '/timecapsule',
+             lambda: {'message': f'bench message {rng.random()}'}),
+        ]
+    return read_routes
+
+
+def measure_route(app, args, method, path, form):
+    latencies, queries, statuses = [], [], {}
+    lock = threading.Lock()
+
+    def worker(count):
+        client = app.test_client()
+        login(client, args.username)
+        for _ in range(count):
+            query_counts.value = 0
+            started = time.perf_counter()
+            response = client.open(path(), method=method, data=form() if form else None)
+            response.get_data()
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                queries.append(query_counts.value)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    per_worker = [args.requests // args.concurrency + (i < args.requests % args.concurrency) for i in range(args.concurrency)]
+    worker(args.warmup)
+    latencies.clear()
+    queries.clear()
+    statuses.clear()
+    threads = [threading.Thread(target=worker, args=(count,)) for count in per_worker]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "queries_per_request": round(sum(queries) / len(queries), 2),
+        "max_queries": max(queries),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+def compare(report, baseline):
+    print(f"{'route':24} {'p50 ms':>18} {'p99 ms':>18} {'queries':>14}")
+    for name, result in report["routes"].items():
+        before = baseline.get("routes", {}).get(name)
+        if not before:
+            print(f"{name:24} (new)")
+            continue
+        cells = [f"{before[key]:>7} -> {result[key]:<7}" for key in ('p50_ms', 'p99_ms', 'queries_per_request')]
+        print(f"{name:24} " + " ".join(cells))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='Measured requests per route.')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per route.')
+    parser.add_argument('--concurrency', type=int, default=1, help='Client threads per route.')
+    parser.add_argument('--username', default='bench_user_1')
+    parser.add_argument('--transfer-to', default=None, help='Wallet address for --writes transfers.')
+    parser.add_argument('--writes', action='store_true', help='Also measure POST /transfer and POST /timecapsule.')
+    parser.add_argument('--only', action='append', help='Measure only these route names.')
+    parser.add_argument('--seed', type=int, default=2025)
+    parser.add_argument('--out', default='bench-report.json')
+    parser.add_argument('--compare', help='Earlier report to print deltas against.')
+    args = parser.parse_args()
+
+    app = main.app
+    app.config['TESTING'] = True
+    instrument_pool()
+    rng = random.Random(args.seed)
+    with app.app_context():
+        cursor = main.get_db().cursor()
+        stats = main.get_platform_stats(cursor, 'users', 'blocks', 'transactions', 'posts', 'comments')
+        if args.writes and not args.transfer_to:
+            cursor.execute("SELECT wallet_address FROM wallets w JOIN users u ON u.id = w.user_id WHERE u.username <> %s LIMIT 1",
+                           (args.username,))
+            args.transfer_to = cursor.fetchone()[0]
+    total_blocks = max(int(stats['blocks']), 1)
+
+    rss_before = rss_kb()
+    results = {}
+    for name, method, path, form in routes(args, total_blocks, rng):
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure_route(app, args, method, path, form)
+        print(f"{name:24} p50 {results[name]['p50_ms']:8.2f} ms  p99 {results[name]['p99_ms']:8.2f} ms  "
+              f"queries {results[name]['queries_per_request']:6.2f}  {results[name]['statuses']}")
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "requests_per_route": args.requests,
+            "concurrency": args.concurrency,
+            "dataset": {name: int(value) for name, value in stats.items()},
+        },
+        "routes": results,
+        "rss_kb": {
+            "before": rss_before,
+            "after": rss_kb(),
+            "peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    stub_server.shutdown()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,150 @@
+"""Seed the configured PostgreSQL database with synthetic data through COPY.
+
+Usage: python bench/seed.py --users 1000 --blocks 100000 --transactions 500000 --posts 5000 --comments 20000 --truncate
+
+Every seeded user logs in with password "bench" (usernames bench_user_0 ...).
+The chain is hash-linked from the usual genesis block, wallet balances match
+the ledger and platform_stats is reconciled, so the app sees a consistent
+database. The same --seed always produces the same data.
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main  # noqa: E402
+
+BENCH_PASSWORD = 'bench'
+SEEDED_TABLES = ['comments', 'posts', 'block_ownership_history', 'transactions', 'blocks', 'wallets', 'users',
+                 'chain_checkpoints']
+START = datetime(2024, 1, 1)
+WORDS = ['samurai', 'blade', 'ledger', 'block', 'moon', 'hodl', 'dojo', 'katana', 'wallet', 'hash', 'genesis',
+         'sakura', 'ronin', 'shogun', 'bitcoin', 'puk', 'scroll', 'vault', 'chain', 'honor']
+
+
+class RowStream:
+    """File-like object over generated rows, read by copy_expert without building the whole table in memory."""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                break
+            self._buffer += ('\t'.join('\\N' if value is None else str(value) for value in row) + '\n').encode()
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+def copy_rows(cursor, table, columns, rows):
+    started = time.time()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), RowStream(iter(rows)))
+    print(f"  {table}: {cursor.rowcount} rows in {time.time() - started:.1f}s")
+
+
+def wallet_address(user_id):
+    return hashlib.md5(f'bench-wallet-{user_id}'.encode()).hexdigest()
+
+
+def seed(conn, args):
+    rng = random.Random(args.seed)
+    cursor = conn.cursor()
+    if args.truncate:
+        cursor.execute('TRUNCATE {} RESTART IDENTITY CASCADE'.format(', '.join(SEEDED_TABLES)))
+    cursor.execute('SELECT COUNT(*) FROM users')
+    if cursor.fetchone()[0]:
+        raise SystemExit("Database already has users; pass --truncate to replace them")
+
+    password = hashlib.sha256(BENCH_PASSWORD.encode()).hexdigest()
+    user_ids = range(1, args.users + 1)
+    copy_rows(cursor, 'users', ['id', 'username', 'password', 'puk_balance', 'is_admin'],
+              ((i, f'bench_user_{i - 1}', password, 1000.0, i == 1) for i in user_ids))
+
+    def blocks():
+        previous_hash = main.GENESIS_PREVIOUS_HASH
+        for index in range(args.blocks):
+            message = f'Bench time capsule {index} ' + ' '.join(rng.choice(WORDS) for _ in range(8))
+            if index == 0:
+                message, block_hash = 'Genesis Block - Initializing Blockchain', main.GENESIS_HASH
+            else:
+                block_hash = main.compute_block_hash(previous_hash, index, message)
+            owner = rng.choice(user_ids) if index and rng.random() < args.owned_ratio else None
+            yield index, message, block_hash, previous_hash, START + timedelta(seconds=index), owner
+            previous_hash = block_hash
+
+    copy_rows(cursor, 'blocks', ['"index"', 'message', 'hash', 'previous_hash', 'timestamp', 'owner_id'], blocks())
+
+    balances = dict.fromkeys(user_ids, 0.0)
+
+    def transactions():
+        for tx_id in range(1, args.transactions + 1):
+            to_user = rng.choice(user_ids)
+            from_user = rng.choice(user_ids) if rng.random() < 0.7 else None
+            amount = round(rng.uniform(0.1, 10), 2)
+            if from_user is not None:
+                balances[from_user] -= amount
+            balances[to_user] += amount
+            block_index = rng.randrange(1, args.blocks) if args.blocks > 1 else None
+            yield (tx_id, START + timedelta(seconds=tx_id * args.blocks / max(args.transactions, 1)),
+                   wallet_address(from_user) if from_user is not None else 'system', wallet_address(to_user),
+                   amount, block_index)
+
+    copy_rows(cursor, 'transactions', ['id', 'timestamp', 'from_address', 'to_address', 'amount', 'block_index'],
+              transactions())
+    copy_rows(cursor, 'wallets', ['id', 'wallet_address', 'private_key', 'balance', 'user_id'],
+              ((i, wallet_address(i), hashlib.sha256(f'bench-key-{i}'.encode()).hexdigest(), round(balances[i], 2), i)
+               for i in user_ids))
+    copy_rows(cursor, 'posts', ['id', 'title', 'content', 'user_id', 'timestamp'],
+              ((i, f'Bench post {i} ' + rng.choice(WORDS), ' '.join(rng.choice(WORDS) for _ in range(40)),
+                rng.choice(user_ids), START + timedelta(minutes=i)) for i in range(1, args.posts + 1)))
+    if args.posts:
+        copy_rows(cursor, 'comments', ['id', 'post_id', 'user_id', 'content', 'timestamp'],
+                  ((i, rng.randrange(1, args.posts + 1), rng.choice(user_ids),
+                    ' '.join(rng.choice(WORDS) for _ in range(15)), START + timedelta(minutes=i))
+                   for i in range(1, args.comments + 1)))
+
+    for table in ('users', 'blocks', 'transactions', 'wallets', 'posts', 'comments'):
+        cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST((SELECT MAX(id) FROM {}), 1))".format(table),
+                       (table,))
+    conn.commit()
+    cursor.execute('ANALYZE')
+    conn.commit()
+    main.reconcile_platform_stats(conn)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--blocks', type=int, default=10000)
+    parser.add_argument('--transactions', type=int, default=50000)
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--owned-ratio', type=float, default=0.3, help='Share of blocks with an owner.')
+    parser.add_argument('--seed', type=int, default=2025)
+    parser.add_argument('--truncate', action='store_true', help='Empty the seeded tables first.')
+    args = parser.parse_args()
+    if args.users < 1 or args.blocks < 1:
+        parser.error('--users and --blocks must be at least 1')
+
+    with main.app.app_context():
+        conn = main.get_db()
+        main.run_migrations(conn)
+        started = time.time()
+        print(f"Seeding {main.DB_CONFIG['dbname']}")
+        seed(conn, args)
+        print(f"Done in {time.time() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,80 @@
+"""Local stand-in for the two Binance endpoints the app calls, with deterministic data.
+
+Run standalone (python bench/stub_binance.py --port 8999) and point the app at
+it with BINANCE_API_BASE=http://127.0.0.1:8999, or start it in-process with
+start_stub().
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+INTERVAL_MS = {'1m': 60_000, '5m': 300_000, '15m': 900_000, '30m': 1_800_000, '1h': 3_600_000, '1d': 86_400_000}
+BASE_PRICE = 65000.0
+
+
+def stub_price(at_ms):
+    """Deterministic saw-tooth BTC price for a millisecond timestamp."""
+    return round(BASE_PRICE + (at_ms // 60_000) % 500 - 250, 2)
+
+
+class StubBinanceHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.delay:
+            time.sleep(self.delay)
+        if url.path == '/api/v3/ticker/price':
+            body = {"symbol": query.get('symbol', 'BTCUSDT'), "price": str(stub_price(int(time.time() * 1000)))}
+        elif url.path == '/api/v3/klines':
+            body = self.klines(query)
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def klines(self, query):
+        step = INTERVAL_MS.get(query.get('interval'), 60_000)
+        limit = min(int(query.get('limit', 500)), 1000)
+        now = int(time.time() * 1000) // step * step
+        start = int(query['startTime']) // step * step if 'startTime' in query else now - (limit - 1) * step
+        candles = []
+        for open_time in range(start, min(now, start + (limit - 1) * step) + 1, step):
+            open_price, close_price = stub_price(open_time), stub_price(open_time + step - 1)
+            candles.append([open_time, str(open_price), str(max(open_price, close_price) + 5),
+                            str(min(open_price, close_price) - 5), str(close_price), "12.5",
+                            open_time + step - 1, "0", 100, "0", "0", "0"])
+        return candles
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port=0, delay=0.0):
+    """Serve the stub on a daemon thread; returns (server, base_url)."""
+    handler = type('Handler', (StubBinanceHandler,), {'delay': delay})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, name='stub-binance', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to wait before each response.')
+    args = parser.parse_args()
+    server, base_url = start_stub(args.port, args.delay)
+    print(f"Stub Binance listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+
+# Each worker writes its Prometheus samples here and /metrics aggregates them.
+# Must be set before main.py (and prometheus_client) is imported; cleared on
+# every master start so samples from dead workers of a previous run are dropped.
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'chainlogger-prometheus'))
+shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5111')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+# /stream holds a thread per connected browser for as long as the page is open
+# (but no database connection), so workers need threads rather than sync slots
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '64'))
+# Cap open streams per worker at half the threads so other routes keep being served
+os.environ.setdefault('STREAM_MAX_CLIENTS', str(threads // 2))
+
+# Import main.py once in the master so workers fork with the code, templates
+# and warmed chain cache already in memory (shared copy-on-write)
+preload_app = True
+
+
+def on_starting(server):
+    import main
+
+    with main.app.app_context():
+        # Migrations run at deploy time (flask --app main migrate), never here
+        main.check_schema(main.get_db())
+        count = main.warm_chain_cache()
+        server.log.info("Chain cache warmed, snapshot holds %d block(s)", count)
+    # Connections must not be inherited by the forked workers
+    main.db_pool.closeall()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
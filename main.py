@@ -1,11 +1,39 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, Response, stream_with_context
+from flask import before_render_template, has_request_context, template_rendered
+from markupsafe import Markup, escape
 import psycopg2
+import psycopg2.extensions
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import execute_batch, execute_values
 import hashlib
+import heapq
+import hmac
+import re
 import secrets
-from datetime import datetime
+import base64
+import csv
+import io
+import json
+import collections
+import fcntl
+import itertools
+import math
+import mmap
+import queue
+import select
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from datetime import datetime, timedelta
 from functools import wraps
 import requests
 from bleach import clean
+import click
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 from dotenv import load_dotenv
 import os
 
@@ -24,267 +52,2913 @@ DB_CONFIG = {
     'port': '5432'
 }
 
+# Prometheus metrics. Under gunicorn, PROMETHEUS_MULTIPROC_DIR (set in gunicorn.conf.py)
+# makes every worker write its samples there so /metrics can aggregate them.
+REQUEST_SECONDS = Histogram('chainlogger_request_seconds', 'Request latency by endpoint', ['endpoint', 'method'])
+REQUESTS_TOTAL = Counter('chainlogger_requests_total', 'Requests by endpoint and status', ['endpoint', 'method', 'status'])
+REQUEST_QUERIES = Histogram('chainlogger_request_db_queries', 'SQL statements issued per request', ['endpoint'],
+                            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144))
+DB_QUERY_SECONDS = Histogram('chainlogger_db_query_seconds', 'SQL statement execution time', ['endpoint'])
+DB_POOL_WAIT_SECONDS = Histogram('chainlogger_db_pool_wait_seconds', 'Time spent waiting for a pooled connection')
+DB_ROUTED_TOTAL = Counter('chainlogger_db_routed_total', 'Request connections by target database', ['target'])
+OUTBOUND_HTTP_SECONDS = Histogram('chainlogger_outbound_http_seconds', 'Outbound HTTP call time', ['target'])
+TEMPLATE_RENDER_SECONDS = Histogram('chainlogger_template_render_seconds', 'Template render time', ['template'])
 
-# Binance API URL
-BINANCE_API_URL = "https://api.binance.com/api/v3/ticker/price?symbol=BTCUSDT"
-BINANCE_KLINES_URL = "https://api.binance.com/api/v3/klines"
+# Requests slower than this are printed with every SQL statement they ran
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '500'))
 
-class Blockchain:
-    def __init__(self, wallet_address=None, private_key=None):
-        self.wallet_address = wallet_address
-        self.private_key = private_key
-        self.chain = []
-        self.reward_amount = 10
-        self.create_table()
-        self.load_blocks_from_db()
-        if not self.chain:
-            self.create_genesis_block()
 
-    def create_table(self):
-        conn = psycopg2.connect(**DB_CONFIG)
+def metrics_endpoint_label():
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'background'
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor that times every statement and, inside a request, appends it to g.query_log."""
+
+    def execute(self, query, vars=None):
+        return self._timed(query, super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(query, super().executemany, query, vars_list)
+
+    def _timed(self, query, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.labels(metrics_endpoint_label()).observe(elapsed)
+            if has_request_context() and 'query_log' in g:
+                g.query_log.append((query if isinstance(query, str) else str(query), elapsed))
+
+
+# Connection pool sizing (per gunicorn worker)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+
+
+class ConnectionPool:
+    """Blocking, fork-aware pool of psycopg2 connections.
+
+    Connections are opened lazily in the process that uses them, so every
+    gunicorn worker gets its own, and up to ``maxconn`` stay open between
+    requests (``minconn`` are opened on first use). Callers wait up to
+    ``timeout`` seconds for a free connection instead of failing immediately.
+    ``_lock`` guards the idle list and the stats; connecting and closing
+    happen outside it.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.dsn = dsn
+        self._idle = []
+        self._open = 0
+        self._pid = None
+        self._orphans = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.stats = {
+            'requests_num': 0,
+            'requests_waiting': 0,
+            'requests_errors': 0,
+            'requests_wait_ms': 0.0,
+            'connections_num': 0,
+            'connections_lost': 0,
+            'in_use': 0,
+        }
+
+    def _connect(self):
+        return psycopg2.connect(cursor_factory=InstrumentedCursor, **self.dsn)
+
+    def _ensure_pool(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Inherited across fork: the sockets belong to the parent, so keep
+                # the old connections referenced instead of letting them close.
+                self._orphans.extend(self._idle)
+                self._idle = [self._connect() for _ in range(self.minconn)]
+                self._open = len(self._idle)
+                self._pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.maxconn)
+                self._reset_stats()
+                self.stats['connections_num'] = self._open
+
+    def getconn(self):
+        self._ensure_pool()
+        start = time.monotonic()
+        with self._lock:
+            self.stats['requests_waiting'] += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.monotonic() - start
+        with self._lock:
+            self.stats['requests_waiting'] -= 1
+            if acquired:
+                self.stats['requests_wait_ms'] += waited * 1000
+            else:
+                self.stats['requests_errors'] += 1
+        if not acquired:
+            raise pg_pool.PoolError(f'no connection available after {self.timeout}s')
+        DB_POOL_WAIT_SECONDS.observe(waited)
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            if conn is not None and conn.closed:
+                self.stats['connections_lost'] += 1
+                self._open -= 1
+                conn = None
+            if conn is None:
+                # Reserved now, opened below without holding the lock
+                self._open += 1
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                    self.stats['requests_errors'] += 1
+                self._slots.release()
+                raise
+            with self._lock:
+                self.stats['connections_num'] += 1
+        with self._lock:
+            self.stats['requests_num'] += 1
+            self.stats['in_use'] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        self._ensure_pool()
+        try:
+            status = conn.get_transaction_status() if not conn.closed else None
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status is not None and status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        with self._lock:
+            if conn.closed:
+                self.stats['connections_lost'] += 1
+                close = True
+            if close:
+                self._open -= 1
+            else:
+                self._idle.append(conn)
+            self.stats['in_use'] -= 1
+        if close and not conn.closed:
+            conn.close()
+        self._slots.release()
+
+    def get_stats(self):
+        current = self._pid == os.getpid()
+        with self._lock:
+            stats = dict(self.stats)
+            stats.update({
+                'pid': os.getpid(),
+                'pool_min': self.minconn,
+                'pool_max': self.maxconn,
+                'pool_size': self._open if current else 0,
+                'pool_available': len(self._idle) if current else 0,
+            })
+        return stats
+
+    def closeall(self):
+        with self._lock:
+            idle = self._idle if self._pid == os.getpid() else []
+            if not idle:
+                self._orphans.extend(self._idle)
+            self._idle = []
+            self._open = 0
+            self._pid = None
+        for conn in idle:
+            conn.close()
+
+
+db_pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, **DB_CONFIG)
+
+# Streaming replicas for read-only routes, as comma-separated libpq DSNs or URIs
+# ("host=10.0.0.2 port=5433,host=10.0.0.3"); unset keys fall back to DB_CONFIG.
+# A user is kept on the primary for REPLICA_STICKY_SECONDS after any write, which
+# must exceed REPLICA_MAX_LAG for them to always read their own writes.
+DB_REPLICA_DSNS = [dsn.strip() for dsn in os.getenv('DB_REPLICA_DSNS', '').split(',') if dsn.strip()]
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', '5'))
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', '10'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', '1'))
+REPLICA_CONNECT_TIMEOUT = int(os.getenv('REPLICA_CONNECT_TIMEOUT', '2'))
+# How far behind a replica that pick() accepts can be: its lag limit plus the
+# age of the oldest measurement still trusted
+REPLICA_STALE_SECONDS = REPLICA_MAX_LAG + 3 * REPLICA_LAG_CHECK_INTERVAL
+# Seconds the replica is behind; 0 when it has replayed everything it received
+# (an idle primary sends nothing, so the last replay timestamp alone would look old).
+# NULL, i.e. unusable, unless the WAL receiver is streaming: a disconnected replica
+# has replayed all it received too. Reading the status needs pg_read_all_stats
+# (GRANT pg_read_all_stats TO chainlogger_user); without it reads stay on the primary.
+REPLICA_LAG_QUERY = '''
+    SELECT CASE WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+'''
+
+
+class ReplicaRouter:
+    """Round-robins read-only requests over replica pools that are reachable and within max_lag.
+
+    A daemon thread per worker measures every replica's lag each ``check_interval``
+    seconds on its own connection, so requests never wait on a probe. A replica
+    that is unreachable, or whose last measurement is older than three intervals
+    (the probe is stuck on a dead host), counts as infinitely behind.
+    """
+
+    def __init__(self, dsns, max_lag, check_interval):
+        self.dsns = dsns
+        self.pools = [ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, **dsn) for dsn in dsns]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lag = {}
+        self._turn = itertools.count()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._lag = {}
+                self._thread = threading.Thread(target=self._run, name='replica-lag', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        conns = {}
+        while True:
+            for index in range(len(self.dsns)):
+                self._lag[index] = (time.monotonic(), self._probe(index, conns))
+            time.sleep(self.check_interval)
+
+    def _probe(self, index, conns):
+        conn = conns.get(index)
+        try:
+            if conn is None or conn.closed:
+                conn = conns[index] = psycopg2.connect(**self.dsns[index])
+                conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(REPLICA_LAG_QUERY)
+            lag = cursor.fetchone()[0]
+            return float('inf') if lag is None else float(lag)
+        except psycopg2.Error as e:
+            app.logger.warning("Replica %d lag check failed: %s", index, e)
+            if conns.pop(index, None) is not None and not conn.closed:
+                conn.close()
+            return float('inf')
+
+    def lag(self, index):
+        checked = self._lag.get(index)
+        if checked is None or time.monotonic() - checked[0] > 3 * self.check_interval:
+            return float('inf')
+        return checked[1]
+
+    def mark_unhealthy(self, pool):
+        """Stop routing to ``pool`` until its next lag measurement."""
+        self._lag[self.pools.index(pool)] = (time.monotonic(), float('inf'))
+
+    def pick(self):
+        """A replica pool fit to serve reads, or None to use the primary."""
+        self.ensure_started()
+        start = next(self._turn)
+        for offset in range(len(self.pools)):
+            index = (start + offset) % len(self.pools)
+            if self.lag(index) <= self.max_lag:
+                return self.pools[index]
+        return None
+
+
+replica_router = ReplicaRouter(
+    [{**DB_CONFIG, 'connect_timeout': REPLICA_CONNECT_TIMEOUT, **psycopg2.extensions.parse_dsn(dsn)} for dsn in DB_REPLICA_DSNS],
+    REPLICA_MAX_LAG, REPLICA_LAG_CHECK_INTERVAL)
+
+
+def read_only(view):
+    """Mark a route whose GET requests only read, so they may be served by a replica."""
+    view.read_only = True
+    return view
+
+
+def request_pool():
+    """The pool the current app context borrows from: a replica for reads of read-only routes, else the primary."""
+    if not replica_router.pools or not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return db_pool
+    if not getattr(app.view_functions.get(request.endpoint), 'read_only', False):
+        return db_pool
+    if session.get('primary_until', 0) > time.time():
+        return db_pool
+    return replica_router.pick() or db_pool
+
+
+def get_db():
+    """Return the connection borrowed for the current app context, borrowing one on first use."""
+    if 'db' not in g:
+        pool = request_pool()
+        if pool is db_pool:
+            g.db = pool.getconn()
+        else:
+            try:
+                g.db = pool.getconn()
+            except (psycopg2.Error, pg_pool.PoolError) as e:
+                # Down before the lag probe noticed: serve this read from the primary
+                app.logger.warning("Replica connection failed, using the primary: %s", e)
+                replica_router.mark_unhealthy(pool)
+                pool = db_pool
+                g.db = pool.getconn()
+        g.db_pool = pool
+        if has_request_context():
+            DB_ROUTED_TOTAL.labels('primary' if pool is db_pool else 'replica').inc()
+    return g.db
+
+
+def db_is_replica():
+    return g.get('db_pool', db_pool) is not db_pool
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        g.pop('db_pool', db_pool).putconn(conn, close=isinstance(exc, psycopg2.OperationalError))
+
+
+# Binance API URL (BINANCE_API_BASE can point at a local stub server)
+BINANCE_API_BASE = os.getenv('BINANCE_API_BASE', 'https://api.binance.com').rstrip('/')
+BINANCE_API_URL = f"{BINANCE_API_BASE}/api/v3/ticker/price?symbol=BTCUSDT"
+BINANCE_KLINES_URL = f"{BINANCE_API_BASE}/api/v3/klines"
+BINANCE_TIMEOUT = float(os.getenv('BINANCE_TIMEOUT', '3'))
+
+
+def binance_get(url, target, **kwargs):
+    """GET a Binance endpoint and return the decoded JSON, timing the call under ``target``."""
+    with OUTBOUND_HTTP_SECONDS.labels(target).time():
+        return requests.get(url, timeout=BINANCE_TIMEOUT, **kwargs).json()
+
+# Price feed: background refresh interval and the oldest price still served
+PRICE_REFRESH_INTERVAL = float(os.getenv('PRICE_REFRESH_INTERVAL', '5'))
+PRICE_MAX_STALENESS = float(os.getenv('PRICE_MAX_STALENESS', '120'))
+PRICE_LOCAL_TTL = 1.0
+PRICE_LOCK_ID = 7_031_006
+
+
+class PriceFeed:
+    """BTCUSDT ticker refreshed in the background and shared through the price_cache table.
+
+    Each worker runs a daemon thread that refreshes the row every
+    PRICE_REFRESH_INTERVAL seconds, skipping the outbound call when another
+    worker already did. Requests only read the stored row (memoized in-process
+    for PRICE_LOCAL_TTL) and get None once it is older than PRICE_MAX_STALENESS.
+    """
+
+    def __init__(self, symbol, url, interval, max_staleness):
+        self.symbol = symbol
+        self.url = url
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._memo = None
+
+    def ensure_started(self):
+        if self.interval <= 0 or (self._pid == os.getpid() and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='price-feed', daemon=True)
+                self._pid = os.getpid()
+                self._memo = None
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                app.logger.warning("Price feed refresh failed: %s", e)
+            time.sleep(self.interval)
+
+    def refresh(self, force=False):
+        conn = db_pool.getconn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT EXTRACT(EPOCH FROM now() - fetched_at) FROM price_cache WHERE symbol = %s', (self.symbol,))
+            row = cursor.fetchone()
+            if not force and row and row[0] < self.interval:
+                return
+            cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', (PRICE_LOCK_ID,))
+            if not cursor.fetchone()[0]:
+                return
+            price = float(binance_get(self.url, 'binance_ticker')['price'])
+            cursor.execute('''
+                INSERT INTO price_cache (symbol, price, fetched_at) VALUES (%s, %s, now())
+                ON CONFLICT (symbol) DO UPDATE SET price = EXCLUDED.price, fetched_at = EXCLUDED.fetched_at
+            ''', (self.symbol, price))
+            notify(cursor, BTC_PRICE_CHANNEL, str(price))
+            conn.commit()
+        finally:
+            db_pool.putconn(conn)
+
+    def get_price(self):
+        """Latest stored price, or None when it is missing or older than max_staleness."""
+        self.ensure_started()
+        memo = self._memo
+        now = time.monotonic()
+        if memo is None or now - memo[0] > PRICE_LOCAL_TTL:
+            cursor = get_db().cursor()
+            cursor.execute('SELECT price, EXTRACT(EPOCH FROM now() - fetched_at) FROM price_cache WHERE symbol = %s', (self.symbol,))
+            row = cursor.fetchone()
+            memo = (now, row[0] if row else None, float(row[1]) if row else None)
+            self._memo = memo
+        read_at, price, age = memo
+        if price is None or age + (now - read_at) > self.max_staleness:
+            return None
+        return price
+
+
+price_feed = PriceFeed('BTCUSDT', BINANCE_API_URL, PRICE_REFRESH_INTERVAL, PRICE_MAX_STALENESS)
+
+# Candle store: intervals fetched from upstream, and coarser ones rolled up from them
+# as (base interval, bucket ms, bucket offset ms); Binance weeks start on Monday.
+KLINES_LIMIT = 100
+KLINES_BACKFILL = 1000
+KLINES_REFRESH_INTERVAL = float(os.getenv('KLINES_REFRESH_INTERVAL', '10'))
+KLINES_LOCK_ID = 7_031_007
+KLINE_INTERVAL_MS = {'1m': 60_000, '5m': 300_000, '30m': 1_800_000, '1h': 3_600_000, '1d': 86_400_000}
+KLINE_ROLLUPS = {
+    '4h': ('1h', 4 * 3_600_000, 0),
+    '8h': ('1h', 8 * 3_600_000, 0),
+    '1w': ('1d', 7 * 86_400_000, 4 * 86_400_000),
+}
+
+
+class KlineStore:
+    """Candles persisted in the klines table and topped up incrementally from upstream.
+
+    A sync fetches only candles from the newest stored open_time onwards (that
+    candle may still have been open), at most once per KLINES_REFRESH_INTERVAL
+    per interval across all workers. Intervals in KLINE_ROLLUPS are derived from
+    their stored base interval instead of being fetched.
+    """
+
+    def __init__(self, symbol, url):
+        self.symbol = symbol
+        self.url = url
+
+    def sync(self, interval):
+        conn = get_db()
         cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                puk_balance REAL DEFAULT 0.0,
-                is_admin BOOLEAN DEFAULT FALSE
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS blocks (
-                id SERIAL PRIMARY KEY,
-                "index" INTEGER UNIQUE NOT NULL,
-                message TEXT NOT NULL,
-                hash TEXT NOT NULL,
-                previous_hash TEXT NOT NULL DEFAULT '0',
-                timestamp TIMESTAMP NOT NULL,
-                owner_id INTEGER REFERENCES users(id)
-            )
-        ''')
+        cursor.execute('SELECT EXTRACT(EPOCH FROM now() - synced_at) FROM klines_sync WHERE symbol = %s AND interval = %s',
+                       (self.symbol, interval))
+        row = cursor.fetchone()
+        if row and row[0] < KLINES_REFRESH_INTERVAL:
+            return
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s, hashtext(%s))', (KLINES_LOCK_ID, interval))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return
+        cursor.execute('SELECT MAX(open_time) FROM klines WHERE symbol = %s AND interval = %s', (self.symbol, interval))
+        last_open_time = cursor.fetchone()[0]
+        params = {'symbol': self.symbol, 'interval': interval, 'limit': KLINES_BACKFILL}
+        if last_open_time is not None and time.time() * 1000 - last_open_time < KLINES_BACKFILL * KLINE_INTERVAL_MS[interval]:
+            params['startTime'] = last_open_time
+        try:
+            candles = binance_get(self.url, 'binance_klines', params=params)
+        except (requests.RequestException, ValueError) as e:
+            conn.rollback()
+            app.logger.warning("Klines sync for %s %s failed: %s", self.symbol, interval, e)
+            return
+        execute_values(cursor, '''
+            INSERT INTO klines (symbol, interval, open_time, open, high, low, close, volume, close_time) VALUES %s
+            ON CONFLICT (symbol, interval, open_time) DO UPDATE SET
+                high = EXCLUDED.high, low = EXCLUDED.low, close = EXCLUDED.close,
+                volume = EXCLUDED.volume, close_time = EXCLUDED.close_time
+        ''', [(self.symbol, interval, int(c[0]), float(c[1]), float(c[2]), float(c[3]), float(c[4]), float(c[5]), int(c[6]))
+              for c in candles])
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                from_address TEXT NOT NULL,
-                to_address TEXT NOT NULL,
-                amount REAL NOT NULL,
-                block_index INTEGER
-            )
-        ''')
+            INSERT INTO klines_sync (symbol, interval, synced_at) VALUES (%s, %s, now())
+            ON CONFLICT (symbol, interval) DO UPDATE SET synced_at = EXCLUDED.synced_at
+        ''', (self.symbol, interval))
+        conn.commit()
+
+    def candles(self, timeframe, limit=KLINES_LIMIT):
+        """The latest ``limit`` candles, oldest first, as [open_time, open, high, low, close, volume, close_time]."""
+        cursor = get_db().cursor()
+        if timeframe in KLINE_ROLLUPS:
+            base, bucket, offset = KLINE_ROLLUPS[timeframe]
+            self.sync(base)
+            cursor.execute('''
+                SELECT (open_time - %(offset)s) / %(bucket)s * %(bucket)s + %(offset)s AS bucket_open,
+                       (array_agg(open ORDER BY open_time))[1], MAX(high), MIN(low),
+                       (array_agg(close ORDER BY open_time DESC))[1], SUM(volume), MAX(close_time)
+                FROM klines
+                WHERE symbol = %(symbol)s AND interval = %(base)s
+                  AND open_time >= (SELECT MAX(open_time) FROM klines WHERE symbol = %(symbol)s AND interval = %(base)s)
+                                   - %(bucket)s * %(limit)s
+                GROUP BY bucket_open
+                ORDER BY bucket_open DESC
+                LIMIT %(limit)s
+            ''', {'symbol': self.symbol, 'base': base, 'bucket': bucket, 'offset': offset, 'limit': limit})
+        else:
+            self.sync(timeframe)
+            cursor.execute('''
+                SELECT open_time, open, high, low, close, volume, close_time FROM klines
+                WHERE symbol = %s AND interval = %s
+                ORDER BY open_time DESC
+                LIMIT %s
+            ''', (self.symbol, timeframe, limit))
+        return [list(row) for row in reversed(cursor.fetchall())]
+
+
+kline_store = KlineStore('BTCUSDT', BINANCE_KLINES_URL)
+
+CHAIN_SNAPSHOT_FILE = os.getenv('CHAIN_SNAPSHOT_FILE', os.path.join(tempfile.gettempdir(), 'chainlogger-chain.snapshot'))
+
+
+class CompactChain:
+    """Columnar store for blocks ``base`` and up, indexed by block index.
+
+    Hashes are kept as 32 raw bytes (values that are not 64 hex digits, like
+    the genesis "Genesis", go to a small side dict), timestamps as int64
+    microseconds since the epoch, owners as int64 (-1 for none) and
+    transactions in packed side columns addressed by a per-block offset and
+    count, with wallet addresses interned. Dicts are only built on get().
+    """
+
+    HASH_SIZE = 32
+    NO_OWNER = -1
+    EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, base=0):
+        self.base = base
+        self._present = bytearray()
+        self._hashes = bytearray()
+        self._previous_hashes = bytearray()
+        self._odd_hashes = {}
+        self._timestamps = array('q')
+        self._owner_ids = array('q')
+        self._messages = []
+        self._tx_offsets = array('q')
+        self._tx_counts = array('I')
+        self._tx_from = array('I')
+        self._tx_to = array('I')
+        self._tx_amounts = array('d')
+        self._addresses = []
+        self._address_ids = {}
+
+    def __len__(self):
+        return len(self._present)
+
+    def _grow(self, position):
+        missing = position + 1 - len(self._present)
+        if missing <= 0:
+            return
+        self._present.extend(bytes(missing))
+        self._hashes.extend(bytes(missing * self.HASH_SIZE))
+        self._previous_hashes.extend(bytes(missing * self.HASH_SIZE))
+        self._timestamps.extend([0] * missing)
+        self._owner_ids.extend([self.NO_OWNER] * missing)
+        self._messages.extend([None] * missing)
+        self._tx_offsets.extend([0] * missing)
+        self._tx_counts.extend([0] * missing)
+
+    def _set_hash(self, column, name, position, value):
+        start = position * self.HASH_SIZE
+        try:
+            packed = bytes.fromhex(value) if len(value) == self.HASH_SIZE * 2 else None
+        except ValueError:
+            packed = None
+        if packed is None:
+            self._odd_hashes[(name, position)] = value
+            packed = bytes(self.HASH_SIZE)
+        else:
+            self._odd_hashes.pop((name, position), None)
+        column[start:start + self.HASH_SIZE] = packed
+
+    def _get_hash(self, column, name, position):
+        odd = self._odd_hashes.get((name, position))
+        if odd is not None:
+            return odd
+        start = position * self.HASH_SIZE
+        return column[start:start + self.HASH_SIZE].hex()
+
+    def _address_id(self, address):
+        address_id = self._address_ids.get(address)
+        if address_id is None:
+            address_id = self._address_ids[address] = len(self._addresses)
+            self._addresses.append(address)
+        return address_id
+
+    def put(self, index, message, block_hash, previous_hash, timestamp, owner_id, transactions):
+        """Store a block; transactions is a sequence of (from_address, to_address, amount)."""
+        position = index - self.base
+        self._grow(position)
+        self._set_hash(self._hashes, 'hash', position, block_hash)
+        self._set_hash(self._previous_hashes, 'previous_hash', position, previous_hash)
+        self._timestamps[position] = (timestamp - self.EPOCH) // timedelta(microseconds=1)
+        self._owner_ids[position] = self.NO_OWNER if owner_id is None else owner_id
+        self._messages[position] = message
+        if not (self._present[position] and self._tx_counts[position] == len(transactions)):
+            # Re-use the block's run in place when the count is unchanged, else append a new run
+            self._tx_offsets[position] = len(self._tx_amounts)
+            self._tx_from.extend([0] * len(transactions))
+            self._tx_to.extend([0] * len(transactions))
+            self._tx_amounts.extend([0.0] * len(transactions))
+        offset = self._tx_offsets[position]
+        for i, (from_address, to_address, amount) in enumerate(transactions):
+            self._tx_from[offset + i] = self._address_id(from_address)
+            self._tx_to[offset + i] = self._address_id(to_address)
+            self._tx_amounts[offset + i] = amount
+        self._tx_counts[position] = len(transactions)
+        self._present[position] = 1
+
+    def complete(self, count):
+        """Whether every block from base up to ``count`` - 1 is stored."""
+        return self.base + len(self._present) == count and 0 not in self._present
+
+    def get(self, index):
+        position = index - self.base
+        if not 0 <= position < len(self._present) or not self._present[position]:
+            return None
+        owner_id = self._owner_ids[position]
+        offset, count = self._tx_offsets[position], self._tx_counts[position]
+        return {
+            "index": index,
+            "message": self._messages[position],
+            "hash": self._get_hash(self._hashes, 'hash', position),
+            "previous_hash": self._get_hash(self._previous_hashes, 'previous_hash', position),
+            "timestamp": self.EPOCH + timedelta(microseconds=self._timestamps[position]),
+            "owner_id": None if owner_id == self.NO_OWNER else owner_id,
+            "transactions": [
+                {"from_address": self._addresses[self._tx_from[i]], "to_address": self._addresses[self._tx_to[i]],
+                 "amount": self._tx_amounts[i]}
+                for i in range(offset, offset + count)
+            ]
+        }
+
+
+class ChainSnapshot:
+    """Read-only, memory-mapped chain image written by ChainCache.save_snapshot.
+
+    Layout: header (magic, last_index, max_version, count, capacity), an offset
+    table with room for capacity + 1 entries, then one JSON record per block in
+    index order. Opening maps the file without reading the records, so it costs
+    the same at any chain length; blocks are decoded one at a time on access and
+    the pages are shared by every worker through the page cache.
+
+    Records are streamed to the file one block at a time. Newer blocks are
+    appended after the last record with their offsets written into the table's
+    spare room (a sparse hole until then), so bytes already written never change
+    under a reader; the header is updated last. A full table means a rewrite
+    with twice the room.
+    """
+
+    MAGIC = b'CLCHAIN2'
+    HEADER = struct.Struct('<8sqqQQ')
+    MIN_CAPACITY = 1 << 16
+    OFFSET_BATCH = 4096
+
+    def __init__(self, mapped, last_index, max_version, count, capacity, inode):
+        self._mmap = mapped
+        self.last_index = last_index
+        self.max_version = max_version
+        self.count = count
+        self.capacity = capacity
+        self.inode = inode
+        self._offsets = memoryview(mapped)[self.HEADER.size:self.HEADER.size + (count + 1) * 8].cast('Q')
+        self._data_start = self.HEADER.size + (capacity + 1) * 8
+
+    @classmethod
+    def open(cls, path):
+        """Map a snapshot file, or return None when it is missing or unreadable."""
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                inode = os.fstat(f.fileno()).st_ino
+        except (OSError, ValueError):
+            return None
+        if len(mapped) < cls.HEADER.size:
+            return None
+        magic, last_index, max_version, count, capacity = cls.HEADER.unpack_from(mapped)
+        if magic != cls.MAGIC or count != last_index + 1 or count > capacity:
+            return None
+        snapshot = cls(mapped, last_index, max_version, count, capacity, inode)
+        if len(mapped) < snapshot._data_start + snapshot._offsets[count]:
+            return None
+        return snapshot
+
+    def block(self, index):
+        start = self._data_start + self._offsets[index]
+        end = self._data_start + self._offsets[index + 1]
+        record = json.loads(self._mmap[start:end])
+        return {
+            "index": record[0],
+            "message": record[1],
+            "hash": record[2],
+            "previous_hash": record[3],
+            "timestamp": datetime.fromisoformat(record[4]),
+            "owner_id": record[5],
+            "transactions": [{"from_address": tx[0], "to_address": tx[1], "amount": tx[2]} for tx in record[6]]
+        }
+
+    @staticmethod
+    def record(block):
+        return json.dumps([
+            block["index"], block["message"], block["hash"], block["previous_hash"],
+            block["timestamp"].isoformat(), block["owner_id"],
+            [[tx["from_address"], tx["to_address"], tx["amount"]] for tx in block["transactions"]]
+        ]).encode()
+
+    @classmethod
+    def _write_records(cls, f, capacity, count, offset, blocks):
+        """Write records after data offset ``offset`` and their end offsets after table entry ``count``.
+
+        Returns the new count. Only one batch of offsets is held in memory.
+        """
+        f.seek(cls.HEADER.size + (capacity + 1) * 8 + offset)
+        pending = array('Q')
+        for block in blocks:
+            record = cls.record(block)
+            f.write(record)
+            offset += len(record)
+            pending.append(offset)
+            count += 1
+            if len(pending) == cls.OFFSET_BATCH:
+                os.pwrite(f.fileno(), pending.tobytes(), cls.HEADER.size + (count - len(pending) + 1) * 8)
+                pending = array('Q')
+        if pending:
+            os.pwrite(f.fileno(), pending.tobytes(), cls.HEADER.size + (count - len(pending) + 1) * 8)
+        f.flush()
+        return count
+
+    @classmethod
+    def write(cls, path, blocks, count, max_version):
+        """Atomically replace the snapshot at path with ``count`` blocks (an iterable running from index 0)."""
+        capacity = max(cls.MIN_CAPACITY, count * 2)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.chain-snapshot-')
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                f.truncate(cls.HEADER.size + (capacity + 1) * 8)
+                written = cls._write_records(f, capacity, 0, 0, blocks)
+                f.seek(0)
+                f.write(cls.HEADER.pack(cls.MAGIC, written - 1, max_version, written, capacity))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return written
+
+    def append(self, path, blocks, count, max_version):
+        """Append blocks ``self.count`` to ``count`` - 1 to the file this snapshot was opened from.
+
+        Returns the new count, or None when the file was replaced or changed
+        since it was opened, or has no room left, and must be rewritten instead.
+        """
+        if count > self.capacity:
+            return None
+        try:
+            f = open(path, 'r+b')
+        except OSError:
+            return None
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            header = (self.MAGIC, self.last_index, self.max_version, self.count, self.capacity)
+            if os.fstat(f.fileno()).st_ino != self.inode or self.HEADER.unpack(f.read(self.HEADER.size)) != header:
+                return None
+            written = self._write_records(f, self.capacity, self.count, self._offsets[self.count], blocks)
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, written - 1, max_version, written, self.capacity))
+        return written
+
+
+class ChainCache:
+    """Process-wide copy of the chain kept current with incremental reads.
+
+    Every block row carries a ``version`` drawn from ``blocks_version_seq`` on
+    insert and on edit, so a sync only fetches blocks appended after the last
+    cached index or changed since the highest version seen, together with their
+    transactions, in a single grouped query.
+
+    On its first sync the cache adopts the on-disk snapshot (if its tip still
+    matches the database) and only tops up from there. Blocks read from the
+    database go into a CompactChain starting after the snapshot; edits to
+    blocks the snapshot covers are kept as plain dicts that shadow it.
+    """
+
+    SYNC_QUERY = '''
+        SELECT b."index", b.message, b.hash, b.previous_hash, b.timestamp, b.owner_id, b.version,
+               COALESCE(json_agg(json_build_array(t.from_address, t.to_address, t.amount) ORDER BY t.id)
+                        FILTER (WHERE t.id IS NOT NULL), '[]')
+        FROM blocks b
+        LEFT JOIN transactions t ON t.block_index = b."index"
+        WHERE b."index" > %s OR b.version > %s
+        GROUP BY b.id
+        ORDER BY b."index"
+    '''
+
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self.snapshot = None
+        self._snapshot_checked = False
+        self._store = CompactChain()
+        self._overrides = {}
+        self.last_index = -1
+        self.max_version = 0
+        self._lock = threading.Lock()
+
+    def sync(self, conn):
+        with self._lock:
+            cursor = conn.cursor()
+            if not self._snapshot_checked:
+                self._snapshot_checked = True
+                self._adopt_snapshot(cursor)
+            cursor.execute(self.SYNC_QUERY, (self.last_index, self.max_version))
+            for row in cursor.fetchall():
+                self._apply(row)
+        return self
+
+    def _adopt_snapshot(self, cursor):
+        snapshot = ChainSnapshot.open(self.snapshot_path) if self.snapshot_path else None
+        if snapshot is None or snapshot.last_index <= self.last_index:
+            return
+        cursor.execute('SELECT hash FROM blocks WHERE "index" = %s', (snapshot.last_index,))
+        row = cursor.fetchone()
+        if not row or row[0] != snapshot.block(snapshot.last_index)["hash"]:
+            print(f"Ignoring chain snapshot {self.snapshot_path}: tip does not match the database")
+            return
+        self.snapshot = snapshot
+        self._store = CompactChain(snapshot.count)
+        self.last_index = snapshot.last_index
+        self.max_version = max(self.max_version, snapshot.max_version)
+
+    def _apply(self, row):
+        index = row[0]
+        if index < self._store.base:
+            self._overrides[index] = {
+                "index": index,
+                "message": row[1],
+                "hash": row[2],
+                "previous_hash": row[3],
+                "timestamp": row[4],
+                "owner_id": row[5],
+                "transactions": [{"from_address": tx[0], "to_address": tx[1], "amount": tx[2]} for tx in row[7]]
+            }
+        else:
+            self._store.put(index, row[1], row[2], row[3], row[4], row[5], row[7])
+        self.last_index = max(self.last_index, index)
+        self.max_version = max(self.max_version, row[6])
+
+    def get(self, index):
+        block = self._overrides.get(index) or self._store.get(index)
+        if block is None and self.snapshot is not None and 0 <= index < self.snapshot.count:
+            block = self.snapshot.block(index)
+        return block
+
+    @property
+    def blocks(self):
+        return [self.get(index) for index in range(self.last_index + 1)]
+
+    def reset(self):
+        """Forget everything cached so the next sync starts again from the snapshot file."""
+        with self._lock:
+            self.snapshot = None
+            self._snapshot_checked = False
+            self._store = CompactChain()
+            self._overrides = {}
+            self.last_index = -1
+            self.max_version = 0
+
+    def save_snapshot(self, path=None):
+        """Write the cached chain to disk for other workers to map; returns the block count.
+
+        Blocks are written one at a time. When ``path`` is the snapshot this
+        cache adopted and none of its blocks were edited since, only the blocks
+        after its tip are appended; otherwise the file is rewritten.
+        """
+        path = path or self.snapshot_path
+        with self._lock:
+            count = self.last_index + 1
+            if not count or not self._store.complete(count):
+                return 0
+            snapshot = self.snapshot
+            if snapshot is not None and not self._overrides and path == self.snapshot_path:
+                written = snapshot.append(path, (self.get(index) for index in range(snapshot.count, count)),
+                                          count, self.max_version)
+                if written is not None:
+                    return written
+            return ChainSnapshot.write(path, (self.get(index) for index in range(count)), count, self.max_version)
+
+    def __len__(self):
+        return self.last_index + 1
+
+
+chain_cache = ChainCache(CHAIN_SNAPSHOT_FILE)
+
+
+# Ledger balance per address, recomputed from scratch (used by migrations and reconciliation)
+LEDGER_BALANCES_QUERY = '''
+    SELECT address, SUM(amount) AS balance
+    FROM (
+        SELECT to_address AS address, amount FROM transactions
+        UNION ALL
+        SELECT from_address AS address, -amount FROM transactions
+    ) entries
+    GROUP BY address
+'''
+
+# Schema migrations, applied in order by `flask --app main migrate` at deploy time.
+# Each entry is (version, description, statements); never edit a released entry,
+# append a new one instead.
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            puk_balance REAL DEFAULT 0.0,
+            is_admin BOOLEAN DEFAULT FALSE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS blocks (
+            id SERIAL PRIMARY KEY,
+            "index" INTEGER UNIQUE NOT NULL,
+            message TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            previous_hash TEXT NOT NULL DEFAULT '0',
+            timestamp TIMESTAMP NOT NULL,
+            owner_id INTEGER REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL PRIMARY KEY,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            from_address TEXT NOT NULL,
+            to_address TEXT NOT NULL,
+            amount REAL NOT NULL,
+            block_index INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS wallets (
+            id SERIAL PRIMARY KEY,
+            wallet_address TEXT UNIQUE NOT NULL,
+            private_key TEXT NOT NULL,
+            balance REAL DEFAULT 0.0,
+            user_id INTEGER REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS block_ownership_history (
+            id SERIAL PRIMARY KEY,
+            block_index INTEGER NOT NULL REFERENCES blocks("index"),
+            previous_owner_id INTEGER REFERENCES users(id),
+            new_owner_id INTEGER REFERENCES users(id),
+            timestamp TIMESTAMP NOT NULL,
+            price REAL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS posts (
+            id SERIAL PRIMARY KEY,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            user_id INTEGER REFERENCES users(id),
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS comments (
+            id SERIAL PRIMARY KEY,
+            post_id INTEGER REFERENCES posts(id),
+            user_id INTEGER REFERENCES users(id),
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "ALTER TABLE blocks ADD COLUMN IF NOT EXISTS previous_hash TEXT NOT NULL DEFAULT '0'",
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN DEFAULT FALSE',
+    ]),
+    (2, 'block versions for incremental chain sync', [
+        'CREATE SEQUENCE IF NOT EXISTS blocks_version_seq',
+        "ALTER TABLE blocks ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('blocks_version_seq')",
+        'CREATE INDEX IF NOT EXISTS blocks_version_idx ON blocks (version)',
+        'CREATE INDEX IF NOT EXISTS transactions_block_index_idx ON transactions (block_index)',
+    ]),
+    (3, 'materialized wallet balances', [
+        'UPDATE wallets SET balance = 0',
+        '''
+        UPDATE wallets w SET balance = l.balance
+        FROM ({}) l
+        WHERE l.address = w.wallet_address
+        '''.format(LEDGER_BALANCES_QUERY),
+    ]),
+    (4, 'keyset indexes for transaction history', [
+        "UPDATE transactions SET timestamp = '1970-01-01' WHERE timestamp IS NULL",
+        'ALTER TABLE transactions ALTER COLUMN timestamp SET NOT NULL',
+        'CREATE INDEX IF NOT EXISTS transactions_timestamp_id_idx ON transactions (timestamp DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS transactions_from_timestamp_id_idx ON transactions (from_address, timestamp DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS transactions_to_timestamp_id_idx ON transactions (to_address, timestamp DESC, id DESC)',
+    ]),
+    (5, 'shared price feed cache', [
+        '''
+        CREATE TABLE IF NOT EXISTS price_cache (
+            symbol TEXT PRIMARY KEY,
+            price DOUBLE PRECISION NOT NULL,
+            fetched_at TIMESTAMPTZ NOT NULL
+        )
+        ''',
+    ]),
+    (6, 'persistent candle store', [
+        '''
+        CREATE TABLE IF NOT EXISTS klines (
+            symbol TEXT NOT NULL,
+            interval TEXT NOT NULL,
+            open_time BIGINT NOT NULL,
+            open DOUBLE PRECISION NOT NULL,
+            high DOUBLE PRECISION NOT NULL,
+            low DOUBLE PRECISION NOT NULL,
+            close DOUBLE PRECISION NOT NULL,
+            volume DOUBLE PRECISION NOT NULL,
+            close_time BIGINT NOT NULL,
+            PRIMARY KEY (symbol, interval, open_time)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS klines_sync (
+            symbol TEXT NOT NULL,
+            interval TEXT NOT NULL,
+            synced_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (symbol, interval)
+        )
+        ''',
+    ]),
+    (7, 'signed chain verification checkpoints', [
+        '''
+        CREATE TABLE IF NOT EXISTS chain_checkpoints (
+            id SERIAL PRIMARY KEY,
+            last_index INTEGER NOT NULL,
+            last_hash TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            max_version BIGINT NOT NULL,
+            signature TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS chain_checkpoints_last_index_idx ON chain_checkpoints (last_index DESC)',
+    ]),
+    (8, 'mempool index for pending transactions', [
+        'CREATE INDEX IF NOT EXISTS transactions_pending_idx ON transactions (id) WHERE block_index IS NULL',
+    ]),
+    (9, 'cached counters and keyset listing indexes', [
+        '''
+        CREATE TABLE IF NOT EXISTS platform_stats (
+            name TEXT PRIMARY KEY,
+            value DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+        ''',
+        "INSERT INTO platform_stats (name, value) SELECT 'blocks', COUNT(*) FROM blocks ON CONFLICT (name) DO NOTHING",
+        "INSERT INTO platform_stats (name, value) SELECT 'posts', COUNT(*) FROM posts ON CONFLICT (name) DO NOTHING",
+        'CREATE INDEX IF NOT EXISTS blocks_owner_index_idx ON blocks (owner_id, "index")',
+        'UPDATE posts SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL',
+        'ALTER TABLE posts ALTER COLUMN timestamp SET NOT NULL',
+        'CREATE INDEX IF NOT EXISTS posts_timestamp_id_idx ON posts (timestamp DESC, id DESC)',
+    ]),
+    (10, 'sharded platform counters and moderation indexes', [
+        'ALTER TABLE platform_stats ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0',
+        'ALTER TABLE platform_stats DROP CONSTRAINT IF EXISTS platform_stats_pkey',
+        'ALTER TABLE platform_stats ADD PRIMARY KEY (name, shard)',
+        "INSERT INTO platform_stats (name, value) SELECT 'users', COUNT(*) FROM users ON CONFLICT DO NOTHING",
+        "INSERT INTO platform_stats (name, value) SELECT 'transactions', COUNT(*) FROM transactions ON CONFLICT DO NOTHING",
+        "INSERT INTO platform_stats (name, value) SELECT 'comments', COUNT(*) FROM comments ON CONFLICT DO NOTHING",
+        "INSERT INTO platform_stats (name, value) SELECT 'minted', COALESCE(SUM(amount), 0) FROM transactions WHERE from_address = 'system' ON CONFLICT DO NOTHING",
+        'UPDATE comments SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL',
+        'ALTER TABLE comments ALTER COLUMN timestamp SET NOT NULL',
+        'CREATE INDEX IF NOT EXISTS comments_timestamp_id_idx ON comments (timestamp DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS comments_user_timestamp_id_idx ON comments (user_id, timestamp DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS posts_user_timestamp_id_idx ON posts (user_id, timestamp DESC, id DESC)',
+    ]),
+    (11, 'full-text search columns', [
+        '''
+        ALTER TABLE blocks ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple', message)) STORED
+        ''',
+        '''
+        ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (setweight(to_tsvector('simple', title), 'A') ||
+                                 setweight(to_tsvector('simple', content), 'B')) STORED
+        ''',
+        '''
+        ALTER TABLE comments ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED
+        ''',
+        'CREATE INDEX IF NOT EXISTS blocks_search_idx ON blocks USING GIN (search_vector)',
+        'CREATE INDEX IF NOT EXISTS posts_search_idx ON posts USING GIN (search_vector)',
+        'CREATE INDEX IF NOT EXISTS comments_search_idx ON comments USING GIN (search_vector)',
+    ]),
+    (12, 'PUK order book', [
+        '''
+        CREATE TABLE IF NOT EXISTS orders (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            side TEXT NOT NULL CHECK (side IN ('buy', 'sell')),
+            kind TEXT NOT NULL CHECK (kind IN ('limit', 'market')),
+            price DOUBLE PRECISION,
+            reserve_price DOUBLE PRECISION NOT NULL,
+            quantity DOUBLE PRECISION NOT NULL CHECK (quantity > 0),
+            remaining DOUBLE PRECISION NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open' CHECK (status IN ('open', 'partial', 'filled', 'cancelled')),
+            cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS orders_live_idx ON orders (id) WHERE status IN ('open', 'partial')",
+        "CREATE INDEX IF NOT EXISTS orders_user_live_idx ON orders (user_id, id DESC) WHERE status IN ('open', 'partial')",
+        "CREATE INDEX IF NOT EXISTS orders_book_idx ON orders (side, price) WHERE status IN ('open', 'partial') AND kind = 'limit'",
+        '''
+        CREATE TABLE IF NOT EXISTS trades (
+            id BIGSERIAL PRIMARY KEY,
+            buy_order_id BIGINT NOT NULL REFERENCES orders(id),
+            sell_order_id BIGINT NOT NULL REFERENCES orders(id),
+            buyer_id INTEGER NOT NULL REFERENCES users(id),
+            seller_id INTEGER NOT NULL REFERENCES users(id),
+            price DOUBLE PRECISION NOT NULL,
+            quantity DOUBLE PRECISION NOT NULL,
+            executed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (13, 'PUK candles rolled up from trades', [
+        # One-off backfill of the trades executed before the matcher kept candles itself
+        '''
+        INSERT INTO klines (symbol, interval, open_time, open, high, low, close, volume, close_time)
+        SELECT 'PUKCOIN', i.interval, b.open_time,
+               (array_agg(t.price ORDER BY t.id))[1], MAX(t.price), MIN(t.price),
+               (array_agg(t.price ORDER BY t.id DESC))[1], SUM(t.quantity), b.open_time + i.ms - 1
+        FROM trades t
+        CROSS JOIN (VALUES ('1m', 60000), ('5m', 300000), ('1h', 3600000), ('4h', 14400000), ('1d', 86400000))
+            AS i(interval, ms)
+        CROSS JOIN LATERAL (
+            SELECT (EXTRACT(EPOCH FROM t.executed_at::timestamptz) * 1000)::bigint / i.ms * i.ms AS open_time
+        ) b
+        GROUP BY i.interval, i.ms, b.open_time
+        ON CONFLICT (symbol, interval, open_time) DO NOTHING
+        ''',
+    ]),
+    # Foreign keys that routes look up by; bench/plan_check.py fails on sequential scans of large tables
+    (14, 'foreign-key lookup indexes', [
+        'CREATE INDEX IF NOT EXISTS wallets_user_id_idx ON wallets (user_id, id)',
+        'CREATE INDEX IF NOT EXISTS comments_post_timestamp_idx ON comments (post_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS block_ownership_history_block_index_idx ON block_ownership_history (block_index)',
+    ]),
+    # Orders commit out of id order, so the matcher claims them by flag instead of by a high-water id
+    (15, 'matcher claims orders by flag', [
+        'ALTER TABLE orders ADD COLUMN IF NOT EXISTS booked BOOLEAN NOT NULL DEFAULT FALSE',
+        "CREATE INDEX IF NOT EXISTS orders_unbooked_idx ON orders (id) WHERE NOT booked AND status IN ('open', 'partial')",
+    ]),
+]
+
+# Arbitrary key for pg_advisory_xact_lock so concurrent deploys migrate one at a time
+MIGRATION_LOCK_ID = 7_031_001
+
+
+def run_migrations(conn):
+    """Apply every migration newer than schema_version in one transaction; return the applied list."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    current_version = cursor.fetchone()[0]
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute('INSERT INTO schema_version (version, description) VALUES (%s, %s)', (version, description))
+        applied.append((version, description))
+    conn.commit()
+    return applied
+
+
+def check_schema(conn):
+    """Fail unless every migration is applied; servers never migrate, `flask --app main migrate` does."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    current_version = 0
+    if cursor.fetchone()[0]:
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        current_version = cursor.fetchone()[0]
+    conn.commit()
+    latest_version = MIGRATIONS[-1][0]
+    if current_version < latest_version:
+        raise RuntimeError(f"Database schema is at version {current_version} but the code needs {latest_version}: "
+                           "run `flask --app main migrate` first")
+    return current_version
+
+
+def ensure_admin_user(conn):
+    """Create the .env admin account when no admin exists yet."""
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = TRUE')
+    admin_count = cursor.fetchone()[0]
+    if admin_count > 0:
+        return
+    admin_username = os.getenv('ADMIN_USERNAME', 'admin_user')
+    admin_password = os.getenv('ADMIN_PASSWORD')
+    if not admin_password:
+        print("Warning: ADMIN_PASSWORD not set in .env file. Please use /register_admin to create an admin.")
+        return
+    hashed_password = hashlib.sha256(admin_password.encode()).hexdigest()
+    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS wallets (
-                id SERIAL PRIMARY KEY,
-                wallet_address TEXT UNIQUE NOT NULL,
-                private_key TEXT NOT NULL,
-                balance REAL DEFAULT 0.0,
-                user_id INTEGER REFERENCES users(id)
-            )
-        ''')
+            INSERT INTO users (username, password, puk_balance, is_admin)
+            VALUES (%s, %s, %s, %s) RETURNING id
+        ''', (admin_username, hashed_password, 0.0, True))
+        admin_user_id = cursor.fetchone()[0]
+        wallet_address = secrets.token_hex(16)
+        private_key = secrets.token_hex(32)
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS block_ownership_history (
-                id SERIAL PRIMARY KEY,
-                block_index INTEGER NOT NULL REFERENCES blocks("index"),
-                previous_owner_id INTEGER REFERENCES users(id),
-                new_owner_id INTEGER REFERENCES users(id),
-                timestamp TIMESTAMP NOT NULL,
-                price REAL
-            )
-        ''')
+            INSERT INTO wallets (wallet_address, private_key, balance, user_id)
+            VALUES (%s, %s, %s, %s)
+        ''', (wallet_address, private_key, 0.0, admin_user_id))
+        bump_platform_stat(cursor, 'users')
+        conn.commit()
+        print(f"Created default admin user: {admin_username}. Use /register_admin or .env password to log in.")
+    except psycopg2.IntegrityError:
+        conn.rollback()
+        print(f"Admin user {admin_username} already exists.")
+
+
+# NOTIFY channels written in the same transaction as the change and relayed to
+# browsers by /stream. Payloads stay under PostgreSQL's 8000-byte limit because
+# ledger rows are sent NOTIFY_BATCH at a time.
+BLOCK_CHANNEL = 'chain_blocks'
+TRANSACTION_CHANNEL = 'chain_transactions'
+BTC_PRICE_CHANNEL = 'btc_price'
+PUK_PRICE_CHANNEL = 'puk_price'
+NOTIFY_BATCH = 40
+NOTIFY_MESSAGE_CHARS = 500
+
+
+def notify(cursor, channel, payload):
+    cursor.execute('SELECT pg_notify(%s, %s)', (channel, payload if isinstance(payload, str) else json.dumps(payload)))
+
+
+def record_transactions(cursor, entries):
+    """Insert (from_address, to_address, amount, block_index) ledger entries and apply them to wallets.balance.
+
+    Rows go in with one multi-row INSERT and each touched wallet gets a single
+    net UPDATE. The caller commits, so ledger rows, balances and the
+    TRANSACTION_CHANNEL notifications land atomically. Balances are updated in
+    address order; a caller that locks wallets beforehand must lock all of them
+    in that same order (see transfer_coins), or concurrent writers can deadlock.
+    """
+    if not entries:
+        return
+    inserted = execute_values(cursor, '''
+        INSERT INTO transactions (from_address, to_address, amount, block_index) VALUES %s RETURNING id, timestamp
+    ''', entries, fetch=True)
+    rows = [[tx_id, timestamp.isoformat(sep=' ', timespec='seconds'), *entry] for (tx_id, timestamp), entry in zip(inserted, entries)]
+    for start in range(0, len(rows), NOTIFY_BATCH):
+        notify(cursor, TRANSACTION_CHANNEL, rows[start:start + NOTIFY_BATCH])
+    deltas = collections.defaultdict(float)
+    for from_address, to_address, amount, _ in entries:
+        deltas[from_address] -= amount
+        deltas[to_address] += amount
+    execute_batch(cursor, 'UPDATE wallets SET balance = balance + %s WHERE wallet_address = %s',
+                  [(delta, address) for address, delta in sorted(deltas.items())])
+    bump_platform_stat(cursor, 'transactions', len(entries))
+    minted = sum(amount for from_address, _, amount, _ in entries if from_address == "system")
+    if minted:
+        bump_platform_stat(cursor, 'minted', minted)
+
+
+def record_transaction(cursor, from_address, to_address, amount, block_index=None):
+    """Insert one ledger entry; see record_transactions."""
+    record_transactions(cursor, [(from_address, to_address, amount, block_index)])
+
+
+TRANSACTION_PAGE_SIZE = 50
+TRANSACTION_PAGE_MAX = 500
+EXPORT_FETCH_SIZE = 2000
+TRANSACTION_COLUMNS = 'id, timestamp, from_address, to_address, amount, block_index'
+
+
+def encode_cursor(*values):
+    """Opaque keyset cursor token for the given sort-key values (datetimes are ISO encoded)."""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(token):
+    """Return the list of values in a keyset cursor token, or None when missing or malformed."""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def decode_timestamp_cursor(token):
+    """Return (timestamp, id) from a transaction history cursor, or None."""
+    values = decode_cursor(token)
+    try:
+        return datetime.fromisoformat(values[0]), int(values[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def transaction_to_dict(row):
+    return {"id": row[0], "timestamp": row[1], "from": row[2], "to": row[3], "amount": row[4], "block_index": row[5]}
+
+
+def fetch_transactions(address=None, cursor_token=None, limit=TRANSACTION_PAGE_SIZE):
+    """One page of ledger entries, newest first, keyed on (timestamp, id).
+
+    With an address only entries sent or received by that wallet are returned;
+    each side is read from its own (address, timestamp, id) index and merged.
+    Returns (transactions, next_cursor) where next_cursor is None on the last page.
+    """
+    after = decode_timestamp_cursor(cursor_token)
+    keyset = ' AND (timestamp, id) < (%(ts)s, %(id)s)' if after else ''
+    params = {'address': address, 'limit': limit + 1,
+              'ts': after[0] if after else None, 'id': after[1] if after else None}
+    if address:
+        side = ('(SELECT ' + TRANSACTION_COLUMNS + ' FROM transactions WHERE {} = %(address)s' + keyset +
+                ' ORDER BY timestamp DESC, id DESC LIMIT %(limit)s)')
+        query = '''
+            SELECT {} FROM ({} UNION {}) t
+            ORDER BY timestamp DESC, id DESC LIMIT %(limit)s
+        '''.format(TRANSACTION_COLUMNS, side.format('from_address'), side.format('to_address'))
+    else:
+        query = '''
+            SELECT {} FROM transactions WHERE TRUE{}
+            ORDER BY timestamp DESC, id DESC LIMIT %(limit)s
+        '''.format(TRANSACTION_COLUMNS, keyset)
+    cursor = get_db().cursor()
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return [transaction_to_dict(row) for row in rows[:limit]], next_cursor
+
+
+def iter_transactions(address=None):
+    """Stream ledger rows newest first through a server-side cursor, EXPORT_FETCH_SIZE rows per round-trip."""
+    cursor = get_db().cursor(name=f'export_{secrets.token_hex(4)}')
+    cursor.itersize = EXPORT_FETCH_SIZE
+    if address:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS posts (
-                id SERIAL PRIMARY KEY,
-                title TEXT NOT NULL,
-                content TEXT NOT NULL,
-                user_id INTEGER REFERENCES users(id),
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            SELECT {0} FROM transactions WHERE from_address = %(address)s
+            UNION ALL
+            SELECT {0} FROM transactions WHERE to_address = %(address)s AND from_address <> %(address)s
+            ORDER BY timestamp DESC, id DESC
+        '''.format(TRANSACTION_COLUMNS), {'address': address})
+    else:
+        cursor.execute('SELECT {} FROM transactions ORDER BY timestamp DESC, id DESC'.format(TRANSACTION_COLUMNS))
+    try:
+        for row in cursor:
+            yield transaction_to_dict(row)
+    finally:
+        cursor.close()
+
+
+BLOCK_EXPORT_QUERY = '''
+    SELECT b."index", b.message, b.hash, b.previous_hash, b.timestamp, u.username,
+           (SELECT COALESCE(json_agg(json_build_array(t.from_address, t.to_address, t.amount) ORDER BY t.id), '[]')
+            FROM transactions t WHERE t.block_index = b."index")
+    FROM blocks b
+    LEFT JOIN users u ON u.id = b.owner_id
+    WHERE {filters}
+    ORDER BY b."index"
+'''
+
+
+def block_export_to_dict(row):
+    return {
+        "index": row[0],
+        "message": row[1],
+        "hash": row[2],
+        "previous_hash": row[3],
+        "timestamp": row[4].isoformat(),
+        "owner": row[5],
+        "transactions": [{"from": tx[0], "to": tx[1], "amount": tx[2]} for tx in row[6]]
+    }
+
+
+def iter_blocks(start=None, end=None, owner=None):
+    """Stream blocks in index order through a server-side cursor, EXPORT_FETCH_SIZE rows per round-trip.
+
+    start and end are inclusive index bounds; owner is a username.
+    """
+    filters, params = ['TRUE'], []
+    if start is not None:
+        filters.append('b."index" >= %s')
+        params.append(start)
+    if end is not None:
+        filters.append('b."index" <= %s')
+        params.append(end)
+    if owner:
+        filters.append('b.owner_id = (SELECT id FROM users WHERE username = %s)')
+        params.append(owner)
+    cursor = get_db().cursor(name=f'blocks_{secrets.token_hex(4)}')
+    cursor.itersize = EXPORT_FETCH_SIZE
+    cursor.execute(BLOCK_EXPORT_QUERY.format(filters=' AND '.join(filters)), params)
+    try:
+        for row in cursor:
+            yield block_export_to_dict(row)
+    finally:
+        cursor.close()
+
+
+# Each counter is spread over this many rows so concurrent writers rarely share a row lock
+PLATFORM_STAT_SHARDS = 16
+
+# How each cached counter is recomputed from scratch by reconcile_platform_stats
+PLATFORM_STAT_QUERIES = {
+    'users': 'SELECT COUNT(*) FROM users',
+    'blocks': 'SELECT COUNT(*) FROM blocks',
+    'transactions': 'SELECT COUNT(*) FROM transactions',
+    'posts': 'SELECT COUNT(*) FROM posts',
+    'comments': 'SELECT COUNT(*) FROM comments',
+    'minted': "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE from_address = 'system'",
+}
+
+
+def get_platform_stats(cursor, *names):
+    """Cached counters from platform_stats (missing names read as 0)."""
+    cursor.execute('SELECT name, SUM(value) FROM platform_stats WHERE name = ANY(%s) GROUP BY name', (list(names),))
+    stats = dict.fromkeys(names, 0)
+    stats.update(cursor.fetchall())
+    return stats
+
+
+def bump_platform_stat(cursor, name, delta=1):
+    """Adjust a cached counter on the caller's transaction, alongside the write it counts.
+
+    The shard is fixed per connection, so one transaction never locks two
+    shards of the same counter and concurrent bumps cannot deadlock.
+    """
+    shard = cursor.connection.get_backend_pid() % PLATFORM_STAT_SHARDS
+    cursor.execute('''
+        INSERT INTO platform_stats (name, shard, value) VALUES (%s, %s, %s)
+        ON CONFLICT (name, shard) DO UPDATE SET value = platform_stats.value + EXCLUDED.value
+    ''', (name, shard, delta))
+
+
+def reconcile_platform_stats(conn):
+    """Recompute every counter from its source table; return {name: (cached, actual)} for drifted ones.
+
+    The cached values and the recounts are read from one REPEATABLE READ
+    snapshot, which holds no locks: writers bump a counter in the same
+    transaction as the rows it counts, so both sides of the snapshot see the
+    same writers. Only the difference is then added back through
+    bump_platform_stat, and bumps committed since the snapshot stay intact.
+    """
+    cursor = conn.cursor()
+    conn.commit()
+    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    stats = get_platform_stats(cursor, *PLATFORM_STAT_QUERIES)
+    drifted = {}
+    for name, query in PLATFORM_STAT_QUERIES.items():
+        cursor.execute(query)
+        cached, actual = float(stats[name]), float(cursor.fetchone()[0])
+        if abs(actual - cached) > 1e-6:
+            drifted[name] = (cached, actual)
+    conn.commit()
+    for name, (cached, actual) in drifted.items():
+        bump_platform_stat(cursor, name, actual - cached)
+    conn.commit()
+    return drifted
+
+
+MODERATION_PAGE_SIZE = 25
+
+MODERATION_QUERIES = {
+    'posts': """
+        SELECT p.id, p.title, p.content, p.timestamp, u.username
+        FROM posts p
+        LEFT JOIN users u ON p.user_id = u.id
+        WHERE {filters}
+        ORDER BY p.timestamp DESC, p.id DESC
+        LIMIT %s
+    """,
+    'comments': """
+        SELECT c.id, c.content, c.timestamp, u.username, c.post_id, p.title
+        FROM comments c
+        LEFT JOIN users u ON c.user_id = u.id
+        LEFT JOIN posts p ON c.post_id = p.id
+        WHERE {filters}
+        ORDER BY c.timestamp DESC, c.id DESC
+        LIMIT %s
+    """,
+}
+
+
+def fetch_moderation_page(cursor, kind, username=None, since=None, after=None, limit=MODERATION_PAGE_SIZE):
+    """Newest-first posts or comments for the admin dashboard, keyed on (timestamp, id).
+
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    """
+    alias = kind[0]
+    filters, params = ['TRUE'], []
+    if username:
+        filters.append(f'{alias}.user_id = (SELECT id FROM users WHERE username = %s)')
+        params.append(username)
+    if since:
+        filters.append(f'{alias}.timestamp >= %s')
+        params.append(since)
+    if after:
+        filters.append(f'({alias}.timestamp, {alias}.id) < (%s, %s)')
+        params.extend(after)
+    cursor.execute(MODERATION_QUERIES[kind].format(filters=' AND '.join(filters)), params + [limit + 1])
+    rows = cursor.fetchall()
+    if kind == 'posts':
+        items = [
+            {"id": row[0], "title": row[1], "content": row[2], "timestamp": row[3], "username": row[4] or "None"}
+            for row in rows[:limit]
+        ]
+    else:
+        items = [
+            {"id": row[0], "content": row[1], "timestamp": row[2], "username": row[3] or "None",
+             "post_id": row[4], "post_title": row[5] or "Unknown"}
+            for row in rows[:limit]
+        ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last["timestamp"], last["id"])
+    return items, next_cursor
+
+
+def page_window(page, total_pages, radius=2):
+    """Page numbers to link around the current page, so pagination HTML stays constant-size."""
+    return list(range(max(1, page - radius), min(total_pages, page + radius) + 1))
+
+
+BLOCK_PAGE_SIZE = 10
+POST_PAGE_SIZE = 10
+
+
+def block_row_to_dict(row):
+    return {"index": row[0], "message": row[1], "hash": row[2], "owner": row[3] or "None"}
+
+
+def fetch_blocks_by_index(cursor, page, descending, per_page=BLOCK_PAGE_SIZE):
+    """A page of blocks in index order, seeking straight to it (block indexes are contiguous from 0)."""
+    if descending:
+        cursor.execute('SELECT MAX("index") FROM blocks')
+        tip = cursor.fetchone()[0] or 0
+        condition, start, direction = 'b."index" <= %s', tip - (page - 1) * per_page, 'DESC'
+    else:
+        condition, start, direction = 'b."index" >= %s', (page - 1) * per_page, 'ASC'
+    cursor.execute('''
+        SELECT b."index", b.message, b.hash, u.username
+        FROM blocks b
+        LEFT JOIN users u ON b.owner_id = u.id
+        WHERE {}
+        ORDER BY b."index" {}
+        LIMIT %s
+    '''.format(condition, direction), (start, per_page))
+    return [block_row_to_dict(row) for row in cursor.fetchall()]
+
+
+def fetch_blocks_by_owner(cursor, descending, after=None, limit=BLOCK_PAGE_SIZE):
+    """Blocks ordered by (owner username, index), owned blocks first and ownerless ones last.
+
+    ``after`` is the sort key [group, username, index] of the row before the
+    page (group 0 = owned, 1 = ownerless); descending order walks the same
+    sequence backwards. Owned blocks are read user by user through the username
+    and (owner_id, index) indexes, so the cost does not depend on how deep the page is.
+    Returns rows as (key, block dict).
+    """
+    op, direction = ('<', 'DESC') if descending else ('>', 'ASC')
+    rows = []
+
+    def owned(limit):
+        params = {'limit': limit, 'username': None, 'index': None}
+        outer, inner = 'TRUE', ''
+        if after and after[0] == 0:
+            params['username'], params['index'] = after[1], after[2]
+            outer = 'u.username {}= %(username)s'.format(op)
+            inner = 'AND (u.username {0} %(username)s OR "index" {0} %(index)s)'.format(op)
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS comments (
-                id SERIAL PRIMARY KEY,
-                post_id INTEGER REFERENCES posts(id),
-                user_id INTEGER REFERENCES users(id),
-                content TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            SELECT b."index", b.message, b.hash, u.username
+            FROM users u
+            CROSS JOIN LATERAL (
+                SELECT "index", message, hash FROM blocks
+                WHERE owner_id = u.id {inner}
+                ORDER BY "index" {direction}
+                LIMIT %(limit)s
+            ) b
+            WHERE {outer}
+            ORDER BY u.username {direction}, b."index" {direction}
+            LIMIT %(limit)s
+        '''.format(inner=inner, outer=outer, direction=direction), params)
+        return [([0, row[3], row[0]], block_row_to_dict(row)) for row in cursor.fetchall()]
+
+    def ownerless(limit):
+        start = after[2] if after and after[0] == 1 else None
+        condition = ' AND "index" {} %s'.format(op) if start is not None else ''
         cursor.execute('''
-            ALTER TABLE blocks 
-            ADD COLUMN IF NOT EXISTS previous_hash TEXT NOT NULL DEFAULT '0'
-        ''')
+            SELECT "index", message, hash, NULL FROM blocks
+            WHERE owner_id IS NULL{}
+            ORDER BY "index" {}
+            LIMIT %s
+        '''.format(condition, direction), ((start, limit) if start is not None else (limit,)))
+        return [([1, '', row[0]], block_row_to_dict(row)) for row in cursor.fetchall()]
+
+    # Ascending: owned then ownerless; descending: ownerless then owned
+    phases = [ownerless, owned] if descending else [owned, ownerless]
+    if after and after[0] == (0 if descending else 1):
+        phases = phases[1:]
+    for phase in phases:
+        rows += phase(limit - len(rows))
+        if len(rows) >= limit:
+            break
+        after = None
+    return rows
+
+
+def fetch_posts_page(cursor, after=None, before=None, per_page=POST_PAGE_SIZE):
+    """Posts newest first keyed on (timestamp, id); ``before`` pages back towards newer posts.
+
+    Returns (posts, newer_cursor, older_cursor).
+    """
+    key = before or after
+    reverse = before is not None
+    condition = ''
+    params = []
+    if key:
+        condition = 'WHERE (p.timestamp, p.id) {} (%s, %s)'.format('>' if reverse else '<')
+        params = [datetime.fromisoformat(key[0]), int(key[1])]
+    cursor.execute('''
+        SELECT p.id, p.title, p.content, p.timestamp, u.username
+        FROM posts p
+        LEFT JOIN users u ON p.user_id = u.id
+        {}
+        ORDER BY p.timestamp {order}, p.id {order}
+        LIMIT %s
+    '''.format(condition, order='ASC' if reverse else 'DESC'), params + [per_page + 1])
+    rows = cursor.fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+    posts = [
+        {"id": row[0], "title": row[1], "content": row[2], "timestamp": row[3], "username": row[4] or "None"}
+        for row in rows
+    ]
+    if not posts:
+        return posts, None, None
+    newer = encode_cursor(rows[0][3], rows[0][0]) if (key and not reverse) or (reverse and has_more) else None
+    older = encode_cursor(rows[-1][3], rows[-1][0]) if reverse or has_more else None
+    return posts, newer, older
+
+
+# Board result cache: entry bound per worker, and the file holding generation
+# counters shared by every worker on the host
+BOARD_CACHE_SIZE = int(os.getenv('BOARD_CACHE_SIZE', '1024'))
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '4096'))
+CACHE_GENERATION_FILE = os.getenv('CACHE_GENERATION_FILE', os.path.join(tempfile.gettempdir(), 'chainlogger-cache-generations'))
+CACHE_GENERATION_SLOTS = 4096
+
+
+class SharedGenerations:
+    """Invalidation counters in a memory-mapped file shared by all worker processes.
+
+    Reading a counter is a plain memory read; bumping one takes an flock so
+    concurrent writers in different workers never lose an increment. Keys hash
+    into a fixed number of slots, so a collision can only over-invalidate.
+    The wall-clock time of each slot's last bump follows the counters.
+    """
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._mmap = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _map(self):
+        # Re-open after a fork: flock on a descriptor inherited from the master
+        # would be shared with every sibling worker and exclude nothing
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    if os.fstat(fd).st_size < self.slots * 16:
+                        os.ftruncate(fd, self.slots * 16)
+                    self._fd = fd
+                    self._mmap = mmap.mmap(fd, self.slots * 16)
+                    self._pid = os.getpid()
+        return self._mmap
+
+    def slot(self, key):
+        return zlib.crc32(repr(key).encode()) % self.slots
+
+    def get(self, key):
+        return struct.unpack_from('<Q', self._map(), self.slot(key) * 8)[0]
+
+    def bumped_at(self, key):
+        return struct.unpack_from('<d', self._map(), (self.slots + self.slot(key)) * 8)[0]
+
+    def bump(self, key):
+        mapped = self._map()
+        offset = self.slot(key) * 8
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            struct.pack_into('<Q', mapped, offset, struct.unpack_from('<Q', mapped, offset)[0] + 1)
+            struct.pack_into('<d', mapped, self.slots * 8 + offset, time.time())
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class GenerationalLRUCache:
+    """Size-bounded LRU of query results, each tagged with the generation of its invalidation key.
+
+    Callers read the generation before querying and store the result under it,
+    so a write that commits (and bumps the key) while the query runs leaves the
+    entry already stale rather than resurrecting old data.
+    """
+
+    def __init__(self, maxsize, generations):
+        self.maxsize = maxsize
+        self.generations = generations
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, invalidation_key):
+        generation = self.generations.get(invalidation_key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return generation, entry[1]
+            self.misses += 1
+        return generation, None
+
+    def set(self, key, generation, value, invalidation_key):
+        if (has_request_context() and db_is_replica()
+                and time.time() - self.generations.bumped_at(invalidation_key) < REPLICA_STALE_SECONDS):
+            # The replica may not have replayed the write that bumped the generation yet
+            return
+        with self._lock:
+            self._entries[key] = (generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, invalidation_key):
+        self.generations.bump(invalidation_key)
+
+
+cache_generations = SharedGenerations(CACHE_GENERATION_FILE, CACHE_GENERATION_SLOTS)
+board_cache = GenerationalLRUCache(BOARD_CACHE_SIZE, cache_generations)
+identity_cache = GenerationalLRUCache(IDENTITY_CACHE_SIZE, cache_generations)
+BOARD_LISTING_KEY = ('board',)
+
+
+def post_thread_key(post_id):
+    return ('post', post_id)
+
+
+def load_post_thread(cursor, post_id):
+    """(post, comments) for a board thread, or None when the post does not exist."""
+    cursor.execute(
+        'SELECT p.id, p.title, p.content, p.timestamp, u.username '
+        'FROM posts p LEFT JOIN users u ON p.user_id = u.id '
+        'WHERE p.id = %s',
+        (post_id,)
+    )
+    post_data = cursor.fetchone()
+    if not post_data:
+        return None
+    post = {
+        "id": post_data[0],
+        "title": post_data[1],
+        "content": post_data[2],
+        "timestamp": post_data[3],
+        "username": post_data[4] or "None"
+    }
+    cursor.execute(
+        'SELECT c.id, c.content, c.timestamp, u.username '
+        'FROM comments c LEFT JOIN users u ON c.user_id = u.id '
+        'WHERE c.post_id = %s ORDER BY c.timestamp ASC',
+        (post_id,)
+    )
+    comments = [
+        {"id": row[0], "content": row[1], "timestamp": row[2], "username": row[3] or "None"}
+        for row in cursor.fetchall()
+    ]
+    return post, comments
+
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_KINDS = ('block', 'post', 'comment')
+# At most this many matches of each kind are ranked, so a very common term costs
+# a bounded scan instead of scoring every matching row. The newest are kept, so
+# pages stay stable between requests and across replicas.
+SEARCH_CANDIDATES = 5000
+SEARCH_HEADLINE_OPTIONS = 'StartSel=<mark>, StopSel=</mark>, MaxWords=30, MinWords=10, MaxFragments=2'
+
+SEARCH_SOURCES = {
+    'block': '''SELECT 'block'::text AS kind, "index" AS id, search_vector FROM blocks
+                  WHERE search_vector @@ websearch_to_tsquery('simple', %(query)s)
+                  ORDER BY "index" DESC LIMIT %(candidates)s''',
+    'post': '''SELECT 'post'::text AS kind, id, search_vector FROM posts
+                 WHERE search_vector @@ websearch_to_tsquery('simple', %(query)s)
+                 ORDER BY id DESC LIMIT %(candidates)s''',
+    'comment': '''SELECT 'comment'::text AS kind, id, search_vector FROM comments
+                    WHERE search_vector @@ websearch_to_tsquery('simple', %(query)s)
+                    ORDER BY id DESC LIMIT %(candidates)s''',
+}
+
+
+def search_content(cursor, query, kinds=SEARCH_KINDS, after=None, limit=SEARCH_PAGE_SIZE):
+    """Ranked full-text matches across block messages, posts and comments.
+
+    ``after`` is the [rank, kind, id] key of the last hit on the previous page;
+    headlines are only computed for the rows on the returned page.
+    Returns (hits, next_cursor).
+    """
+    sources = ' UNION ALL '.join('({})'.format(SEARCH_SOURCES[kind]) for kind in SEARCH_KINDS if kind in kinds)
+    params = {'query': query, 'candidates': SEARCH_CANDIDATES, 'limit': limit + 1,
+              'options': SEARCH_HEADLINE_OPTIONS, 'after_rank': None, 'after_kind': None, 'after_id': None}
+    keyset = 'TRUE'
+    if after:
+        params['after_rank'], params['after_kind'], params['after_id'] = after
+        keyset = '(rank, kind, id) < (%(after_rank)s, %(after_kind)s, %(after_id)s)'
+    cursor.execute('''
+        WITH q AS (SELECT websearch_to_tsquery('simple', %(query)s) AS query),
+        candidates AS ({sources}),
+        ranked AS (
+            SELECT kind, id, ts_rank(search_vector, (SELECT query FROM q))::float8 AS rank FROM candidates
+        ),
+        page AS (
+            SELECT kind, id, rank FROM ranked WHERE {keyset}
+            ORDER BY rank DESC, kind DESC, id DESC
+            LIMIT %(limit)s
+        )
+        SELECT p.kind, p.id, p.rank,
+               CASE p.kind WHEN 'block' THEN 'Block #' || p.id WHEN 'post' THEN po.title ELSE cp.title END,
+               ts_headline('simple', COALESCE(b.message, po.content, c.content), (SELECT query FROM q), %(options)s),
+               COALESCE(b.timestamp, po.timestamp, c.timestamp),
+               COALESCE(c.post_id, po.id)
+        FROM page p
+        LEFT JOIN blocks b ON p.kind = 'block' AND b."index" = p.id
+        LEFT JOIN posts po ON p.kind = 'post' AND po.id = p.id
+        LEFT JOIN comments c ON p.kind = 'comment' AND c.id = p.id
+        LEFT JOIN posts cp ON cp.id = c.post_id
+        ORDER BY p.rank DESC, p.kind DESC, p.id DESC
+    '''.format(sources=sources, keyset=keyset), params)
+    rows = cursor.fetchall()
+    hits = [
+        {"kind": row[0], "id": row[1], "rank": row[2], "title": row[3] or "Unknown",
+         "snippet": highlight_snippet(row[4]), "timestamp": row[5], "post_id": row[6]}
+        for row in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = hits[-1]
+        next_cursor = encode_cursor(last["rank"], last["kind"], last["id"])
+    return hits, next_cursor
+
+
+SNIPPET_TAG_RE = re.compile(r'</?(?:b|i|u|strong|em)>')
+
+
+def highlight_snippet(headline):
+    """Escape a ts_headline fragment but keep its <mark> highlights (board formatting tags are dropped)."""
+    escaped = str(escape(SNIPPET_TAG_RE.sub('', headline or '')))
+    return Markup(escaped.replace('&lt;mark&gt;', '<mark>').replace('&lt;/mark&gt;', '</mark>'))
+
+
+def parse_search_args(args):
+    """(query, kinds, after, limit) from request args; raises ValueError on a bad cursor or kind."""
+    query = args.get('q', '').strip()
+    kinds = tuple(args.getlist('kind')) or SEARCH_KINDS
+    if any(kind not in SEARCH_KINDS for kind in kinds):
+        raise ValueError('kind must be one of ' + ', '.join(SEARCH_KINDS))
+    after = decode_cursor(args.get('after'))
+    if args.get('after'):
+        try:
+            after = [float(after[0]), str(after[1]), int(after[2])]
+        except (TypeError, ValueError, IndexError):
+            raise ValueError('invalid cursor')
+    limit = min(max(args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_PAGE_MAX)
+    return query, kinds, after, limit
+
+
+GENESIS_HASH = "Genesis"
+GENESIS_PREVIOUS_HASH = "0" * 64
+
+# Advisory lock key serializing block appends and edits across workers
+CHAIN_LOCK_ID = 7_031_009
+
+# Block producer: seal the mempool once it holds this many transactions, or when
+# the oldest pending transaction has waited BLOCK_INTERVAL seconds
+BLOCK_MAX_TRANSACTIONS = int(os.getenv('BLOCK_MAX_TRANSACTIONS', '1000'))
+BLOCK_INTERVAL = float(os.getenv('BLOCK_INTERVAL', '10'))
+
+# Chain verification: blocks per worker batch, and the key signing stored checkpoints.
+# Without CHECKPOINT_SECRET every verification is a full one and no checkpoint is stored.
+VERIFY_BATCH_SIZE = int(os.getenv('VERIFY_BATCH_SIZE', '20000'))
+CHECKPOINT_SECRET = os.getenv('CHECKPOINT_SECRET')
+
+
+def compute_block_hash(previous_hash, index, message):
+    return hashlib.sha256(f"{previous_hash}{index}{message}".encode('utf-8')).hexdigest()
+
+
+def lock_chain_tip(cursor):
+    """Take the chain advisory lock for this transaction; return (next index, hash of the committed tip)."""
+    cursor.execute('SELECT pg_advisory_xact_lock(%s)', (CHAIN_LOCK_ID,))
+    cursor.execute('SELECT "index", hash FROM blocks ORDER BY "index" DESC LIMIT 1')
+    tip = cursor.fetchone()
+    if tip is None:
+        return 0, GENESIS_PREVIOUS_HASH
+    return tip[0] + 1, tip[1]
+
+
+def insert_block(cursor, index, message, block_hash, previous_hash, owner_id):
+    """Insert one block row, count it and announce it on BLOCK_CHANNEL; the caller commits."""
+    timestamp = datetime.now()
+    cursor.execute('INSERT INTO blocks ("index", message, hash, previous_hash, timestamp, owner_id) VALUES (%s, %s, %s, %s, %s, %s) '
+                   'RETURNING (SELECT username FROM users WHERE id = blocks.owner_id)',
+                   (index, message, block_hash, previous_hash, timestamp.isoformat(), owner_id))
+    notify(cursor, BLOCK_CHANNEL, {"index": index, "message": message[:NOTIFY_MESSAGE_CHARS], "hash": block_hash,
+                                   "owner": cursor.fetchone()[0], "timestamp": timestamp.isoformat(sep=' ', timespec='seconds')})
+    bump_platform_stat(cursor, 'blocks')
+
+
+def seal_pending_transactions(conn, max_transactions=BLOCK_MAX_TRANSACTIONS):
+    """Seal up to ``max_transactions`` mempool entries (block_index IS NULL) into one new block.
+
+    The block row and a single bulk UPDATE of block_index commit together. The
+    block message carries a digest of the sealed entries, so the block hash
+    commits to them. Returns (block index, sealed count), or None when the mempool is empty.
+    """
+    cursor = conn.cursor()
+    new_index, previous_hash = lock_chain_tip(cursor)
+    cursor.execute('''
+        SELECT id, from_address, to_address, amount FROM transactions
+        WHERE block_index IS NULL ORDER BY id LIMIT %s
+    ''', (max_transactions,))
+    pending = cursor.fetchall()
+    if not pending:
+        conn.rollback()
+        return None
+    tx_root = hashlib.sha256("".join(f"{tx_id}:{src}:{dst}:{amount};" for tx_id, src, dst, amount in pending).encode()).hexdigest()
+    message = f"Sealed {len(pending)} transactions (root {tx_root})"
+    insert_block(cursor, new_index, message, compute_block_hash(previous_hash, new_index, message), previous_hash, None)
+    cursor.execute('UPDATE transactions SET block_index = %s WHERE id = ANY(%s)', (new_index, [tx[0] for tx in pending]))
+    conn.commit()
+    return new_index, len(pending)
+
+
+def mempool_status(conn):
+    """(pending transaction count, age in seconds of the oldest pending one)."""
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*), EXTRACT(EPOCH FROM now() - MIN(timestamp)) FROM transactions WHERE block_index IS NULL')
+    count, oldest_age = cursor.fetchone()
+    conn.commit()
+    return count, float(oldest_age or 0)
+
+
+def verify_block_batch(batch):
+    """Check one batch of (index, message, hash, previous_hash) rows in index order.
+
+    ``batch`` is (previous_index, previous_hash, rows) where the first two describe
+    the block just before the batch (None before genesis). Returns
+    (index, reason) for the first broken block, or None. Runs in worker processes.
+    """
+    expected_index, expected_previous_hash, rows = batch
+    for index, message, stored_hash, previous_hash in rows:
+        if expected_index is not None and index != expected_index + 1:
+            return index, f"index gap after block {expected_index}"
+        if expected_previous_hash is not None and previous_hash != expected_previous_hash:
+            return index, f"previous_hash does not match the hash of block {index - 1}"
+        if index == 0 and stored_hash == GENESIS_HASH:
+            if previous_hash != GENESIS_PREVIOUS_HASH:
+                return index, "genesis previous_hash is not zero"
+        elif compute_block_hash(previous_hash, index, message) != stored_hash:
+            return index, "hash does not match sha256(previous_hash + index + message)"
+        expected_index, expected_previous_hash = index, stored_hash
+    return None
+
+
+def sign_checkpoint(last_index, last_hash, digest, max_version):
+    if not CHECKPOINT_SECRET:
+        raise RuntimeError('CHECKPOINT_SECRET is not set')
+    payload = f"{last_index}:{last_hash}:{digest}:{max_version}".encode()
+    return hmac.new(CHECKPOINT_SECRET.encode(), payload, hashlib.sha256).hexdigest()
+
+
+def find_resume_checkpoint(cursor):
+    """Newest correctly signed checkpoint whose verified range has no blocks edited since it was taken."""
+    if not CHECKPOINT_SECRET:
+        return None
+    cursor.execute('''
+        SELECT last_index, last_hash, digest, max_version, signature
+        FROM chain_checkpoints ORDER BY last_index DESC, id DESC LIMIT 50
+    ''')
+    for last_index, last_hash, digest, max_version, signature in cursor.fetchall():
+        if not hmac.compare_digest(signature, sign_checkpoint(last_index, last_hash, digest, max_version)):
+            continue
+        cursor.execute('SELECT 1 FROM blocks WHERE version > %s AND "index" <= %s LIMIT 1', (max_version, last_index))
+        if cursor.fetchone() is None:
+            return last_index, last_hash, digest, max_version
+    return None
+
+
+def verify_chain(conn, full=False, workers=1, batch_size=VERIFY_BATCH_SIZE):
+    """Verify hashes and previous_hash links, resuming from the last valid checkpoint unless ``full``.
+
+    Blocks are streamed in index order from a server-side cursor and checked in
+    batches, across a process pool when ``workers`` > 1. A new signed checkpoint
+    (last verified index, rolling digest of block hashes, highest version seen)
+    is stored for the verified prefix, so the next run only re-checks blocks
+    appended or edited after it.
+    """
+    started = time.monotonic()
+    cursor = conn.cursor()
+    resume = None if full else find_resume_checkpoint(cursor)
+    last_index, last_hash, digest, max_version = resume or (None, None, '', 0)
+    start_after = last_index
+
+    block_cursor = conn.cursor(name=f'verify_{secrets.token_hex(4)}')
+    block_cursor.itersize = batch_size
+    block_cursor.execute('''
+        SELECT "index", message, hash, previous_hash, version FROM blocks
+        WHERE "index" > %s ORDER BY "index"
+    ''', (-1 if last_index is None else last_index,))
+
+    def batches():
+        while True:
+            rows = block_cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pending = collections.deque()
+    verified = 0
+    broken = None
+    try:
+        for rows in itertools.chain(batches(), [None]):
+            if rows is not None:
+                batch = (last_index, last_hash, [row[:4] for row in rows])
+                pending.append((rows, executor.submit(verify_block_batch, batch) if executor else verify_block_batch(batch)))
+                last_index, last_hash = rows[-1][0], rows[-1][2]
+            # Keep a bounded number of batches in flight and consume results in order
+            while pending and (rows is None or len(pending) > workers * 2 or executor is None):
+                batch_rows, result = pending.popleft()
+                failure = result.result() if executor else result
+                good_rows = batch_rows if failure is None else [row for row in batch_rows if row[0] < failure[0]]
+                for index, _, block_hash, _, version in good_rows:
+                    digest = hashlib.sha256(f"{digest}{block_hash}".encode()).hexdigest()
+                    max_version = max(max_version, version)
+                    resume = (index, block_hash, digest, max_version)
+                verified += len(good_rows)
+                if failure is not None:
+                    broken = {"index": failure[0], "reason": failure[1]}
+                    break
+            if broken:
+                break
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        block_cursor.close()
+
+    if resume and CHECKPOINT_SECRET and (start_after is None or resume[0] > start_after):
         cursor.execute('''
-            ALTER TABLE users
-            ADD COLUMN IF NOT EXISTS is_admin BOOLEAN DEFAULT FALSE
-        ''')
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = TRUE')
-        admin_count = cursor.fetchone()[0]
-        if admin_count == 0:
-            admin_username = os.getenv('ADMIN_USERNAME', 'admin_user')
-            admin_password = os.getenv('ADMIN_PASSWORD')
-            if not admin_password:
-                print("Warning: ADMIN_PASSWORD not set in .env file. Please use /register_admin to create an admin.")
-            else:
-                hashed_password = hashlib.sha256(admin_password.encode()).hexdigest()
-                try:
-                    cursor.execute('''
-                        INSERT INTO users (username, password, puk_balance, is_admin)
-                        VALUES (%s, %s, %s, %s) RETURNING id
-                    ''', (admin_username, hashed_password, 0.0, True))
-                    admin_user_id = cursor.fetchone()[0]
-                    wallet_address = secrets.token_hex(16)
-                    private_key = secrets.token_hex(32)
-                    cursor.execute('''
-                        INSERT INTO wallets (wallet_address, private_key, balance, user_id)
-                        VALUES (%s, %s, %s, %s)
-                    ''', (wallet_address, private_key, 0.0, admin_user_id))
-                    print(f"Created default admin user: {admin_username}. Use /register_admin or .env password to log in.")
-                except psycopg2.IntegrityError:
-                    print(f"Admin user {admin_username} already exists.")
-        
-        conn.commit()
-        conn.close()
-        print("Database tables created")
+            INSERT INTO chain_checkpoints (last_index, last_hash, digest, max_version, signature)
+            VALUES (%s, %s, %s, %s, %s)
+        ''', (*resume, sign_checkpoint(*resume)))
+    conn.commit()
+    return {
+        "ok": broken is None,
+        "first_broken": broken,
+        "resumed_after": start_after,
+        "verified_blocks": verified,
+        "last_verified_index": resume[0] if resume else None,
+        "digest": resume[2] if resume else None,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 2),
+    }
+
+
+class Blockchain:
+    def __init__(self, wallet_address=None, private_key=None):
+        self.wallet_address = wallet_address
+        self.private_key = private_key
+        self.reward_amount = 10
+
+    @property
+    def chain(self):
+        return chain_cache.blocks
 
     def create_genesis_block(self):
         genesis_message = "Genesis Block - Initializing Blockchain"
-        genesis_hash = "Genesis"
-        genesis_previous_hash = "0" * 64
-        genesis_block = {
-            "index": 0,
-            "message": genesis_message,
-            "transactions": [],
-            "hash": genesis_hash,
-            "previous_hash": genesis_previous_hash,
-            "owner_id": None,
-            "timestamp": datetime.now().isoformat()
-        }
-        self.chain.append(genesis_block)
-        self.save_block_to_db(0, genesis_message, genesis_hash, genesis_previous_hash, [], None)
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (CHAIN_LOCK_ID,))
+        cursor.execute('SELECT 1 FROM blocks LIMIT 1')
+        if cursor.fetchone() is None:
+            self.save_block_to_db(cursor, 0, genesis_message, GENESIS_HASH, GENESIS_PREVIOUS_HASH, [], None)
+        conn.commit()
+        self.load_blocks_from_db()
+
+    def load_blocks_from_db(self):
+        return chain_cache.sync(get_db())
+
+    def add_block(self, message, transactions=None):
+        """Append a block with its transactions and the owner's reward in one database transaction.
+
+        The chain advisory lock serializes appends across workers, so the index
+        and previous_hash always come from the committed tip, never from a stale cache.
+        """
+        conn = get_db()
+        cursor = conn.cursor()
+        new_index, previous_hash = lock_chain_tip(cursor)
+        new_hash = compute_block_hash(previous_hash, new_index, message)
+        block_transactions = transactions if transactions else []
+
+        self.save_block_to_db(cursor, new_index, message, new_hash, previous_hash, block_transactions, session.get('user_id'))
+        rewarded_user_id = self.give_reward(cursor, new_index)
+        conn.commit()
+        invalidate_user_context(rewarded_user_id)
+        self.load_blocks_from_db()
+        return new_index
+
+    def save_block_to_db(self, cursor, index, message, block_hash, previous_hash, transactions, owner_id):
+        """Insert a block and its transactions on the caller's cursor; the caller commits."""
+        insert_block(cursor, index, message, block_hash, previous_hash, owner_id)
+        record_transactions(cursor, [(tx["from_address"], tx["to_address"], tx["amount"], index) for tx in transactions])
+
+    def update_block_message(self, index, new_message):
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (CHAIN_LOCK_ID,))
+        cursor.execute('SELECT previous_hash FROM blocks WHERE "index" = %s', (index,))
+        row = cursor.fetchone()
+        previous_hash = row[0] if row else GENESIS_PREVIOUS_HASH
+        new_hash = compute_block_hash(previous_hash, index, new_message)
+        cursor.execute('UPDATE blocks SET message = %s, hash = %s, timestamp = %s, version = nextval(\'blocks_version_seq\') WHERE "index" = %s',
+                       (new_message, new_hash, datetime.now().isoformat(), index))
+        conn.commit()
+        self.load_blocks_from_db()
+
+    def give_reward(self, cursor, block_index=None):
+        """Credit the block reward on the caller's cursor and return the rewarded user id; the caller commits."""
+        record_transaction(cursor, "system", self.wallet_address, self.reward_amount, block_index)
+        cursor.execute('UPDATE users SET puk_balance = puk_balance + %s WHERE id = (SELECT user_id FROM wallets WHERE wallet_address = %s) RETURNING id',
+                       (self.reward_amount, self.wallet_address))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def view_transactions(self, cursor_token=None, limit=TRANSACTION_PAGE_SIZE):
+        if not self.wallet_address:
+            return [], None
+        return fetch_transactions(self.wallet_address, cursor_token, limit)
+
+    def calculate_balance(self, cursor=None, for_update=False):
+        cursor = cursor or get_db().cursor()
+        query = 'SELECT balance FROM wallets WHERE wallet_address = %s'
+        cursor.execute(query + (' FOR UPDATE' if for_update else ''), (self.wallet_address,))
+        result = cursor.fetchone()
+        return result[0] if result else 0
+
+    def transfer_coins(self, to_address, amount):
+        if amount <= 0:
+            return False, "Amount must be greater than 0"
+        conn = get_db()
+        cursor = conn.cursor()
+        # Lock both wallets up front in address order, the same order record_transactions
+        # updates them in, so opposite transfers between two wallets cannot deadlock
+        cursor.execute('SELECT wallet_address, balance FROM wallets WHERE wallet_address = ANY(%s) ORDER BY wallet_address FOR UPDATE',
+                       ([self.wallet_address, to_address],))
+        balances = dict(cursor.fetchall())
+        if (balances.get(self.wallet_address) or 0) < amount:
+            conn.rollback()
+            return False, "Insufficient balance"
+        if to_address not in balances:
+            conn.rollback()
+            return False, "Recipient address does not exist"
+        record_transaction(cursor, self.wallet_address, to_address, amount)
+        conn.commit()
+        return True, "Transfer successful"
+
+blockchain = Blockchain()
+
+
+# PUK order book: PUK (users.puk_balance) is traded for ledger coins (wallets.balance).
+# Orders reserve their funds when placed: sells debit PUK, buys move coins into the
+# ORDERBOOK_ESCROW ledger address. A single matcher process (flask match-orders)
+# owns the in-memory book and settles fills back out of the reservations.
+ORDER_CHANNEL = 'puk_orders'
+ORDERBOOK_ESCROW = 'orderbook'
+MATCHER_LOCK_ID = 7_031_021
+PUK_INITIAL_PRICE = float(os.getenv('PUK_INITIAL_PRICE', '1.0'))
+# Market orders are limited to this fraction away from the last trade price
+MARKET_ORDER_COLLAR = float(os.getenv('MARKET_ORDER_COLLAR', '0.10'))
+MATCH_BATCH_SIZE = int(os.getenv('MATCH_BATCH_SIZE', '500'))
+MATCH_POLL_INTERVAL = 5.0
+QUANTITY_EPSILON = 1e-9
+ORDER_BOOK_DEPTH = 10
+# PUK candles live in the klines table under this symbol, maintained by the matcher
+PUK_KLINE_SYMBOL = 'PUKCOIN'
+PUK_KLINE_INTERVAL_MS = {'1m': 60_000, '5m': 300_000, '1h': 3_600_000, '4h': 14_400_000, '1d': 86_400_000}
+PUK_KLINES_MAX_LIMIT = 1000
+PUK_KLINES_MAX_AGE = 5
+
+
+def last_puk_price(cursor=None):
+    """Price of the most recent PUK trade, or PUK_INITIAL_PRICE before the first one."""
+    cursor = cursor or get_db().cursor()
+    cursor.execute('SELECT price FROM trades ORDER BY id DESC LIMIT 1')
+    row = cursor.fetchone()
+    return row[0] if row else PUK_INITIAL_PRICE
+
+
+class BookOrder:
+    __slots__ = ('id', 'user_id', 'side', 'kind', 'price', 'reserve_price', 'remaining', 'filled')
+
+    def __init__(self, order_id, user_id, side, kind, price, reserve_price, remaining):
+        self.id = order_id
+        self.user_id = user_id
+        self.side = side
+        self.kind = kind
+        self.price = price
+        self.reserve_price = reserve_price
+        self.remaining = remaining
+        self.filled = False
+
+    @property
+    def limit_price(self):
+        return self.price if self.kind == 'limit' else self.reserve_price
+
+
+class OrderBook:
+    """Price-time priority book: a FIFO deque per price level, best level found through a heap per side.
+
+    Emptied levels are dropped lazily when they reach the top of their heap.
+    """
+
+    def __init__(self):
+        self.levels = {'buy': {}, 'sell': {}}
+        self._heaps = {'buy': [], 'sell': []}
+        self.orders = {}
+
+    def best_price(self, side):
+        heap, levels = self._heaps[side], self.levels[side]
+        while heap:
+            price = -heap[0] if side == 'buy' else heap[0]
+            if levels.get(price):
+                return price
+            heapq.heappop(heap)
+            levels.pop(price, None)
+        return None
+
+    def _rest(self, order):
+        level = self.levels[order.side].get(order.price)
+        if level is None:
+            level = self.levels[order.side][order.price] = collections.deque()
+            heapq.heappush(self._heaps[order.side], -order.price if order.side == 'buy' else order.price)
+        level.append(order)
+        self.orders[order.id] = order
+
+    def cancel(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self.levels[order.side][order.price].remove(order)
+        return order
+
+    def submit(self, order):
+        """Match an incoming order at resting prices; rest a limit remainder.
+
+        Returns the fills as (maker, quantity, price) tuples.
+        """
+        fills = []
+        opposite = 'sell' if order.side == 'buy' else 'buy'
+        limit = order.limit_price
+        while order.remaining > QUANTITY_EPSILON:
+            best = self.best_price(opposite)
+            if best is None or (best > limit if order.side == 'buy' else best < limit):
+                break
+            level = self.levels[opposite][best]
+            maker = level[0]
+            quantity = min(order.remaining, maker.remaining)
+            order.remaining -= quantity
+            maker.remaining -= quantity
+            order.filled = maker.filled = True
+            fills.append((maker, quantity, best))
+            if maker.remaining <= QUANTITY_EPSILON:
+                level.popleft()
+                del self.orders[maker.id]
+        if order.kind == 'limit' and order.remaining > QUANTITY_EPSILON:
+            self._rest(order)
+        return fills
+
+
+class CandleAggregator:
+    """OHLCV candles per interval, updated trade by trade and flushed as upserts of the touched rows.
+
+    Only the newest candle of each interval is held in memory; it is reloaded from
+    the klines table on start-up so a restarted matcher keeps extending it.
+    """
+
+    def __init__(self, symbol, intervals):
+        self.symbol = symbol
+        self.intervals = intervals
+        self.current = {}
+        self.pending = {}
+        self.loaded = False
+
+    def load(self, cursor):
+        cursor.execute('''
+            SELECT DISTINCT ON (interval) interval, open_time, open, high, low, close, volume, close_time FROM klines
+            WHERE symbol = %s AND interval = ANY(%s)
+            ORDER BY interval, open_time DESC
+        ''', (self.symbol, list(self.intervals)))
+        self.current = {row[0]: list(row[1:]) for row in cursor.fetchall()}
+        self.pending = {}
+        self.loaded = True
+
+    def add(self, executed_ms, price, quantity):
+        for interval, ms in self.intervals.items():
+            open_time = executed_ms // ms * ms
+            candle = self.current.get(interval)
+            if candle is None or open_time > candle[0]:
+                candle = [open_time, price, price, price, price, 0.0, open_time + ms - 1]
+                self.current[interval] = candle
+            else:
+                candle[2] = max(candle[2], price)
+                candle[3] = min(candle[3], price)
+                candle[4] = price
+            candle[5] += quantity
+            self.pending[(interval, candle[0])] = candle
+
+    def flush(self, cursor):
+        if not self.pending:
+            return 0
+        execute_values(cursor, '''
+            INSERT INTO klines (symbol, interval, open_time, open, high, low, close, volume, close_time) VALUES %s
+            ON CONFLICT (symbol, interval, open_time) DO UPDATE SET
+                high = EXCLUDED.high, low = EXCLUDED.low, close = EXCLUDED.close, volume = EXCLUDED.volume
+        ''', [(self.symbol, interval, *candle) for (interval, _), candle in sorted(self.pending.items())])
+        flushed = len(self.pending)
+        self.pending = {}
+        return flushed
+
+
+def puk_candles(timeframe, start=None, end=None, limit=KLINES_LIMIT):
+    """The newest ``limit`` PUK candles opened within [start, end] (ms), oldest first."""
+    cursor = get_db().cursor()
+    cursor.execute('''
+        SELECT open_time, open, high, low, close, volume, close_time FROM klines
+        WHERE symbol = %s AND interval = %s AND open_time >= %s AND open_time <= %s
+        ORDER BY open_time DESC
+        LIMIT %s
+    ''', (PUK_KLINE_SYMBOL, timeframe, start or 0, end if end is not None else 2 ** 62, limit))
+    return [list(row) for row in reversed(cursor.fetchall())]
+
+
+def order_status(order, cancelled=False):
+    if order.remaining <= QUANTITY_EPSILON:
+        return 'filled'
+    if cancelled:
+        return 'cancelled'
+    return 'partial' if order.filled else 'open'
+
+
+def settlement_credits(fills, cancelled):
+    """Trade rows and the PUK and coin released to each user by a batch of fills and cancels.
+
+    Returns (trades, puk_credits, coin_credits), the credits as Counters by user id.
+    """
+    puk_credits = collections.Counter()
+    coin_credits = collections.Counter()
+    trades = []
+    for taker, maker, quantity, price in fills:
+        buy, sell = (taker, maker) if taker.side == 'buy' else (maker, taker)
+        trades.append((buy.id, sell.id, buy.user_id, sell.user_id, price, quantity))
+        puk_credits[buy.user_id] += quantity
+        coin_credits[sell.user_id] += price * quantity
+        # Buyers reserved at their own limit; trading at a better price refunds the difference
+        coin_credits[buy.user_id] += (buy.reserve_price - price) * quantity
+    for order in cancelled:
+        if order.side == 'buy':
+            coin_credits[order.user_id] += order.remaining * order.reserve_price
+        else:
+            puk_credits[order.user_id] += order.remaining
+    return trades, puk_credits, coin_credits
+
+
+class MatchingEngine:
+    """Feeds queued orders and cancel requests through the OrderBook and settles each batch in one transaction.
+
+    New orders are claimed by their ``booked`` flag, which the settlement sets,
+    so an order that commits after a higher id was already read is still picked
+    up. The book is only ever rebuilt from the orders table: on start-up (and
+    after a failed settlement) every booked live order is replayed in id order.
+    Orders that had already rested cannot cross each other, so the replay
+    reproduces the old book.
+    """
+
+    def __init__(self):
+        self.recover()
 
-    def load_blocks_from_db(self):
-        self.chain = []
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT "index", message, hash, previous_hash, timestamp, owner_id FROM blocks')
-        for row in cursor.fetchall():
-            block = {
-                "index": row[0],
-                "message": row[1],
-                "hash": row[2],
-                "previous_hash": row[3],
-                "timestamp": row[4],
-                "owner_id": row[5],
-                "transactions": []
-            }
-            cursor.execute('SELECT from_address, to_address, amount FROM transactions WHERE block_index = %s', (row[0],))
-            block["transactions"] = [{"from_address": tx[0], "to_address": tx[1], "amount": tx[2]} for tx in cursor.fetchall()]
-            self.chain.append(block)
-        conn.close()
+    def recover(self):
+        self.book = OrderBook()
+        self.loaded = False
+        self.candles = CandleAggregator(PUK_KLINE_SYMBOL, PUK_KLINE_INTERVAL_MS)
 
-    def add_block(self, message, transactions=None):
-        conn = psycopg2.connect(**DB_CONFIG)
+    def run_batch(self, conn):
+        """Process up to MATCH_BATCH_SIZE new orders plus pending cancels; returns the number of new orders."""
         cursor = conn.cursor()
-        cursor.execute('SELECT MAX("index") FROM blocks')
-        max_index = cursor.fetchone()[0]
-        new_index = 0 if max_index is None else max_index + 1
-        
-        previous_hash = self.chain[-1]["hash"] if self.chain else "0" * 64
-        new_hash = hashlib.sha256(f"{previous_hash}{new_index}{message}".encode('utf-8')).hexdigest()
-        block_transactions = transactions if transactions else []
-        
-        new_block = {
-            "index": new_index,
-            "message": message,
-            "transactions": block_transactions,
-            "hash": new_hash,
-            "previous_hash": previous_hash,
-            "owner_id": session.get('user_id'),
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        self.chain.append(new_block)
-        self.save_block_to_db(new_index, message, new_hash, previous_hash, block_transactions, session.get('user_id'))
-        self.give_reward()
-        conn.close()
+        replayed = []
+        if not self.loaded:
+            cursor.execute('''
+                SELECT id, user_id, side, kind, price, reserve_price, remaining, cancel_requested, status FROM orders
+                WHERE booked AND status IN ('open', 'partial')
+                ORDER BY id
+            ''')
+            replayed = cursor.fetchall()
+        cursor.execute('''
+            SELECT id, user_id, side, kind, price, reserve_price, remaining, cancel_requested, status FROM orders
+            WHERE NOT booked AND status IN ('open', 'partial')
+            ORDER BY id
+            LIMIT %s
+        ''', (MATCH_BATCH_SIZE,))
+        incoming = cursor.fetchall()
+        cursor.execute("SELECT id FROM orders WHERE cancel_requested AND booked AND status IN ('open', 'partial')")
+        cancel_ids = [row[0] for row in cursor.fetchall()]
+        self.loaded = True
+        if not replayed and not incoming and not cancel_ids:
+            conn.commit()
+            return 0
 
-    def save_block_to_db(self, index, message, block_hash, previous_hash, transactions, owner_id):
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO blocks ("index", message, hash, previous_hash, timestamp, owner_id) VALUES (%s, %s, %s, %s, %s, %s)',
-                       (index, message, block_hash, previous_hash, datetime.now().isoformat(), owner_id))
-        for tx in transactions:
-            cursor.execute('INSERT INTO transactions (from_address, to_address, amount, block_index) VALUES (%s, %s, %s, %s)',
-                           (tx["from_address"], tx["to_address"], tx["amount"], index))
-        conn.commit()
-        conn.close()
-        
-    def update_block_message(self, index, new_message):
-        conn = psycopg2.connect(**DB_CONFIG)
+        fills, touched, cancelled = [], {}, []
+        # Cancels apply to the (replayed) book before new orders can match against it
+        self.feed(replayed, fills, touched, cancelled)
+        for order_id in cancel_ids:
+            order = self.book.cancel(order_id)
+            if order is not None:
+                cancelled.append(order)
+        self.feed(incoming, fills, touched, cancelled)
+        try:
+            self.settle(conn, fills, touched, cancelled)
+        except Exception:
+            conn.rollback()
+            self.recover()
+            raise
+        return len(incoming)
+
+    def feed(self, rows, fills, touched, cancelled):
+        for order_id, user_id, side, kind, price, reserve_price, remaining, cancel_requested, status in rows:
+            order = BookOrder(order_id, user_id, side, kind, price, reserve_price, remaining)
+            order.filled = status == 'partial'
+            if cancel_requested:
+                cancelled.append(order)
+                continue
+            for maker, quantity, fill_price in self.book.submit(order):
+                fills.append((order, maker, quantity, fill_price))
+                touched[maker.id] = maker
+            touched[order.id] = order
+            if order.kind == 'market' and order.remaining > QUANTITY_EPSILON:
+                # Market orders never rest: the unfilled remainder is cancelled
+                cancelled.append(order)
+
+    def settle(self, conn, fills, touched, cancelled):
         cursor = conn.cursor()
-        previous_hash = self.chain[index]["previous_hash"] if index < len(self.chain) else "0" * 64
-        new_hash = hashlib.sha256(f"{previous_hash}{index}{new_message}".encode('utf-8')).hexdigest()
-        cursor.execute('UPDATE blocks SET message = %s, hash = %s, timestamp = %s WHERE "index" = %s',
-                       (new_message, new_hash, datetime.now().isoformat(), index))
+        trades, puk_credits, coin_credits = settlement_credits(fills, cancelled)
+        cancelled_ids = set()
+        for order in cancelled:
+            cancelled_ids.add(order.id)
+            touched[order.id] = order
+
+        if trades:
+            execute_values(cursor, '''
+                INSERT INTO trades (buy_order_id, sell_order_id, buyer_id, seller_id, price, quantity) VALUES %s
+            ''', trades)
+            # Same clock as the trades' executed_at default, so candles match a backfill from the table
+            cursor.execute('SELECT (EXTRACT(EPOCH FROM CURRENT_TIMESTAMP) * 1000)::bigint')
+            executed_ms = cursor.fetchone()[0]
+            if not self.candles.loaded:
+                self.candles.load(cursor)
+            for trade in trades:
+                self.candles.add(executed_ms, trade[4], trade[5])
+            self.candles.flush(cursor)
+        execute_batch(cursor, 'UPDATE orders SET remaining = %s, status = %s, booked = TRUE, updated_at = now() WHERE id = %s',
+                      [(max(order.remaining, 0.0), order_status(order, order.id in cancelled_ids), order.id)
+                       for order in sorted(touched.values(), key=lambda o: o.id)])
+        execute_batch(cursor, 'UPDATE users SET puk_balance = puk_balance + %s WHERE id = %s',
+                      [(amount, user_id) for user_id, amount in sorted(puk_credits.items()) if amount > QUANTITY_EPSILON])
+        payouts = {user_id: amount for user_id, amount in coin_credits.items() if amount > QUANTITY_EPSILON}
+        if payouts:
+            cursor.execute('''
+                SELECT DISTINCT ON (user_id) user_id, wallet_address FROM wallets
+                WHERE user_id = ANY(%s) ORDER BY user_id, id
+            ''', (list(payouts),))
+            wallets = dict(cursor.fetchall())
+            record_transactions(cursor, [(ORDERBOOK_ESCROW, wallets[user_id], amount, None)
+                                         for user_id, amount in sorted(payouts.items())])
+        if trades:
+            notify(cursor, PUK_PRICE_CHANNEL, str(trades[-1][4]))
         conn.commit()
-        conn.close()
-        for block in self.chain:
-            if block["index"] == index:
-                block["message"] = new_message
-                block["hash"] = new_hash
-                block["timestamp"] = datetime.now().isoformat()
+        for user_id in set(puk_credits) | set(payouts):
+            identity_cache.invalidate(user_identity_key(user_id))
+        return len(trades)
+
+
+def place_order(conn, user_id, side, kind, quantity, price=None):
+    """Reserve funds for a PUK order and queue it for the matcher.
+
+    Returns (order id, None) or (None, error message); nothing is written on error.
+    """
+    if side not in ('buy', 'sell') or kind not in ('limit', 'market'):
+        return None, 'Unknown order type.'
+    # float() accepts 'nan' and 'inf', which compare False against 0 and would reach the book
+    if (not quantity or not math.isfinite(quantity) or quantity <= 0
+            or (kind == 'limit' and (not price or not math.isfinite(price) or price <= 0))):
+        return None, 'Quantity and limit price must be positive.'
+    cursor = conn.cursor()
+    if kind == 'limit':
+        reserve_price = price
+    else:
+        price = None
+        collar = 1 + MARKET_ORDER_COLLAR if side == 'buy' else 1 - MARKET_ORDER_COLLAR
+        reserve_price = last_puk_price(cursor) * collar
+    if side == 'sell':
+        cursor.execute('UPDATE users SET puk_balance = puk_balance - %s WHERE id = %s AND puk_balance >= %s RETURNING id',
+                       (quantity, user_id, quantity))
+        if cursor.fetchone() is None:
+            conn.rollback()
+            return None, 'Insufficient PUK balance.'
+    else:
+        cost = quantity * reserve_price
+        cursor.execute('SELECT wallet_address, balance FROM wallets WHERE user_id = %s ORDER BY id LIMIT 1 FOR UPDATE',
+                       (user_id,))
+        wallet = cursor.fetchone()
+        if wallet is None or (wallet[1] or 0) < cost:
+            conn.rollback()
+            return None, f'Insufficient coin balance: {cost:.2f} needed.'
+        record_transaction(cursor, wallet[0], ORDERBOOK_ESCROW, cost)
+    cursor.execute('''
+        INSERT INTO orders (user_id, side, kind, price, reserve_price, quantity, remaining)
+        VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
+    ''', (user_id, side, kind, price, reserve_price, quantity, quantity))
+    order_id = cursor.fetchone()[0]
+    cursor.execute('NOTIFY ' + ORDER_CHANNEL)
+    conn.commit()
+    return order_id, None
+
+
+def request_order_cancel(conn, user_id, order_id):
+    """Ask the matcher to cancel one of the user's live orders; False if there is no such order."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE orders SET cancel_requested = TRUE
+        WHERE id = %s AND user_id = %s AND status IN ('open', 'partial') RETURNING id
+    ''', (order_id, user_id))
+    found = cursor.fetchone() is not None
+    if found:
+        cursor.execute('NOTIFY ' + ORDER_CHANNEL)
+    conn.commit()
+    return found
+
+
+def order_book_depth(cursor, depth=ORDER_BOOK_DEPTH):
+    """Aggregated resting quantity at the best ``depth`` price levels: {'buy': [(price, qty)], 'sell': [...]}."""
+    book = {}
+    for side, direction in (('buy', 'DESC'), ('sell', 'ASC')):
+        cursor.execute('''
+            SELECT price, SUM(remaining) FROM orders
+            WHERE side = %s AND kind = 'limit' AND status IN ('open', 'partial') AND NOT cancel_requested
+            GROUP BY price ORDER BY price {} LIMIT %s
+        '''.format(direction), (side, depth))
+        book[side] = cursor.fetchall()
+    return book
+
+
+def bootstrap_database():
+    """Apply pending schema migrations, then make sure the admin user and genesis block exist."""
+    conn = get_db()
+    applied = run_migrations(conn)
+    for version, description in applied:
+        print(f"Applied migration {version}: {description}")
+    ensure_admin_user(conn)
+    if not blockchain.load_blocks_from_db():
+        blockchain.create_genesis_block()
+        print("Created genesis block")
+    return applied
+
+
+def warm_chain_cache(write_snapshot=True):
+    """Sync the chain cache (from the snapshot plus a top-up) and refresh the snapshot file."""
+    conn = get_db()
+    chain_cache.sync(conn)
+    count = 0
+    if write_snapshot and chain_cache.snapshot_path:
+        count = chain_cache.save_snapshot()
+        # Re-open from the file so forked workers share its pages instead of the parsed dicts
+        chain_cache.reset()
+        chain_cache.sync(conn)
+    return count
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations (run once per deploy)."""
+    if not bootstrap_database():
+        print("Schema is up to date")
+
+
+@app.cli.command('snapshot-chain')
+@click.option('--path', default=CHAIN_SNAPSHOT_FILE, show_default=True, help='Snapshot file to write.')
+def snapshot_chain_command(path):
+    """Write the chain to an on-disk snapshot that workers map at startup."""
+    chain_cache.sync(get_db())
+    count = chain_cache.save_snapshot(path)
+    print(f"Wrote {count} block(s) to {path}")
+
+
+@app.cli.command('verify-chain')
+@click.option('--full', is_flag=True, help='Ignore checkpoints and verify from genesis.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Hashing processes.')
+@click.option('--batch-size', default=VERIFY_BATCH_SIZE, show_default=True, help='Blocks per batch.')
+def verify_chain_command(full, workers, batch_size):
+    """Verify block hashes and links, resuming from the last signed checkpoint."""
+    if not CHECKPOINT_SECRET:
+        print("CHECKPOINT_SECRET is not set: verifying from genesis without storing a checkpoint")
+    result = verify_chain(get_db(), full=full, workers=workers, batch_size=batch_size)
+    print(json.dumps(result, indent=2))
+    if not result["ok"]:
+        raise SystemExit(1)
+
+
+@app.cli.command('produce-blocks')
+@click.option('--max-transactions', default=BLOCK_MAX_TRANSACTIONS, show_default=True, help='Transactions per sealed block.')
+@click.option('--interval', default=BLOCK_INTERVAL, show_default=True, help='Seconds a pending transaction may wait.')
+@click.option('--once', is_flag=True, help='Seal whatever is pending and exit.')
+def produce_blocks_command(max_transactions, interval, once):
+    """Seal pending transfers and trades into blocks by size or age."""
+    conn = get_db()
+    while True:
+        count, oldest_age = mempool_status(conn)
+        while count and (once or count >= max_transactions or oldest_age >= interval):
+            sealed = seal_pending_transactions(conn, max_transactions)
+            if sealed is None:
+                break
+            print(f"Sealed {sealed[1]} transaction(s) into block #{sealed[0]}")
+            count -= sealed[1]
+            if count < max_transactions and not once:
                 break
+        if once:
+            return
+        time.sleep(min(interval, 1.0))
 
-    def give_reward(self):
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO transactions (from_address, to_address, amount) VALUES (%s, %s, %s)',
-                       ("system", self.wallet_address, self.reward_amount))
-        cursor.execute('UPDATE users SET puk_balance = puk_balance + %s WHERE id = (SELECT user_id FROM wallets WHERE wallet_address = %s)',
-                       (self.reward_amount, self.wallet_address))
+
+@app.cli.command('match-orders')
+def match_orders_command():
+    """Run the PUK matching engine (one per database), woken by NOTIFY on new orders and cancels."""
+    listener = psycopg2.connect(**DB_CONFIG)
+    listener.autocommit = True
+    cursor = listener.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s)', (MATCHER_LOCK_ID,))
+    if not cursor.fetchone()[0]:
+        raise SystemExit("Another matcher is already running")
+    cursor.execute('LISTEN ' + ORDER_CHANNEL)
+    engine = MatchingEngine()
+    print("Matcher started, replaying live orders")
+    while True:
+        started = time.perf_counter()
+        try:
+            processed = engine.run_batch(get_db())
+        except psycopg2.Error as e:
+            app.logger.warning("Matching batch failed, rebuilding the book from the database: %s", e)
+            # The book may hold orders the aborted batch never settled
+            engine.recover()
+            conn = g.get('db')
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+                if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    # Borrow a fresh connection on the next attempt
+                    g.pop('db')
+                    g.pop('db_pool', db_pool).putconn(conn, close=True)
+            time.sleep(1)
+            continue
+        if processed:
+            print(f"Matched {processed} order(s) in {(time.perf_counter() - started) * 1000:.1f} ms")
+        if processed == MATCH_BATCH_SIZE:
+            continue
+        if select.select([listener], [], [], MATCH_POLL_INTERVAL)[0]:
+            listener.poll()
+            listener.notifies.clear()
+
+
+@app.cli.command('reconcile-balances')
+@click.option('--fix', is_flag=True, help='Overwrite drifted wallet balances with the ledger totals.')
+@click.option('--tolerance', default=0.001, show_default=True, help='Absolute drift ignored as REAL rounding.')
+def reconcile_balances_command(fix, tolerance):
+    """Recompute every wallet balance from the ledger and report drift."""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT w.wallet_address, w.balance, COALESCE(l.balance, 0)
+        FROM wallets w
+        LEFT JOIN ({}) l ON l.address = w.wallet_address
+        WHERE abs(COALESCE(w.balance, 0) - COALESCE(l.balance, 0)) > %s
+        ORDER BY w.wallet_address
+    '''.format(LEDGER_BALANCES_QUERY), (tolerance,))
+    drifted = cursor.fetchall()
+    for wallet_address, stored, ledger in drifted:
+        print(f"{wallet_address}: stored {stored} ledger {ledger} drift {(stored or 0) - ledger}")
+    if fix and drifted:
+        cursor.executemany('UPDATE wallets SET balance = %s WHERE wallet_address = %s',
+                           [(ledger, wallet_address) for wallet_address, _, ledger in drifted])
         conn.commit()
-        conn.close()
+        print(f"Fixed {len(drifted)} wallet balance(s)")
+    elif not drifted:
+        print("All wallet balances match the ledger")
 
-    def view_transactions(self):
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, timestamp, from_address, to_address, amount, block_index FROM transactions')
-        transactions = [{"id": t[0], "timestamp": t[1], "from": t[2], "to": t[3], "amount": t[4], "block_index": t[5]} for t in cursor.fetchall()]
-        conn.close()
-        return transactions
+@app.cli.command('reconcile-stats')
+@click.option('--interval', default=0, show_default=True, help='Repeat every N seconds instead of running once.')
+def reconcile_stats_command(interval):
+    """Rebuild the platform_stats counters from their source tables and report drift."""
+    while True:
+        drifted = reconcile_platform_stats(get_db())
+        for name, (cached, actual) in drifted.items():
+            print(f"{name}: cached {cached} actual {actual} drift {cached - actual}")
+        if not drifted:
+            print("All platform counters match their tables")
+        if not interval:
+            break
+        time.sleep(interval)
 
-    def calculate_balance(self):
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT SUM(amount) FROM transactions WHERE to_address = %s', (self.wallet_address,))
-        incoming = cursor.fetchone()[0] or 0
-        cursor.execute('SELECT SUM(amount) FROM transactions WHERE from_address = %s', (self.wallet_address,))
-        outgoing = cursor.fetchone()[0] or 0
-        conn.close()
-        return incoming - outgoing
+# Live updates: every worker keeps one LISTEN connection and fans its
+# notifications out to that worker's /stream clients
+STREAM_EVENTS = {BLOCK_CHANNEL: 'block', TRANSACTION_CHANNEL: 'transaction',
+                 BTC_PRICE_CHANNEL: 'btc_price', PUK_PRICE_CHANNEL: 'puk_price'}
+STREAM_QUEUE_SIZE = 256
+STREAM_HEARTBEAT = 15.0
+STREAM_RETRY_MS = 3000
+STREAM_RECONNECT_DELAY = 2.0
+# Every open stream holds one server thread, so keep well under the gunicorn
+# thread count (gunicorn.conf.py defaults this to half of it) to leave threads
+# for ordinary requests; clients over the cap are told to retry later
+STREAM_MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', '32'))
+STREAM_BUSY_RETRY_MS = 30_000
 
-    def transfer_coins(self, to_address, amount):
-        balance = self.calculate_balance()
-        if balance < amount:
-            return False, "Insufficient balance"
-        if amount <= 0:
-            return False, "Amount must be greater than 0"
+
+class EventBroker:
+    """Relays NOTIFY payloads from a single listener thread to per-client queues.
+
+    The listener starts with the first subscriber (and again in a forked worker).
+    It always listens on the primary, since NOTIFY is not replicated. A client
+    whose queue fills up is sent a final None so its stream ends with a resync.
+    subscribe() returns None once ``max_clients`` streams are open in this worker.
+    """
+
+    def __init__(self, channels, max_clients):
+        self.channels = channels
+        self.max_clients = max_clients
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self):
+        subscriber = queue.Queue(STREAM_QUEUE_SIZE)
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    self._subscribers = set()
+                self._thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except (psycopg2.Error, OSError) as e:
+                app.logger.warning("Event listener lost its connection: %s", e)
+            time.sleep(STREAM_RECONNECT_DELAY)
+
+    def _listen(self):
         conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT wallet_address FROM wallets WHERE wallet_address = %s', (to_address,))
-        if not cursor.fetchone():
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            for channel in self.channels:
+                cursor.execute('LISTEN ' + channel)
+            while True:
+                if not select.select([conn], [], [], STREAM_HEARTBEAT)[0]:
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    self.publish(notification.channel, notification.payload)
+        finally:
             conn.close()
-            return False, "Recipient address does not exist"
-        cursor.execute('INSERT INTO transactions (from_address, to_address, amount) VALUES (%s, %s, %s)',
-                       (self.wallet_address, to_address, amount))
-        conn.commit()
-        conn.close()
-        return True, "Transfer successful"
 
-blockchain = Blockchain()
+    def publish(self, channel, payload):
+        event = STREAM_EVENTS[channel]
+        # Ledger rows are filtered per client by wallet address, so decode them once here
+        rows = json.loads(payload) if channel == TRANSACTION_CHANNEL else None
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, payload, rows))
+            except queue.Full:
+                self.unsubscribe(subscriber)
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait(None)
+
+
+event_broker = EventBroker(list(STREAM_EVENTS), STREAM_MAX_CLIENTS)
+
+
+def stream_events(events, wallet_address):
+    """Server-Sent Events for one client; ledger rows are limited to those touching ``wallet_address``.
+
+    The client subscribes only once the response is actually being sent, so an
+    abandoned response never holds a subscriber slot.
+    """
+    subscriber = event_broker.subscribe()
+    if subscriber is None:
+        yield f"retry: {STREAM_BUSY_RETRY_MS}\n\n"
+        return
+    try:
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        while True:
+            try:
+                item = subscriber.get(timeout=STREAM_HEARTBEAT)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if item is None:
+                yield "event: resync\ndata: {}\n\n"
+                return
+            event, payload, rows = item
+            if event not in events:
+                continue
+            if rows is not None:
+                rows = [row for row in rows if wallet_address in (row[2], row[3])]
+                if not rows:
+                    continue
+                payload = json.dumps(rows)
+            yield f"event: {event}\ndata: {payload}\n\n"
+    finally:
+        event_broker.unsubscribe(subscriber)
+
 
 # ฟังก์ชันช่วยเหลือ
 def login_required(f):
@@ -308,39 +2982,120 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def user_identity_key(user_id):
+    return ('user', user_id)
+
+def current_user():
+    """Username, PUK balance and wallet of the logged-in user, or None.
+
+    Loaded at most once per request into g and shared across requests through
+    identity_cache until invalidate_user_context() is called for the user.
+    """
+    if 'user_id' not in session:
+        return None
+    if 'user_context' not in g:
+        user_id = session['user_id']
+        key = user_identity_key(user_id)
+        generation, user = identity_cache.get(key, key)
+        if user is None:
+            cursor = get_db().cursor()
+            cursor.execute('''
+                SELECT u.username, u.puk_balance, w.wallet_address, w.private_key
+                FROM users u
+                LEFT JOIN wallets w ON w.user_id = u.id
+                WHERE u.id = %s
+                ORDER BY w.id
+                LIMIT 1
+            ''', (user_id,))
+            row = cursor.fetchone()
+            user = {}
+            if row:
+                user = {"username": row[0], "puk_balance": row[1], "wallet_address": row[2], "private_key": row[3]}
+            identity_cache.set(key, generation, user, key)
+        g.user_context = user
+    return g.user_context or None
+
+def invalidate_user_context(user_id):
+    """Drop cached identity data for a user after a committed change to it."""
+    if user_id is None:
+        return
+    identity_cache.invalidate(user_identity_key(user_id))
+    if session.get('user_id') == user_id:
+        g.pop('user_context', None)
+
 def get_username():
     if 'user_id' in session:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT username FROM users WHERE id = %s', (session['user_id'],))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else "Unknown"
+        user = current_user()
+        return user["username"] if user else "Unknown"
     return None
 
 def is_admin():
     return session.get('is_admin', False)
 
 def get_blockchain():
-    if 'user_id' in session:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT wallet_address, private_key FROM wallets WHERE user_id = %s', (session['user_id'],))
-        wallet = cursor.fetchone()
-        conn.close()
-        if wallet:
-            return Blockchain(wallet[0], wallet[1])
+    user = current_user()
+    if user and user["wallet_address"]:
+        return Blockchain(user["wallet_address"], user["private_key"])
     return blockchain
 
 def get_puk_balance():
-    if 'user_id' in session:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT puk_balance FROM users WHERE id = %s', (session['user_id'],))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else 0.0
-    return 0.0
+    user = current_user()
+    return user["puk_balance"] if user else 0.0
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.query_log = []
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    queries = g.get('query_log', [])
+    REQUEST_SECONDS.labels(endpoint, request.method).observe(elapsed)
+    REQUESTS_TOTAL.labels(endpoint, request.method, str(response.status_code)).inc()
+    REQUEST_QUERIES.labels(endpoint).observe(len(queries))
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        print(f"Slow request: {request.method} {request.full_path} -> {response.status_code} in {elapsed * 1000:.1f} ms, "
+              f"{len(queries)} queries ({sum(t for _, t in queries) * 1000:.1f} ms)")
+        for query, seconds in queries:
+            print(f"  {seconds * 1000:8.2f} ms  {' '.join(query.split())[:300]}")
+    return response
+
+
+@app.after_request
+def stick_writer_to_primary(response):
+    # Read-your-writes: replicas may not have this request's writes yet
+    if replica_router.pools and request.method not in ('GET', 'HEAD', 'OPTIONS') and 'user_id' in session:
+        session['primary_until'] = time.time() + REPLICA_STICKY_SECONDS
+    return response
+
+
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_timers', []).append(time.perf_counter())
+
+
+def stop_template_timer(sender, template, context, **extra):
+    timers = g.get('template_timers')
+    if timers:
+        TEMPLATE_RENDER_SECONDS.labels(template.name or 'inline').observe(time.perf_counter() - timers.pop())
+
+
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(stop_template_timer, app)
+
+
+@app.route('/metrics')
+def metrics():
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
 # ลงทะเบียนฟังก์ชันใน Jinja environment
 app.jinja_env.globals.update(get_username=get_username, is_admin=is_admin)
 
@@ -356,7 +3111,7 @@ def register():
         password = request.form['password']
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
         try:
-            conn = psycopg2.connect(**DB_CONFIG)
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute('INSERT INTO users (username, password, puk_balance, is_admin) VALUES (%s, %s, %s, %s) RETURNING id',
                            (username, hashed_password, 0.0, False))
@@ -365,11 +3120,12 @@ def register():
             private_key = secrets.token_hex(32)
             cursor.execute('INSERT INTO wallets (wallet_address, private_key, balance, user_id) VALUES (%s, %s, %s, %s)',
                            (wallet_address, private_key, 0.0, user_id))
+            bump_platform_stat(cursor, 'users')
             conn.commit()
-            conn.close()
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('login'))
         except psycopg2.IntegrityError:
+            conn.rollback()
             flash('Username already exists.', 'danger')
     return render_template('register.html')
 
@@ -379,11 +3135,10 @@ def login():
         username = request.form['username']
         password = request.form['password']
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('SELECT id, is_admin FROM users WHERE username = %s AND password = %s', (username, hashed_password))
         user = cursor.fetchone()
-        conn.close()
         if user:
             session['user_id'] = user[0]
             session['is_admin'] = user[1]
@@ -395,11 +3150,10 @@ def login():
 
 @app.route('/register_admin', methods=['GET', 'POST'])
 def register_admin():
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = TRUE')
     admin_count = cursor.fetchone()[0]
-    conn.close()
     
     if admin_count > 0 and not session.get('is_admin', False):
         flash('Only existing admins can register new admins.', 'danger')
@@ -410,7 +3164,7 @@ def register_admin():
         password = request.form['password']
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
         try:
-            conn = psycopg2.connect(**DB_CONFIG)
+            conn = get_db()
             cursor = conn.cursor()
             cursor.execute('INSERT INTO users (username, password, puk_balance, is_admin) VALUES (%s, %s, %s, %s) RETURNING id',
                            (username, hashed_password, 0.0, True))
@@ -419,46 +3173,46 @@ def register_admin():
             private_key = secrets.token_hex(32)
             cursor.execute('INSERT INTO wallets (wallet_address, private_key, balance, user_id) VALUES (%s, %s, %s, %s)',
                            (wallet_address, private_key, 0.0, user_id))
+            bump_platform_stat(cursor, 'users')
             conn.commit()
-            conn.close()
             flash('Forged a new Crypto Samurai Admin! Please log in.', 'success')
             return redirect(url_for('login'))
         except psycopg2.IntegrityError:
+            conn.rollback()
             flash('Username already exists.', 'danger')
     return render_template('register_admin.html')
 
 @app.route('/admin_dashboard')
+@read_only
 @admin_required
 def admin_dashboard():
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT p.id, p.title, p.content, p.timestamp, u.username 
-        FROM posts p 
-        LEFT JOIN users u ON p.user_id = u.id 
-        ORDER BY p.timestamp DESC
-    ''')
-    posts = [
-        {"id": row[0], "title": row[1], "content": row[2], "timestamp": row[3], "username": row[4] or "None"}
-        for row in cursor.fetchall()
-    ]
-    cursor.execute('''
-        SELECT c.id, c.post_id, c.content, c.timestamp, u.username, p.title
-        FROM comments c 
-        LEFT JOIN users u ON c.user_id = u.id 
-        LEFT JOIN posts p ON c.post_id = p.id 
-        ORDER BY c.timestamp DESC
-    ''')
-    comments = [
-        {"id": row[0], "post_id": row[1], "content": row[2], "timestamp": row[3], "username": row[4] or "None", "post_title": row[5] or "Unknown"}
-        for row in cursor.fetchall()
-    ]
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM transactions')
-    total_transactions = cursor.fetchone()[0]
-    conn.close()
-    return render_template('admin_dashboard.html', posts=posts, comments=comments, total_users=total_users, total_transactions=total_transactions)
+    username = request.args.get('username', '').strip() or None
+    since = request.args.get('since', '').strip() or None
+    try:
+        since = datetime.strptime(since, '%Y-%m-%d') if since else None
+    except ValueError:
+        flash('Invalid date, expected YYYY-MM-DD.', 'danger')
+        since = None
+    posts_after = decode_timestamp_cursor(request.args.get('posts_after'))
+    comments_after = decode_timestamp_cursor(request.args.get('comments_after'))
+    posts, next_posts = fetch_moderation_page(cursor, 'posts', username, since, posts_after)
+    comments, next_comments = fetch_moderation_page(cursor, 'comments', username, since, comments_after)
+    stats = get_platform_stats(cursor, 'users', 'transactions', 'posts', 'comments', 'minted')
+    return render_template('admin_dashboard.html', posts=posts, comments=comments, stats=stats,
+                           username=username or '', since=request.args.get('since', ''),
+                           next_posts=next_posts, next_comments=next_comments)
+
+@app.route('/admin/pool_stats')
+@admin_required
+def pool_stats():
+    return jsonify(db_pool.get_stats())
+
+@app.route('/admin/verify_chain', methods=['POST'])
+@admin_required
+def admin_verify_chain():
+    return jsonify(verify_chain(get_db(), full=request.args.get('full') == '1'))
 
 @app.route('/logout')
 def logout():
@@ -470,81 +3224,95 @@ def logout():
 @app.route('/board/delete_post/<int:post_id>', methods=['POST'])
 @admin_required
 def delete_post(post_id):
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT id FROM posts WHERE id = %s', (post_id,))
     if not cursor.fetchone():
-        conn.close()
         flash('Post not found.', 'danger')
         return redirect(url_for('board'))
     cursor.execute('DELETE FROM comments WHERE post_id = %s', (post_id,))
+    if cursor.rowcount:
+        bump_platform_stat(cursor, 'comments', -cursor.rowcount)
     cursor.execute('DELETE FROM posts WHERE id = %s', (post_id,))
+    bump_platform_stat(cursor, 'posts', -1)
     conn.commit()
-    conn.close()
+    board_cache.invalidate(BOARD_LISTING_KEY)
+    board_cache.invalidate(post_thread_key(post_id))
     flash('Post and its comments slashed from the Dojo!', 'success')
     return redirect(url_for('board'))
 
 @app.route('/board/delete_comment/<int:comment_id>', methods=['POST'])
 @admin_required
 def delete_comment(comment_id):
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT id, post_id FROM comments WHERE id = %s', (comment_id,))
     comment = cursor.fetchone()
     if not comment:
-        conn.close()
         flash('Comment not found.', 'danger')
         return redirect(url_for('board'))
     post_id = comment[1]
     cursor.execute('DELETE FROM comments WHERE id = %s', (comment_id,))
+    bump_platform_stat(cursor, 'comments', -1)
     conn.commit()
-    conn.close()
+    board_cache.invalidate(post_thread_key(post_id))
     flash('Comment slashed from the Dojo!', 'success')
     return redirect(url_for('post_details', post_id=post_id))
 
 # ... (ส่วนที่เหลือของโค้ดเหมือนเดิม)
 
 @app.route('/blockchain', methods=['GET'])
+@read_only
 @login_required
 def blockchain_info():
-    blockchain = get_blockchain()
-    blockchain.load_blocks_from_db()
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = get_db()
     cursor = conn.cursor()
     page = request.args.get('page', 1, type=int)
-    per_page = 10
+    per_page = BLOCK_PAGE_SIZE
     if page < 1:
         page = 1
-    offset = (page - 1) * per_page
     sort_by = request.args.get('sort_by', 'index')
+    sort_by = sort_by if sort_by in ('index', 'owner') else 'index'
     sort_order = request.args.get('sort_order', 'asc')
-    valid_sort_columns = {'index': 'b."index"', 'owner': 'u.username'}
-    sort_column = valid_sort_columns.get(sort_by, 'b."index"')
     valid_sort_orders = ['asc', 'desc']
     sort_order = sort_order if sort_order in valid_sort_orders else 'asc'
-    query = '''
-        SELECT b."index", b.message, b.hash, u.username 
-        FROM blocks b 
-        LEFT JOIN users u ON b.owner_id = u.id 
-        ORDER BY {} {}
-        LIMIT %s OFFSET %s
-    '''.format(sort_column, sort_order.upper())
-    cursor.execute(query, (per_page, offset))
-    blocks = [{"index": row[0], "message": row[1], "hash": row[2], "owner": row[3] or "None"} for row in cursor.fetchall()]
-    cursor.execute('SELECT COUNT(*) FROM blocks')
-    total_blocks = cursor.fetchone()[0]
+    descending = sort_order == 'desc'
+    total_blocks = int(get_platform_stats(cursor, 'blocks')['blocks'])
     total_pages = (total_blocks + per_page - 1) // per_page
     if page > total_pages and total_blocks > 0:
         page = total_pages
-    conn.close()
+    next_cursor = prev_cursor = None
+    if sort_by == 'index':
+        blocks = fetch_blocks_by_index(cursor, page, descending, per_page)
+    else:
+        after = decode_cursor(request.args.get('after'))
+        before = decode_cursor(request.args.get('before'))
+        if before:
+            rows = fetch_blocks_by_owner(cursor, not descending, before, per_page + 1)
+            has_more_before = len(rows) > per_page
+            rows = rows[:per_page][::-1]
+        else:
+            rows = fetch_blocks_by_owner(cursor, descending, after, per_page + 1)
+            has_more_before = after is not None
+            if len(rows) > per_page:
+                rows = rows[:per_page]
+                next_cursor = encode_cursor(*rows[-1][0])
+        if before and rows:
+            next_cursor = encode_cursor(*rows[-1][0])
+        if has_more_before and rows:
+            prev_cursor = encode_cursor(*rows[0][0])
+        blocks = [block for _, block in rows]
     return render_template(
         'blockchain.html',
         blocks=blocks,
         page=page,
         total_pages=total_pages,
+        page_numbers=page_window(page, total_pages),
         sort_by=sort_by,
         sort_order=sort_order,
-        total_blocks=total_blocks
+        total_blocks=total_blocks,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor
     )
 # Sanitize ฟังก์ชันสำหรับป้องกัน XSS
 def sanitize_text(text):
@@ -552,42 +3320,25 @@ def sanitize_text(text):
     return clean(text, tags=allowed_tags, strip=True)
 
 @app.route('/board', methods=['GET'])
+@read_only
 @login_required
 def board():
-    conn = psycopg2.connect(**DB_CONFIG)
-    cursor = conn.cursor()
-
-    # รับค่าพารามิเตอร์สำหรับการแบ่งหน้า
-    page = request.args.get('page', 1, type=int)
-    per_page = 10
-    if page < 1:
-        page = 1
-    offset = (page - 1) * per_page
-
-    # ดึงกระทู้
-    query = '''
-        SELECT p.id, p.title, p.content, p.timestamp, u.username 
-        FROM posts p 
-        LEFT JOIN users u ON p.user_id = u.id 
-        ORDER BY p.timestamp DESC 
-        LIMIT %s OFFSET %s
-    '''
-    cursor.execute(query, (per_page, offset))
-    posts = [
-        {"id": row[0], "title": row[1], "content": row[2], "timestamp": row[3], "username": row[4] or "None"}
-        for row in cursor.fetchall()
-    ]
-
-    # คำนวณจำนวนหน้าทั้งหมด
-    cursor.execute('SELECT COUNT(*) FROM posts')
-    total_posts = cursor.fetchone()[0]
-    total_pages = (total_posts + per_page - 1) // per_page
-
-    if page > total_pages and total_posts > 0:
-        page = total_pages
-
-    conn.close()
-    return render_template('board.html', posts=posts, page=page, total_pages=total_pages, total_posts=total_posts)
+    # เคอร์เซอร์สำหรับการแบ่งหน้าแบบ keyset
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before'))
+    cache_key = ('board', repr(after), repr(before))
+    generation, page = board_cache.get(cache_key, BOARD_LISTING_KEY)
+    if page is None:
+        cursor = get_db().cursor()
+        try:
+            posts, newer_cursor, older_cursor = fetch_posts_page(cursor, after, before)
+        except (TypeError, ValueError, IndexError):
+            posts, newer_cursor, older_cursor = fetch_posts_page(cursor)
+        total_posts = int(get_platform_stats(cursor, 'posts')['posts'])
+        page = (posts, newer_cursor, older_cursor, total_posts)
+        board_cache.set(cache_key, generation, page, BOARD_LISTING_KEY)
+    posts, newer_cursor, older_cursor, total_posts = page
+    return render_template('board.html', posts=posts, newer_cursor=newer_cursor, older_cursor=older_cursor, total_posts=total_posts)
 
 @app.route('/board/new', methods=['GET', 'POST'])
 @login_required
@@ -602,57 +3353,33 @@ def new_post():
         sanitized_title = sanitize_text(title)
         sanitized_content = sanitize_text(content)
         
-        conn = psycopg2.connect(**DB_CONFIG)
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute(
             'INSERT INTO posts (title, content, user_id) VALUES (%s, %s, %s)',
             (sanitized_title, sanitized_content, session['user_id'])
         )
+        bump_platform_stat(cursor, 'posts')
         conn.commit()
-        conn.close()
+        board_cache.invalidate(BOARD_LISTING_KEY)
         flash('Post created successfully!')
         return redirect(url_for('board'))
     
     return render_template('new_post.html')
 
 @app.route('/board/<int:post_id>', methods=['GET', 'POST'])
+@read_only
 @login_required
 def post_details(post_id):
-    conn = psycopg2.connect(**DB_CONFIG)
-    cursor = conn.cursor()
-    
-    # ดึงข้อมูลกระทู้
-    cursor.execute(
-        'SELECT p.id, p.title, p.content, p.timestamp, u.username '
-        'FROM posts p LEFT JOIN users u ON p.user_id = u.id '
-        'WHERE p.id = %s',
-        (post_id,)
-    )
-    post_data = cursor.fetchone()
-    if not post_data:
-        conn.close()
-        flash('Post not found.')
-        return redirect(url_for('board'))
-    
-    post = {
-        "id": post_data[0],
-        "title": post_data[1],
-        "content": post_data[2],
-        "timestamp": post_data[3],
-        "username": post_data[4] or "None"
-    }
-    
-    # ดึงความคิดเห็น
-    cursor.execute(
-        'SELECT c.id, c.content, c.timestamp, u.username '
-        'FROM comments c LEFT JOIN users u ON c.user_id = u.id '
-        'WHERE c.post_id = %s ORDER BY c.timestamp ASC',
-        (post_id,)
-    )
-    comments = [
-        {"id": row[0], "content": row[1], "timestamp": row[2], "username": row[3] or "None"}
-        for row in cursor.fetchall()
-    ]
+    # ดึงข้อมูลกระทู้และความคิดเห็น (ผ่านแคช)
+    generation, thread = board_cache.get(post_thread_key(post_id), post_thread_key(post_id))
+    if thread is None:
+        thread = load_post_thread(get_db().cursor(), post_id)
+        if thread is None:
+            flash('Post not found.')
+            return redirect(url_for('board'))
+        board_cache.set(post_thread_key(post_id), generation, thread, post_thread_key(post_id))
+    post, comments = thread
     
     # จัดการการเพิ่มความคิดเห็น
     if request.method == 'POST':
@@ -661,46 +3388,72 @@ def post_details(post_id):
             flash('Comment content is required.')
         else:
             sanitized_content = sanitize_text(content)
+            conn = get_db()
+            cursor = conn.cursor()
             cursor.execute(
                 'INSERT INTO comments (post_id, user_id, content) VALUES (%s, %s, %s)',
                 (post_id, session['user_id'], sanitized_content)
             )
+            bump_platform_stat(cursor, 'comments')
             conn.commit()
+            board_cache.invalidate(post_thread_key(post_id))
             flash('Comment added successfully!')
             return redirect(url_for('post_details', post_id=post_id))
     
-    conn.close()
     return render_template('post_details.html', post=post, comments=comments)
 
 
+@app.route('/search')
+@read_only
+@login_required
+def search():
+    try:
+        query, kinds, after, limit = parse_search_args(request.args)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('search'))
+    hits, next_cursor = ([], None)
+    if query:
+        hits, next_cursor = search_content(get_db().cursor(), query, kinds, after, limit)
+    return render_template('search.html', query=query, kinds=kinds, all_kinds=SEARCH_KINDS,
+                           hits=hits, next_cursor=next_cursor)
+
+@app.route('/api/search')
+@read_only
+@login_required
+def api_search():
+    try:
+        query, kinds, after, limit = parse_search_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    hits, next_cursor = search_content(get_db().cursor(), query, kinds, after, limit)
+    for hit in hits:
+        hit["snippet"] = str(hit["snippet"])
+        hit["timestamp"] = hit["timestamp"].isoformat() if hit["timestamp"] else None
+    return jsonify({"results": hits, "next_cursor": next_cursor})
+
+
 @app.route('/block/<int:block_index>')
+@read_only
 @login_required
 def block_details(block_index):
     blockchain = get_blockchain()
     blockchain.load_blocks_from_db()
-    conn = psycopg2.connect(**DB_CONFIG)
+    cached_block = chain_cache.get(block_index)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT b."index", b.message, b.hash, b.previous_hash, b.timestamp, u.username, b.owner_id FROM blocks b LEFT JOIN users u ON b.owner_id = u.id WHERE b."index" = %s', (block_index,))
-    block_data = cursor.fetchone()
-    if block_data:
-        block = {
-            "index": block_data[0],
-            "message": block_data[1],
-            "hash": block_data[2],
-            "previous_hash": block_data[3],
-            "timestamp": block_data[4],
-            "owner": block_data[5] or "None",
-            "owner_id": block_data[6],
-            "transactions": []
-        }
-        cursor.execute('SELECT from_address, to_address, amount FROM transactions WHERE block_index = %s', (block_index,))
-        block["transactions"] = [{"from_address": tx[0], "to_address": tx[1], "amount": tx[2]} for tx in cursor.fetchall()]
+    if cached_block:
+        block = dict(cached_block, owner="None")
+        if block["owner_id"] is not None:
+            cursor.execute('SELECT username FROM users WHERE id = %s', (block["owner_id"],))
+            owner = cursor.fetchone()
+            block["owner"] = owner[0] if owner else "None"
         cursor.execute('SELECT u1.username, u2.username, h.timestamp, h.price FROM block_ownership_history h LEFT JOIN users u1 ON h.previous_owner_id = u1.id LEFT JOIN users u2 ON h.new_owner_id = u2.id WHERE h.block_index = %s', (block_index,))
         ownership_history = [{"previous_owner": row[0] or "None", "new_owner": row[1] or "None", "timestamp": row[2], "price": row[3]} for row in cursor.fetchall()]
-        conn.close()
         is_owner = block["owner_id"] == session['user_id']
         return render_template('block_details.html', block=block, ownership_history=ownership_history, is_owner=is_owner)
-    conn.close()
     flash('Block not found.')
     return redirect(url_for('blockchain_info'))
 
@@ -708,19 +3461,17 @@ def block_details(block_index):
 @login_required
 def edit_block(block_index):
     blockchain = get_blockchain()
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT message, owner_id FROM blocks WHERE "index" = %s', (block_index,))
     block = cursor.fetchone()
     
     if not block:
-        conn.close()
         flash('Block not found.')
         return redirect(url_for('blockchain_info'))
         
     current_message, owner_id = block
     if owner_id != session['user_id']:
-        conn.close()
         flash('You can only edit blocks you own.')
         return redirect(url_for('block_details', block_index=block_index))
 
@@ -728,18 +3479,16 @@ def edit_block(block_index):
         new_message = request.form['new_message']
         if not new_message:
             flash('Please enter a new message.')
-            conn.close()
             return redirect(url_for('edit_block', block_index=block_index))
             
         blockchain.update_block_message(block_index, new_message)
-        conn.close()
         flash(f'Successfully updated message for block #{block_index}')
         return redirect(url_for('block_details', block_index=block_index))
         
-    conn.close()
     return render_template('edit_block.html', block_index=block_index, current_message=current_message)
 
 @app.route('/wallet')
+@read_only
 @login_required
 def wallet_details():
     blockchain = get_blockchain()
@@ -747,17 +3496,13 @@ def wallet_details():
     wallet_address = None
     private_key = None
     balance = 0.0
-    if 'user_id' in session:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute('SELECT wallet_address, private_key FROM wallets WHERE user_id = %s', (session['user_id'],))
-        wallet = cursor.fetchone()
-        conn.close()
-        if wallet:
-            wallet_address, private_key = wallet
-            balance = blockchain.calculate_balance()
-    transactions = blockchain.view_transactions()
-    return render_template('wallet.html', wallet_address=wallet_address, private_key=private_key, balance=balance, puk_balance=puk_balance, transactions=transactions)
+    user = current_user()
+    if user and user["wallet_address"]:
+        wallet_address, private_key = user["wallet_address"], user["private_key"]
+        balance = blockchain.calculate_balance()
+    transactions, next_cursor = blockchain.view_transactions(request.args.get('cursor'))
+    return render_template('wallet.html', wallet_address=wallet_address, private_key=private_key, balance=balance, puk_balance=puk_balance,
+                           transactions=transactions, next_cursor=next_cursor)
 
 @app.route('/timecapsule', methods=['GET', 'POST'])
 @login_required
@@ -771,18 +3516,91 @@ def time_capsule():
     return render_template('timecapsule.html')
 
 @app.route('/transactions')
+@read_only
 @login_required
 def transactions():
-    blockchain = get_blockchain()
-    transactions = blockchain.view_transactions()
-    conn = psycopg2.connect(**DB_CONFIG)
+    address = request.args.get('address') or None
+    transactions, next_cursor = fetch_transactions(address, request.args.get('cursor'))
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    cursor.execute('SELECT SUM(amount) FROM transactions WHERE from_address = %s', ('system',))
-    total_coins = cursor.fetchone()[0] or 0
-    conn.close()
-    return render_template('transactions.html', transactions=transactions, total_users=total_users, total_coins=total_coins)
+    stats = get_platform_stats(cursor, 'users', 'minted')
+    total_users = int(stats['users'])
+    total_coins = stats['minted']
+    return render_template('transactions.html', transactions=transactions, total_users=total_users, total_coins=total_coins,
+                           address=address, next_cursor=next_cursor)
+
+@app.route('/api/transactions')
+@read_only
+@login_required
+def api_transactions():
+    blockchain = get_blockchain()
+    address = request.args.get('address', blockchain.wallet_address)
+    cursor_token = request.args.get('cursor')
+    if cursor_token and not decode_timestamp_cursor(cursor_token):
+        return jsonify({"error": "invalid cursor"}), 400
+    limit = min(max(request.args.get('limit', TRANSACTION_PAGE_SIZE, type=int), 1), TRANSACTION_PAGE_MAX)
+    transactions, next_cursor = fetch_transactions(address, cursor_token, limit)
+    for tx in transactions:
+        tx["timestamp"] = tx["timestamp"].isoformat()
+    return jsonify({"transactions": transactions, "next_cursor": next_cursor})
+
+@app.route('/transactions/export')
+@read_only
+@login_required
+def export_transactions():
+    blockchain = get_blockchain()
+    address = request.args.get('address', blockchain.wallet_address)
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+
+    def csv_line(values):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        return buffer.getvalue()
+
+    def generate():
+        if export_format == 'csv':
+            yield csv_line(["id", "timestamp", "from", "to", "amount", "block_index"])
+        for tx in iter_transactions(address):
+            tx["timestamp"] = tx["timestamp"].isoformat()
+            if export_format == 'csv':
+                yield csv_line([tx["id"], tx["timestamp"], tx["from"], tx["to"], tx["amount"], tx["block_index"]])
+            else:
+                yield json.dumps(tx) + "\n"
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f"transactions-{address or 'all'}.{export_format}"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/api/blocks')
+@read_only
+@login_required
+def api_blocks():
+    start = request.args.get('from', type=int)
+    end = request.args.get('to', type=int)
+    since = request.args.get('since', type=int)
+    if since is not None:
+        start = max(start if start is not None else 0, since + 1)
+    owner = request.args.get('owner') or None
+
+    def generate():
+        for block in iter_blocks(start, end, owner):
+            yield json.dumps(block) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/blocks/<int:block_index>')
+@read_only
+@login_required
+def api_block(block_index):
+    cursor = get_db().cursor()
+    cursor.execute(BLOCK_EXPORT_QUERY.format(filters='b."index" = %s'), (block_index,))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({"error": "block not found"}), 404
+    return jsonify(block_export_to_dict(row))
 
 @app.route('/details')
 @login_required
@@ -813,12 +3631,21 @@ def transfer():
 def trade():
     blockchain = get_blockchain()
     puk_balance = get_puk_balance()
-    puk_price = update_puk_price()
-    btc_price = float(requests.get(BINANCE_API_URL).json()['price'])
+    puk_price = last_puk_price()
+    btc_price = price_feed.get_price()
+    if btc_price is None:
+        flash('BTC price is temporarily unavailable.', 'warning')
 
     if request.method == 'POST':
-        action = request.form['action']
-        percentage = float(request.form['percentage']) / 100
+        action = request.form.get('action')
+        try:
+            percentage = float(request.form['percentage']) / 100
+        except (KeyError, ValueError):
+            flash('Percentage must be a valid number')
+            return redirect(url_for('trade'))
+        if action not in ('buy', 'sell') or not math.isfinite(percentage) or not 0 < percentage <= 1:
+            flash('Percentage must be between 0 and 100')
+            return redirect(url_for('trade'))
         amount_puk = puk_balance * percentage
 
         if action == 'buy':
@@ -826,24 +3653,30 @@ def trade():
             if cost_usdt > puk_balance * puk_price:
                 flash('Insufficient PUK balance')
             else:
-                conn = psycopg2.connect(**DB_CONFIG)
+                conn = get_db()
                 cursor = conn.cursor()
-                cursor.execute('UPDATE users SET puk_balance = puk_balance - %s WHERE id = %s', (amount_puk, session['user_id']))
-                cursor.execute('INSERT INTO transactions (from_address, to_address, amount) VALUES (%s, %s, %s)', (blockchain.wallet_address, "system", amount_puk))
-                conn.commit()
-                conn.close()
-                flash(f'Bought {amount_puk:.2f} PUK worth of BTC')
+                # The balance read above may be stale by now (another request, the matcher)
+                cursor.execute('UPDATE users SET puk_balance = puk_balance - %s WHERE id = %s AND puk_balance >= %s RETURNING id',
+                               (amount_puk, session['user_id'], amount_puk))
+                if cursor.fetchone() is None:
+                    conn.rollback()
+                    flash('Insufficient PUK balance')
+                else:
+                    record_transaction(cursor, blockchain.wallet_address, "system", amount_puk)
+                    conn.commit()
+                    invalidate_user_context(session['user_id'])
+                    flash(f'Bought {amount_puk:.2f} PUK worth of BTC')
 
         elif action == 'sell':
             if amount_puk > puk_balance:
                 flash('Insufficient PUK balance')
             else:
-                conn = psycopg2.connect(**DB_CONFIG)
+                conn = get_db()
                 cursor = conn.cursor()
                 cursor.execute('UPDATE users SET puk_balance = puk_balance + %s WHERE id = %s', (amount_puk, session['user_id']))
-                cursor.execute('INSERT INTO transactions (from_address, to_address, amount) VALUES (%s, %s, %s)', ("system", blockchain.wallet_address, amount_puk))
+                record_transaction(cursor, "system", blockchain.wallet_address, amount_puk)
                 conn.commit()
-                conn.close()
+                invalidate_user_context(session['user_id'])
                 flash(f'Sold {amount_puk:.2f} PUK')
 
         puk_balance = get_puk_balance()
@@ -856,65 +3689,95 @@ def trade():
 @app.route('/trade_puk', methods=['GET', 'POST'])
 @login_required
 def trade_puk():
-    blockchain = get_blockchain()
-    puk_balance = get_puk_balance()
-    puk_price = update_puk_price()
-
+    conn = get_db()
     if request.method == 'POST':
-        action = request.form['action']
-        percentage = float(request.form['percentage']) / 100
-        
-        if action == 'buy':
-            cost_usdt = puk_balance * percentage
-            amount_puk_to_buy = cost_usdt / puk_price
-            
-            if cost_usdt > puk_balance:
-                flash('Insufficient PUK balance to buy.')
-            else:
-                conn = psycopg2.connect(**DB_CONFIG)
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET puk_balance = puk_balance - %s WHERE id = %s', 
-                               (cost_usdt, session['user_id']))
-                cursor.execute('INSERT INTO transactions (from_address, to_address, amount) VALUES (%s, %s, %s)', 
-                               (blockchain.wallet_address, "system", amount_puk_to_buy))
-                conn.commit()
-                conn.close()
-                flash(f'Bought {amount_puk_to_buy:.2f} PUK for {cost_usdt:.2f} USDT')
+        try:
+            quantity = float(request.form['quantity'])
+            price = float(request.form['price']) if request.form.get('price') else None
+        except (KeyError, ValueError):
+            flash('Quantity and price must be valid numbers.')
+            return redirect(url_for('trade_puk'))
+        order_id, error = place_order(conn, session['user_id'], request.form.get('side'),
+                                      request.form.get('kind', 'limit'), quantity, price)
+        if error:
+            flash(error)
+        else:
+            invalidate_user_context(session['user_id'])
+            flash(f'Order #{order_id} placed.')
+        return redirect(url_for('trade_puk'))
 
-        elif action == 'sell':
-            current_puk_amount = puk_balance / puk_price
-            amount_puk_to_sell = current_puk_amount * percentage
-            
-            if amount_puk_to_sell > current_puk_amount:
-                flash('Insufficient PUK balance to sell.')
-            else:
-                proceeds_usdt = amount_puk_to_sell * puk_price
-                if proceeds_usdt > 1e18:
-                    flash('Sell amount exceeds maximum allowed value.')
-                else:
-                    conn = psycopg2.connect(**DB_CONFIG)
-                    cursor = conn.cursor()
-                    cursor.execute('UPDATE users SET puk_balance = puk_balance + %s WHERE id = %s', 
-                                  (proceeds_usdt, session['user_id']))
-                    cursor.execute('INSERT INTO transactions (from_address, to_address, amount) VALUES (%s, %s, %s)', 
-                                  ("system", blockchain.wallet_address, amount_puk_to_sell))
-                    conn.commit()
-                    conn.close()
-                    flash(f'Sold {amount_puk_to_sell:.2f} PUK for {proceeds_usdt:.2f} USDT')
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, side, kind, price, quantity, remaining, status, cancel_requested, created_at FROM orders
+        WHERE user_id = %s AND status IN ('open', 'partial')
+        ORDER BY id DESC LIMIT 50
+    ''', (session['user_id'],))
+    open_orders = [
+        {"id": row[0], "side": row[1], "kind": row[2], "price": row[3], "quantity": row[4], "remaining": row[5],
+         "status": 'cancelling' if row[7] else row[6], "created_at": row[8]}
+        for row in cursor.fetchall()
+    ]
+    cursor.execute('SELECT price, quantity, executed_at FROM trades ORDER BY id DESC LIMIT 20')
+    recent_trades = [{"price": row[0], "quantity": row[1], "executed_at": row[2]} for row in cursor.fetchall()]
+    return render_template('trade_puk.html', puk_balance=get_puk_balance(), puk_price=last_puk_price(cursor),
+                           coin_balance=get_blockchain().calculate_balance(cursor), depth=order_book_depth(cursor),
+                           open_orders=open_orders, recent_trades=recent_trades)
 
-        puk_balance = get_puk_balance()
-        if puk_balance < 0:
-            flash('Your account balance cannot go negative!')
-            return redirect(url_for('logout'))
+@app.route('/trade_puk/cancel/<int:order_id>', methods=['POST'])
+@login_required
+def cancel_order(order_id):
+    if request_order_cancel(get_db(), session['user_id'], order_id):
+        flash(f'Cancel requested for order #{order_id}.')
+    else:
+        flash('Order not found or already closed.')
+    return redirect(url_for('trade_puk'))
+
+@app.route('/stream')
+@login_required
+def stream():
+    events = set(request.args.get('events', ','.join(STREAM_EVENTS.values())).split(','))
+    user = current_user()
+    wallet_address = user["wallet_address"] if user else None
+    # The stream can stay open for hours, so give the pooled connection back now
+    release_db(None)
+    return Response(stream_events(events, wallet_address), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/klines/PUK/<timeframe>')
+@read_only
+def get_puk_klines(timeframe):
+    if timeframe not in PUK_KLINE_INTERVAL_MS:
+        return jsonify({'error': f"timeframe must be one of {', '.join(PUK_KLINE_INTERVAL_MS)}"}), 400
+    try:
+        # args.get(type=int) would turn a malformed value into None, i.e. the default range
+        start = int(request.args['start']) if 'start' in request.args else None
+        end = int(request.args['end']) if 'end' in request.args else None
+        limit = min(max(int(request.args.get('limit', KLINES_LIMIT)), 1), PUK_KLINES_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'start, end and limit must be integers'}), 400
+    candles = puk_candles(timeframe, start, end, limit)
+    response = jsonify(candles)
+    last = candles[-1] if candles else None
+    response.set_etag(hashlib.sha1(f"PUK:{timeframe}:{start}:{end}:{len(candles)}:{last}".encode()).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = PUK_KLINES_MAX_AGE
+    return response.make_conditional(request)
 
-    return render_template('trade_puk.html', puk_balance=puk_balance, puk_price=puk_price)
 
 @app.route('/api/klines/<timeframe>')
 def get_klines(timeframe):
-    intervals = {'1m': '1m', '5m': '5m', '30m': '30m', '1h': '1h', '4h': '4h', '8h': '8h', '1w': '1w'}
-    params = {'symbol': 'BTCUSDT', 'interval': intervals.get(timeframe, '1h'), 'limit': 100}
-    response = requests.get(BINANCE_KLINES_URL, params=params)
-    return jsonify(response.json())
+    if timeframe not in KLINE_INTERVAL_MS and timeframe not in KLINE_ROLLUPS:
+        timeframe = '1h'
+    candles = kline_store.candles(timeframe)
+    response = jsonify(candles)
+    last = candles[-1] if candles else None
+    response.set_etag(hashlib.sha1(f"{timeframe}:{len(candles)}:{last}".encode()).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = int(KLINES_REFRESH_INTERVAL)
+    return response.make_conditional(request)
 
 if __name__ == "__main__":
+    with app.app_context():
+        bootstrap_database()
     app.run(host='0.0.0.0', port=5111, debug=True)
\ No newline at end of file
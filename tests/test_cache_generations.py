@@ -0,0 +1,71 @@
+"""SharedGenerations counters and GenerationalLRUCache, through a file in a temporary directory."""
+import threading
+import time
+
+from main import GenerationalLRUCache, SharedGenerations
+
+
+def test_bump_is_seen_through_another_handle(tmp_path):
+    path = str(tmp_path / 'generations')
+    writer, reader = SharedGenerations(path, 64), SharedGenerations(path, 64)
+    assert reader.get(('post', 1)) == 0
+    writer.bump(('post', 1))
+    writer.bump(('post', 1))
+    assert reader.get(('post', 1)) == 2
+    assert reader.slot(('post', 2)) != reader.slot(('post', 1))
+    assert reader.get(('post', 2)) == 0
+
+
+def test_concurrent_bumps_are_not_lost(tmp_path):
+    path = str(tmp_path / 'generations')
+    handles = [SharedGenerations(path, 64) for _ in range(4)]
+
+    def bump(handle):
+        for _ in range(250):
+            handle.bump(('board',))
+
+    threads = [threading.Thread(target=bump, args=(handle,)) for handle in handles]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert SharedGenerations(path, 64).get(('board',)) == 1000
+
+
+def test_bump_records_its_time(tmp_path):
+    generations = SharedGenerations(str(tmp_path / 'generations'), 64)
+    assert generations.bumped_at(('board',)) == 0
+    before = time.time()
+    generations.bump(('board',))
+    assert before <= generations.bumped_at(('board',)) <= time.time()
+
+
+def test_cache_entry_goes_stale_on_bump(tmp_path):
+    generations = SharedGenerations(str(tmp_path / 'generations'), 64)
+    cache = GenerationalLRUCache(2, generations)
+    generation, value = cache.get('page', ('board',))
+    assert value is None
+    cache.set('page', generation, 'rows', ('board',))
+    assert cache.get('page', ('board',)) == (generation, 'rows')
+    # Another worker's write, through its own handle
+    SharedGenerations(generations.path, 64).bump(('board',))
+    assert cache.get('page', ('board',))[1] is None
+
+
+def test_result_read_before_a_bump_is_not_served(tmp_path):
+    generations = SharedGenerations(str(tmp_path / 'generations'), 64)
+    cache = GenerationalLRUCache(2, generations)
+    generation, _ = cache.get('page', ('board',))
+    cache.invalidate(('board',))
+    cache.set('page', generation, 'rows read before the write committed', ('board',))
+    assert cache.get('page', ('board',))[1] is None
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = GenerationalLRUCache(2, SharedGenerations(str(tmp_path / 'generations'), 64))
+    for key in ('a', 'b'):
+        cache.set(key, 0, key, (key,))
+    cache.get('a', ('a',))
+    cache.set('c', 0, 'c', ('c',))
+    assert cache.get('b', ('b',))[1] is None
+    assert cache.get('a', ('a',))[1] == 'a'
@@ -0,0 +1,135 @@
+"""ChainSnapshot files and ChainCache adopting and topping them up, against an in-memory blocks table."""
+import os
+from datetime import datetime
+
+import pytest
+
+from main import ChainCache, ChainSnapshot
+
+
+def block_row(index, version=None, message=None):
+    """A row as ChainCache.SYNC_QUERY returns it."""
+    return (index, message or f'block {index}', f'{index + 1:064x}', f'{index:064x}',
+            datetime(2025, 1, 1, 0, index % 60, 0, 1000), None if index % 3 else 4, version or index + 1,
+            [['system', f'w{index}', 1.5]] if index % 2 else [])
+
+
+def as_block(row):
+    return {"index": row[0], "message": row[1], "hash": row[2], "previous_hash": row[3], "timestamp": row[4],
+            "owner_id": row[5], "transactions": [{"from_address": f, "to_address": t, "amount": a} for f, t, a in row[7]]}
+
+
+class BlocksTable:
+    """Connection stand-in answering ChainCache's tip check and sync query."""
+
+    def __init__(self, rows):
+        self.rows = {row[0]: row for row in rows}
+        self.synced = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params):
+        if query == ChainCache.SYNC_QUERY:
+            last_index, max_version = params
+            self.result = [row for index, row in sorted(self.rows.items()) if index > last_index or row[6] > max_version]
+            self.synced.extend(row[0] for row in self.result)
+        else:
+            self.result = [(self.rows[params[0]][2],)] if params[0] in self.rows else []
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'chain.snapshot')
+
+
+def test_write_and_open_round_trip(path, monkeypatch):
+    monkeypatch.setattr(ChainSnapshot, 'OFFSET_BATCH', 3)
+    rows = [block_row(index) for index in range(10)]
+    assert ChainSnapshot.write(path, (as_block(row) for row in rows), 10, 10) == 10
+    snapshot = ChainSnapshot.open(path)
+    assert (snapshot.last_index, snapshot.max_version, snapshot.count) == (9, 10, 10)
+    assert [snapshot.block(index) for index in range(10)] == [as_block(row) for row in rows]
+
+
+def test_open_rejects_missing_and_foreign_files(path):
+    assert ChainSnapshot.open(path) is None
+    with open(path, 'wb') as f:
+        f.write(b'CLCHAIN1' + bytes(64))
+    assert ChainSnapshot.open(path) is None
+
+
+def test_append_keeps_existing_bytes(path):
+    ChainSnapshot.write(path, (as_block(block_row(index)) for index in range(4)), 4, 4)
+    with open(path, 'rb') as f:
+        before = f.read()
+    snapshot = ChainSnapshot.open(path)
+    assert snapshot.append(path, (as_block(block_row(index)) for index in range(4, 7)), 7, 7) == 7
+    reopened = ChainSnapshot.open(path)
+    assert reopened.count == 7
+    assert [reopened.block(index) for index in range(7)] == [as_block(block_row(index)) for index in range(7)]
+    # An older handle still reads its own blocks, and a second append through it is refused
+    assert snapshot.block(3) == as_block(block_row(3))
+    assert snapshot.append(path, iter([]), 7, 7) is None
+    with open(path, 'rb') as f:
+        after = f.read()
+    records_start = ChainSnapshot.HEADER.size + (snapshot.capacity + 1) * 8
+    assert after[records_start:len(before)] == before[records_start:]
+
+
+def test_append_refused_when_full(path, monkeypatch):
+    monkeypatch.setattr(ChainSnapshot, 'MIN_CAPACITY', 4)
+    ChainSnapshot.write(path, (as_block(block_row(index)) for index in range(2)), 2, 2)
+    snapshot = ChainSnapshot.open(path)
+    assert snapshot.capacity == 4
+    assert snapshot.append(path, (as_block(block_row(index)) for index in range(2, 5)), 5, 5) is None
+
+
+def test_cache_adopts_snapshot_and_tops_up(path):
+    table = BlocksTable([block_row(index) for index in range(6)])
+    cache = ChainCache(path).sync(table)
+    assert cache.save_snapshot() == 6
+
+    table.rows.update({index: block_row(index) for index in range(6, 9)})
+    table.synced.clear()
+    cache = ChainCache(path).sync(table)
+    assert table.synced == [6, 7, 8]
+    assert cache.snapshot.count == 6
+    assert [cache.get(index) for index in range(9)] == [as_block(table.rows[index]) for index in range(9)]
+
+    inode = os.stat(path).st_ino
+    assert cache.save_snapshot() == 9
+    assert os.stat(path).st_ino == inode, "new blocks are appended in place"
+    snapshot = ChainSnapshot.open(path)
+    assert [snapshot.block(index) for index in range(9)] == [as_block(table.rows[index]) for index in range(9)]
+
+
+def test_edit_below_the_snapshot_rewrites_it(path):
+    table = BlocksTable([block_row(index) for index in range(5)])
+    ChainCache(path).sync(table).save_snapshot()
+    table.rows[2] = block_row(2, version=20, message='edited')
+    cache = ChainCache(path).sync(table)
+    assert cache.get(2)["message"] == 'edited'
+
+    inode = os.stat(path).st_ino
+    assert cache.save_snapshot() == 5
+    assert os.stat(path).st_ino != inode
+    snapshot = ChainSnapshot.open(path)
+    assert snapshot.block(2)["message"] == 'edited'
+    assert snapshot.max_version == 20
+
+
+def test_snapshot_with_a_different_tip_is_ignored(path):
+    table = BlocksTable([block_row(index) for index in range(3)])
+    ChainCache(path).sync(table).save_snapshot()
+    table.rows[2] = block_row(2, message='rewritten')[:2] + ('f' * 64,) + block_row(2)[3:]
+    table.synced.clear()
+    cache = ChainCache(path).sync(table)
+    assert cache.snapshot is None
+    assert table.synced == [0, 1, 2]
@@ -0,0 +1,52 @@
+"""CompactChain column storage round trips."""
+from datetime import datetime
+
+from main import CompactChain
+
+
+def stored(chain, index, message='m', block_hash=None, previous_hash=None, owner_id=7, transactions=()):
+    block_hash = block_hash or f'{index + 1:064x}'
+    previous_hash = previous_hash or f'{index:064x}'
+    timestamp = datetime(2025, 1, 2, 3, 4, 5, 678901)
+    chain.put(index, message, block_hash, previous_hash, timestamp, owner_id, list(transactions))
+    return {"index": index, "message": message, "hash": block_hash, "previous_hash": previous_hash,
+            "timestamp": timestamp, "owner_id": owner_id,
+            "transactions": [{"from_address": f, "to_address": t, "amount": a} for f, t, a in transactions]}
+
+
+def test_round_trip():
+    chain = CompactChain()
+    block = stored(chain, 0, 'hello', transactions=[('system', 'w1', 10.0), ('w1', 'w2', 2.5)])
+    assert chain.get(0) == block
+    assert len(chain) == 1
+
+
+def test_odd_hashes_and_no_owner():
+    chain = CompactChain()
+    block = stored(chain, 0, block_hash='Genesis', previous_hash='0' * 64, owner_id=None)
+    assert chain.get(0) == block
+
+
+def test_base_offset_and_missing_blocks():
+    chain = CompactChain(base=100)
+    block = stored(chain, 102)
+    assert chain.get(102) == block
+    assert chain.get(101) is None
+    assert chain.get(99) is None
+    assert chain.get(103) is None
+    assert not chain.complete(103)
+    stored(chain, 100)
+    stored(chain, 101)
+    assert chain.complete(103)
+
+
+def test_edit_replaces_the_block_and_its_transactions():
+    chain = CompactChain()
+    stored(chain, 0, transactions=[('a', 'b', 1.0)])
+    stored(chain, 1, transactions=[('b', 'c', 2.0)])
+    same_count = stored(chain, 0, 'edited', transactions=[('x', 'y', 3.0)])
+    more = stored(chain, 1, 'edited too', block_hash='f' * 64, transactions=[('c', 'd', 4.0), ('d', 'e', 5.0)])
+    assert chain.get(0) == same_count
+    assert chain.get(1) == more
+    fewer = stored(chain, 1, block_hash='Odd', transactions=[])
+    assert chain.get(1) == fewer
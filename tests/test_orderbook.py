@@ -0,0 +1,146 @@
+"""OrderBook matching and MatchingEngine settlement accounting, without a database."""
+import pytest
+
+from main import BookOrder, MatchingEngine, OrderBook, order_status, settlement_credits
+
+
+def limit(order_id, user_id, side, price, quantity):
+    return BookOrder(order_id, user_id, side, 'limit', price, price, quantity)
+
+
+def market(order_id, user_id, side, reserve_price, quantity):
+    return BookOrder(order_id, user_id, side, 'market', None, reserve_price, quantity)
+
+
+def row(order, cancel_requested=False, status='open'):
+    """An orders-table row as MatchingEngine.run_batch reads it."""
+    return (order.id, order.user_id, order.side, order.kind, order.price, order.reserve_price, order.remaining,
+            cancel_requested, status)
+
+
+def test_best_price_fills_first_at_the_makers_price():
+    book = OrderBook()
+    book.submit(limit(1, 10, 'sell', 1.10, 5))
+    book.submit(limit(2, 11, 'sell', 1.00, 5))
+    fills = book.submit(limit(3, 12, 'buy', 1.20, 7))
+    assert [(maker.id, quantity, price) for maker, quantity, price in fills] == [(2, 5, 1.00), (1, 2, 1.10)]
+    assert book.orders[1].remaining == pytest.approx(3)
+    assert 3 not in book.orders
+
+
+def test_same_price_fills_in_arrival_order():
+    book = OrderBook()
+    for order_id in (1, 2, 3):
+        book.submit(limit(order_id, 10 + order_id, 'buy', 1.00, 2))
+    fills = book.submit(limit(4, 20, 'sell', 1.00, 3))
+    assert [(maker.id, quantity) for maker, quantity, _ in fills] == [(1, 2), (2, 1)]
+    assert [order.id for order in book.levels['buy'][1.00]] == [2, 3]
+
+
+def test_limit_order_that_does_not_cross_rests():
+    book = OrderBook()
+    book.submit(limit(1, 10, 'sell', 1.10, 5))
+    assert book.submit(limit(2, 11, 'buy', 1.00, 5)) == []
+    assert book.best_price('buy') == 1.00
+    assert book.best_price('sell') == 1.10
+
+
+def test_market_order_never_rests():
+    book = OrderBook()
+    book.submit(limit(1, 10, 'sell', 1.00, 2))
+    order = market(2, 11, 'buy', 1.10, 5)
+    fills = book.submit(order)
+    assert [(maker.id, quantity) for maker, quantity, _ in fills] == [(1, 2)]
+    assert order.remaining == pytest.approx(3)
+    assert 2 not in book.orders
+    assert book.best_price('buy') is None
+
+
+def test_market_order_stops_at_its_collar():
+    book = OrderBook()
+    book.submit(limit(1, 10, 'sell', 1.00, 1))
+    book.submit(limit(2, 10, 'sell', 1.50, 1))
+    fills = book.submit(market(3, 11, 'buy', 1.10, 2))
+    assert [maker.id for maker, _, _ in fills] == [1]
+
+
+def test_cancel_removes_the_order_and_its_emptied_level():
+    book = OrderBook()
+    book.submit(limit(1, 10, 'sell', 1.00, 5))
+    book.submit(limit(2, 10, 'sell', 1.10, 5))
+    assert book.cancel(1).id == 1
+    assert book.cancel(1) is None
+    assert book.best_price('sell') == 1.10
+    fills = book.submit(limit(3, 11, 'buy', 1.05, 5))
+    assert fills == []
+
+
+def test_order_status():
+    order = limit(1, 10, 'buy', 1.00, 5)
+    assert order_status(order) == 'open'
+    order.filled = True
+    assert order_status(order) == 'partial'
+    assert order_status(order, cancelled=True) == 'cancelled'
+    order.remaining = 0
+    assert order_status(order, cancelled=True) == 'filled'
+
+
+def test_settlement_pays_seller_and_refunds_buyer_improvement():
+    seller = limit(1, 10, 'sell', 1.00, 5)
+    buyer = limit(2, 11, 'buy', 1.20, 5)
+    book = OrderBook()
+    book.submit(seller)
+    fills = [(buyer, maker, quantity, price) for maker, quantity, price in book.submit(buyer)]
+    trades, puk_credits, coin_credits = settlement_credits(fills, [])
+    assert trades == [(2, 1, 11, 10, 1.00, 5)]
+    assert puk_credits == {11: 5}
+    assert coin_credits[10] == pytest.approx(5.00)
+    # Reserved 5 * 1.20, paid 5 * 1.00
+    assert coin_credits[11] == pytest.approx(1.00)
+
+
+def test_settlement_returns_cancelled_reservations():
+    buy = limit(1, 10, 'buy', 1.20, 4)
+    sell = limit(2, 11, 'sell', 1.50, 3)
+    trades, puk_credits, coin_credits = settlement_credits([], [buy, sell])
+    assert trades == []
+    assert puk_credits == {11: 3}
+    assert coin_credits == {10: pytest.approx(4.80)}
+
+
+def test_engine_conserves_reserved_funds():
+    """Everything reserved by orders that end the batch filled or cancelled is paid back out."""
+    orders = [
+        limit(1, 10, 'sell', 1.00, 3),
+        limit(2, 11, 'sell', 1.05, 4),
+        limit(3, 12, 'buy', 1.10, 5),
+        market(4, 13, 'buy', 1.10, 6),
+        limit(5, 14, 'buy', 0.90, 2),
+    ]
+    reserved_coins = sum(order.remaining * order.reserve_price for order in orders if order.side == 'buy')
+    reserved_puk = sum(order.remaining for order in orders if order.side == 'sell')
+
+    engine = MatchingEngine()
+    fills, touched, cancelled = [], {}, []
+    engine.feed([row(order) for order in orders], fills, touched, cancelled)
+    # Cancel what is still resting, so every reservation is released
+    for order_id in list(engine.book.orders):
+        cancelled.append(engine.book.cancel(order_id))
+    trades, puk_credits, coin_credits = settlement_credits(fills, cancelled)
+
+    assert sum(trade[5] for trade in trades) == pytest.approx(7)
+    assert sum(puk_credits.values()) == pytest.approx(reserved_puk)
+    assert sum(coin_credits.values()) == pytest.approx(reserved_coins)
+    assert coin_credits[10] == pytest.approx(3 * 1.00)
+    assert coin_credits[11] == pytest.approx(4 * 1.05)
+
+
+def test_engine_cancels_requested_orders_and_market_remainders():
+    engine = MatchingEngine()
+    engine.feed([row(limit(1, 10, 'sell', 1.00, 2))], [], {}, [])
+    fills, touched, cancelled = [], {}, []
+    engine.feed([row(limit(2, 11, 'buy', 1.00, 1), cancel_requested=True),
+                 row(market(3, 12, 'buy', 1.10, 5))], fills, touched, cancelled)
+    assert [order.id for order in cancelled] == [2, 3]
+    assert [(taker.id, maker.id, quantity) for taker, maker, quantity, _ in fills] == [(3, 1, 2)]
+    assert engine.book.orders == {}
@@ -0,0 +1,41 @@
+"""Keyset cursor tokens and the page-number window."""
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from main import decode_cursor, decode_timestamp_cursor, encode_cursor, page_window
+
+
+def token(payload):
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def test_cursor_round_trip():
+    moment = datetime(2025, 3, 1, 12, 30, 5, 123456)
+    assert decode_cursor(encode_cursor(moment, 42)) == [moment.isoformat(), 42]
+    assert decode_timestamp_cursor(encode_cursor(moment, 42)) == (moment, 42)
+
+
+@pytest.mark.parametrize('value', [None, '', 'not base64!', '%%%', token(b'{"a": 1}'), token(b'"text"'),
+                                   token(b'[1, '), token(b'\xff\xfe')])
+def test_malformed_cursor_is_none(value):
+    assert decode_cursor(value) is None
+
+
+@pytest.mark.parametrize('values', [[], ['yesterday', 1], ['2025-03-01T12:30:05', 'x'], [None, 1], [1]])
+def test_tampered_timestamp_cursor_is_none(values):
+    assert decode_timestamp_cursor(token(json.dumps(values).encode())) is None
+
+
+def test_page_window():
+    assert page_window(1, 1) == [1]
+    assert page_window(1, 100) == [1, 2, 3]
+    assert page_window(50, 100) == [48, 49, 50, 51, 52]
+    assert page_window(100, 100) == [98, 99, 100]
+    assert page_window(5, 100, radius=1) == [4, 5, 6]
+
+
+def test_page_window_without_pages():
+    assert page_window(1, 0) == []
@@ -0,0 +1,25 @@
+"""Escaping of ts_headline fragments for search results."""
+from markupsafe import Markup
+
+from main import highlight_snippet
+
+
+def test_marks_survive_and_html_is_escaped():
+    snippet = highlight_snippet('<script>alert(1)</script> a <mark>ledger</mark> & more')
+    assert isinstance(snippet, Markup)
+    assert snippet == '&lt;script&gt;alert(1)&lt;/script&gt; a <mark>ledger</mark> &amp; more'
+
+
+def test_board_formatting_tags_are_dropped():
+    assert highlight_snippet('<b>bold</b> <em><mark>hit</mark></em>') == 'bold <mark>hit</mark>'
+
+
+def test_mark_with_attributes_stays_escaped():
+    snippet = highlight_snippet('<mark onmouseover="steal()">x</mark>')
+    assert '<mark onmouseover' not in snippet
+    assert snippet.startswith('&lt;mark onmouseover=')
+
+
+def test_empty_headline():
+    assert highlight_snippet(None) == ''
+    assert highlight_snippet('') == ''
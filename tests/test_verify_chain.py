@@ -0,0 +1,87 @@
+"""Block batch verification and checkpoint signatures, without a database."""
+import pytest
+
+import main
+from main import GENESIS_HASH, GENESIS_PREVIOUS_HASH, compute_block_hash, sign_checkpoint, verify_block_batch
+
+
+def chain(length):
+    rows = [(0, 'Genesis Block', GENESIS_HASH, GENESIS_PREVIOUS_HASH)]
+    for index in range(1, length):
+        message = f'block {index}'
+        rows.append((index, message, compute_block_hash(rows[-1][2], index, message), rows[-1][2]))
+    return rows
+
+
+def test_valid_chain_passes_in_batches():
+    rows = chain(10)
+    assert verify_block_batch((None, None, rows[:4])) is None
+    assert verify_block_batch((rows[3][0], rows[3][2], rows[4:])) is None
+
+
+def test_edited_message_is_reported():
+    rows = chain(5)
+    rows[2] = (2, 'edited', rows[2][2], rows[2][3])
+    assert verify_block_batch((None, None, rows)) == (2, 'hash does not match sha256(previous_hash + index + message)')
+
+
+def test_rehashed_block_breaks_the_next_link():
+    rows = chain(5)
+    rows[2] = (2, 'edited', compute_block_hash(rows[2][3], 2, 'edited'), rows[2][3])
+    index, reason = verify_block_batch((None, None, rows))
+    assert index == 3 and reason.startswith('previous_hash does not match')
+
+
+def test_gap_and_wrong_predecessor_across_batches():
+    rows = chain(6)
+    assert verify_block_batch((None, None, rows[:3] + rows[4:]))[0] == 4
+    assert verify_block_batch((rows[2][0], rows[1][2], rows[3:]))[0] == 3
+
+
+def test_genesis_previous_hash_must_be_zero():
+    rows = chain(2)
+    rows[0] = (0, rows[0][1], GENESIS_HASH, 'f' * 64)
+    assert verify_block_batch((None, None, rows)) == (0, 'genesis previous_hash is not zero')
+
+
+class CheckpointCursor:
+    """Answers find_resume_checkpoint's two queries from fixed rows."""
+
+    def __init__(self, checkpoints, edited=False):
+        self.checkpoints = checkpoints
+        self.edited = edited
+        self.result = None
+
+    def execute(self, query, params=None):
+        self.result = self.checkpoints if 'chain_checkpoints' in query else ([(1,)] if self.edited else [])
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+
+def test_checkpoint_signature(monkeypatch):
+    monkeypatch.setattr(main, 'CHECKPOINT_SECRET', 'secret')
+    signature = sign_checkpoint(9, 'ab', 'cd', 3)
+    assert signature == sign_checkpoint(9, 'ab', 'cd', 3)
+    assert signature != sign_checkpoint(10, 'ab', 'cd', 3)
+    monkeypatch.setattr(main, 'CHECKPOINT_SECRET', 'other')
+    assert signature != sign_checkpoint(9, 'ab', 'cd', 3)
+
+
+def test_resume_skips_forged_and_edited_checkpoints(monkeypatch):
+    monkeypatch.setattr(main, 'CHECKPOINT_SECRET', 'secret')
+    good = (5, 'ab', 'cd', 2)
+    forged = (9, 'ef', '01', 4, 'f' * 64)
+    cursor = CheckpointCursor([forged, (*good, sign_checkpoint(*good))])
+    assert main.find_resume_checkpoint(cursor) == good
+    assert main.find_resume_checkpoint(CheckpointCursor([(*good, sign_checkpoint(*good))], edited=True)) is None
+
+
+def test_no_checkpoints_without_a_secret(monkeypatch):
+    monkeypatch.setattr(main, 'CHECKPOINT_SECRET', None)
+    with pytest.raises(RuntimeError):
+        sign_checkpoint(5, 'ab', 'cd', 2)
+    assert main.find_resume_checkpoint(CheckpointCursor([(5, 'ab', 'cd', 2, 'f' * 64)])) is None